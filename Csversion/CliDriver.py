@@ -16,16 +16,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
 
-import ConfigParser
 import getopt
 import logging
 import os
 import os.path
 import re
 import sys
-import xml.sax.saxutils
-import json
-import yaml
 
 from os import environ
 from Settings import Setting
@@ -238,6 +234,7 @@ class CliDriver(object):
             return
         if self.settings[self.DEFAULT_CONFIG_SETTINGS_KEY] is None:
             return
+        import json
         for (key, value) in json.loads(self.settings[self.DEFAULT_CONFIG_SETTINGS_KEY]).items():
             if isinstance(value, dict):
                 self.settings[key] = value
@@ -251,6 +248,9 @@ class CliDriver(object):
                 self.settings[key] = value
 
     def _getFileOptions(self, filenames):
+        if not any([ os.path.isfile(filename) for filename in filenames ]):
+            return
+        import ConfigParser
         parser = ConfigParser.RawConfigParser()
         parser.read(filenames)
         try:
@@ -0,0 +1,143 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import signal
+import subprocess
+import threading
+
+#The ProcessTracker of each thread, see ProcessTracker.track
+_tracking = threading.local()
+
+class ProcessTracker(object):
+    """Purpose: Keep the processes started for one piece of work, e.g.,
+       a csversionfile section, so they can be killed when it takes too
+       long.  Once a thread calls track, the processes it starts through
+       CommandLines are kept, each in its own process group so what it
+       starts is killed with it.  Others can be kept with add.
+       Processes kept after kill are killed as they are added.
+    """
+
+    def __init__(self, log=logging):
+        self.log = log
+        self.processes = []
+        self.killed = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def current():
+        """Returns the tracker of the calling thread, None if it has none"""
+        return getattr(_tracking, 'tracker', None)
+
+    def track(self):
+        """Makes this the tracker of the calling thread"""
+        _tracking.tracker = self
+
+    @staticmethod
+    def carry(function):
+        """Returns function wrapped to run with the tracker of the
+           calling thread, e.g., on the threads of a pool"""
+        tracker = ProcessTracker.current()
+        def tracked(*args, **kwargs):
+            previous = ProcessTracker.current()
+            _tracking.tracker = tracker
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _tracking.tracker = previous
+        return tracked
+
+    def add(self, process):
+        with self.lock:
+            if process not in self.processes:
+                self.processes.append(process)
+            killed = self.killed
+        if killed:
+            self._kill(process)
+
+    def remove(self, process):
+        """Stops keeping process, e.g., a shared one once this piece of
+           work is done with it"""
+        with self.lock:
+            if process in self.processes:
+                self.processes.remove(process)
+
+    def kill(self):
+        with self.lock:
+            self.killed = True
+            processes = list(self.processes)
+        for process in processes:
+            self._kill(process)
+
+    def _kill(self, process):
+        if process.poll() is not None:
+            return
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError as e:
+            self.log.debug("Could not kill process %d: %s", process.pid, str(e))
+
+class CommandLines(object):
+    """Purpose: Run a command and iterate over its output lines as the
+       command produces them, so the output is parsed while the command
+       is still running and is never held in memory as a whole.
+       stderr is read on a separate thread so the command can't block
+       writing to it.  Once the lines are consumed, returncode and err
+       (the stderr output) are set.
+    """
+
+    def __init__(self, command, log=logging, shell=False, tracker=None):
+        #tracker is the ProcessTracker to keep the command in, the
+        #   calling thread's when None
+        self.command = command
+        self.log = log
+        self.shell = shell
+        self.tracker = tracker
+        self.returncode = None
+        self.err = ''
+
+    def _drain(self, stream, chunks):
+        for chunk in iter(lambda: stream.read(4096), ''):
+            chunks.append(chunk)
+        stream.close()
+
+    def __iter__(self):
+        tracker = self.tracker
+        if tracker is None:
+            tracker = ProcessTracker.current()
+        #Buffered, python 2 reads an unbuffered pipe a byte at a time
+        p = subprocess.Popen(
+            self.command,
+            shell=self.shell,
+            bufsize=-1,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            preexec_fn=os.setsid if tracker is not None else None )
+        if tracker is not None:
+            tracker.add(p)
+        chunks = []
+        drainer = threading.Thread(target=self._drain, args=(p.stderr, chunks))
+        drainer.daemon = True
+        drainer.start()
+        try:
+            for line in iter(p.stdout.readline, ''):
+                yield line.rstrip('\n')
+        finally:
+            p.stdout.close()
+            self.returncode = p.wait()
+            drainer.join()
+            self.err = ''.join(chunks)
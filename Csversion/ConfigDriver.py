@@ -15,11 +15,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
 
+import CommandLines
 import ConfigParser
+import ContainerSession
 import CsversionModules
+import ManifestCache
+import cPickle
 import datetime
+import hashlib
+import imp
+import importlib
+import os
 import os.path
+import tempfile
 import sys
+import threading
+import time
+from Profiler import PROFILER
 
 class ConfigDriver(object):
 
@@ -27,29 +39,121 @@ class ConfigDriver(object):
         def __init__(self):
             self.__dict__ = {}
 
-    def __init__(self, configs, log, manifest):
+    class Section(object):
+        def __init__(self, key, tag, prefix, options, instance, timeout):
+            self.key = key
+            self.tag = tag
+            self.prefix = prefix
+            self.options = options
+            self.instance = instance
+            self.timeout = timeout
+            self.started = None
+            self.finished = threading.Event()
+            self.result = None
+            #Set when the section was captured with its container's batch
+            self.batched = False
+            self.error = None
+            #Set when the section took longer than its timeout
+            self.abandoned = False
+            self.holdsSlot = False
+            self.lock = threading.Lock()
+            self.processes = None
+
+    CACHE_FORMAT = 1
+    SECTION_SUFFIX = '.section'
+    #Options set for one capture, not by the csversionfile
+    RUN_OPTIONS = ('**cache-dir', '**capture-state', '**container-output')
+
+    def __init__(self, configs, log, manifest, workers=1, timeout=None, cachedir=None, incremental=False, target=None):
+        #workers is the number of sections captured at the same time
+        #timeout is the default number of seconds a section may take
+        #   when sections are captured concurrently, None is no limit.
+        #   A section may set its own with a '**timeout' option.
+        #cachedir is given to the sections as a '**cache-dir' option
+        #   for anything they keep between captures, None is no cache.
+        #   Anything they keep during one execute goes in the dict of
+        #   the '**capture-state' option, shared by its sections.  What
+        #   they put in it with a close() is closed when execute ends.
+        #incremental reuses the results a section captured before when
+        #   its csversionInputFingerprint is unchanged, needs cachedir.
+        #target is a (type, name) to capture instead of this system,
+        #   e.g., ('chroot', '/srv/build1') or ('docker', 'web').  It is
+        #   set as the type's option on sections whose module lists the
+        #   type in TARGET_TYPES, and {target} in any option is the name.
         self.spec = ConfigParser.RawConfigParser()
         self.log = log
         self.manifest = manifest
+        self.workers = workers
+        self.timeout = timeout
+        if cachedir is not None:
+            try:
+                ManifestCache.prepareCacheDir(cachedir)
+            except (IOError, OSError) as e:
+                self.log.info("Capture cache '%s' is not usable, continuing without it: %s", cachedir, str(e))
+                cachedir = None
+        self.cachedir = cachedir
+        self.incremental = incremental and cachedir is not None
+        self.target = target
         for config in configs:
             if os.path.isfile(config):
                 self.log.debug("Loading csversionfile: %s", config)
                 self.spec.read(configs)
             else:
                 self.log.error("csversionfile '%s', not found", config)
+        #Only imported when a section isn't a registered module
+        self.localModules = None
+
+    def _getLocalModules(self):
+        if self.localModules is None:
+            #Only a missing CsversionLocalModules means there are none, an
+            #  ImportError from within it is an error in the local modules
+            try:
+                if 'CsversionLocalModules' not in sys.modules:
+                    imp.find_module('CsversionLocalModules')
+            except ImportError:
+                self.log.debug("""No local modules found in CsversionLocalModules
+    If this is unexpected, remember to add __init__.py
+    see man csversion for details""")
+                self.localModules = self.EmptyModules()
+                return self.localModules
+            try:
+                import CsversionLocalModules
+            except ImportError as e:
+                self.log.error("CsversionLocalModules failed to import: %s", str(e))
+                raise
+            self.localModules = CsversionLocalModules
+        return self.localModules
+
+    def _findModule(self, key):
+        targetModule = CsversionModules.lookup(key)
+        if targetModule is not None:
+            return targetModule
+        localModules = self._getLocalModules()
+        if key in localModules.__dict__:
+            return localModules.__dict__[key]
+        if isinstance(localModules, self.EmptyModules):
+            return None
+        #A module in CsversionLocalModules that its __init__.py doesn't import.
+        #  Only its absence means there is no such section, an ImportError
+        #  from within it, e.g., of a missing dependency, is the module's.
         try:
-            import CsversionLocalModules
+            imp.find_module(key, getattr(localModules, '__path__', []))
         except ImportError:
-            self.log.debug("""No local modules found in CsversionLocalModules
-    If this is unexpected, remember to add __init__.py
-    __init__.py must import your modules, see man csversion for details""")
-            CsversionLocalModules = self.EmptyModules()
-            
+            return None
+        try:
+            return importlib.import_module('CsversionLocalModules.%s' % key)
+        except ImportError as e:
+            self.log.error("CsversionLocalModules.%s failed to import: %s", key, str(e))
+            raise
 
-    def execute(self):
-        tags = []
+    def _prepareSections(self, state):
+        sections = []
         for key in self.spec.sections():
             options = { stanza: self.spec.get(key, stanza) for stanza in self.spec.options(key) }
+            if self.target is not None:
+                targetType, targetName = self.target
+                options = dict([ (name, value.replace('{target}', targetName))
+                    for name, value in options.iteritems() ])
             if ' ' in key:
                 key, prefix = key.split()
             else:
@@ -60,14 +164,8 @@ class ConfigDriver(object):
             else:
                 tag = '_'
 
-            if tag not in tags:
-                tags.append(tag)
-            
-            if key in CsversionModules.__dict__:
-                targetModule = CsversionModules.__dict__[key]
-            elif key in CsversionLocalModules.__dict__:
-                targetModule = CsversionLocalModules.__dict__[key]
-            else:
+            targetModule = self._findModule(key)
+            if targetModule is None:
                 self.log.error("Section '%s' not found", key)
                 raise ValueError("Section '%s' not found" % key)
 
@@ -77,17 +175,320 @@ class ConfigDriver(object):
                 raise ValueError("Missing class '%s'" % key)
 
             targetInstance = targetModule.__dict__[key](self.log)
+            if self.target is not None \
+              and targetType in getattr(targetInstance, 'TARGET_TYPES', []) \
+              and targetType not in options:
+                options[targetType] = targetName
             if len(prefix) == 0:
                 prefix = targetInstance.defaultPrefix()
                 self.log.debug("   vvv Prefix not specified, using default: %s", prefix)
-            manifestPart = self.manifest
-            for part in prefix.split('.'):
-                part = part.strip()
-                if part not in manifestPart:
-                    manifestPart[part] = {}
-                manifestPart = manifestPart[part]
-            self.log.debug("Executing Section: [%s@%s %s]", key, tag, prefix)
-            targetInstance.csversionPopulateManifest(manifestPart, options, key, tag, prefix)
+
+            timeout = self.timeout
+            if '**timeout' in options:
+                timeout = float(options['**timeout'])
+            if self.cachedir is not None and '**cache-dir' not in options:
+                options['**cache-dir'] = self.cachedir
+            options['**capture-state'] = state
+            sections.append(self.Section(key, tag, prefix, options, targetInstance, timeout))
+        return sections
+
+    def _manifestPart(self, prefix):
+        manifestPart = self.manifest
+        for part in prefix.split('.'):
+            part = part.strip()
+            if part not in manifestPart:
+                manifestPart[part] = {}
+            manifestPart = manifestPart[part]
+        return manifestPart
+
+    def _runSection(self, section, manifestPart):
+        self.log.debug("Executing Section: [%s@%s %s]", section.key, section.tag, section.prefix)
+        with PROFILER.phase('section', key=section.key, tag=section.tag, prefix=section.prefix):
+            section.instance.csversionPopulateManifest(
+                manifestPart,
+                section.options,
+                section.key,
+                section.tag,
+                section.prefix )
+        return manifestPart
+
+    def _sectionCachePath(self, section):
+        options = sorted([ (name, value) for name, value in section.options.iteritems()
+            if name not in self.RUN_OPTIONS ])
+        return os.path.join(
+            self.cachedir,
+            hashlib.sha1(repr((section.key, section.tag, section.prefix, options))).hexdigest()
+                + self.SECTION_SUFFIX )
+
+    def _inputFingerprint(self, section):
+        #None when the section doesn't declare its inputs
+        if not hasattr(section.instance, 'csversionInputFingerprint'):
+            return None
+        try:
+            return section.instance.csversionInputFingerprint(
+                section.options,
+                section.key,
+                section.tag,
+                section.prefix )
+        except Exception as e:
+            self.log.debug("Section [%s@%s %s] input fingerprint failed: %s",
+                section.key, section.tag, section.prefix, str(e))
+            return None
+
+    def _readSectionCache(self, path, fingerprint):
+        try:
+            with open(path, 'rb') as f:
+                entry = cPickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            self.log.debug("Discarding unreadable section cache '%s': %s", path, str(e))
+            return None
+        if entry.get('format') != self.CACHE_FORMAT \
+          or entry.get('fingerprint') != fingerprint:
+            return None
+        #Used, the cache evicts the least recently used entries first
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry['result']
+
+    def _writeSectionCache(self, path, fingerprint, result):
+        temppath = None
+        try:
+            fd, temppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump({
+                    'format' : self.CACHE_FORMAT,
+                    'fingerprint' : fingerprint,
+                    'result' : result }, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temppath, path)
+        except Exception as e:
+            self.log.debug("Could not write section cache '%s': %s", path, str(e))
+            if temppath is not None and os.path.exists(temppath):
+                os.remove(temppath)
+
+    def _captureSection(self, section):
+        #Returns the section's part of the manifest, from the cache when
+        #  capturing incrementally and its inputs haven't changed
+        fingerprint = None
+        if self.incremental:
+            fingerprint = self._inputFingerprint(section)
+        if fingerprint is None:
+            return self._runSection(section, {})
+        path = self._sectionCachePath(section)
+        result = self._readSectionCache(path, fingerprint)
+        if result is not None:
+            self.log.debug("Section [%s@%s %s] inputs are unchanged, reusing the last capture",
+                section.key, section.tag, section.prefix)
+            PROFILER.count('sections reused')
+            return result
+        result = self._runSection(section, {})
+        if self._outputComplete(section):
+            self._writeSectionCache(path, fingerprint, result)
+        return result
+
+    def _outputComplete(self, section):
+        #Whether all of the batched container output the section read
+        #  arrived, see _captureContainers
+        outputs = section.options.get('**container-output', {})
+        return None not in [ output.returncode for output in outputs.itervalues() if output.started ]
+
+    def _mergeInto(self, target, source):
+        #Merges the result of a section into what the sections before it
+        #  captured: dictionaries are merged, lists are extended and any
+        #  other value replaces the one before it.
+        for key, value in source.iteritems():
+            current = target.get(key)
+            if type(value) is dict:
+                if type(current) is not dict:
+                    current = target[key] = {}
+                self._mergeInto(current, value)
+            elif type(value) is list and type(current) is list:
+                current.extend(value)
+            else:
+                target[key] = value
+
+    def _releaseSlot(self, section, slots):
+        #The slot is given back once, by the section's thread when it
+        #  finishes or for it when it is abandoned
+        with section.lock:
+            if not section.holdsSlot:
+                return
+            section.holdsSlot = False
+        slots.release()
+
+    def _runSectionThread(self, section, slots, progress):
+        try:
+            slots.acquire()
+            with section.lock:
+                section.holdsSlot = True
+                section.started = time.time()
+            progress.set()
+            section.processes.track()
+            try:
+                section.result = self._captureSection(section)
+            except BaseException:
+                section.error = sys.exc_info()
+        finally:
+            self._releaseSlot(section, slots)
+            section.finished.set()
+            progress.set()
+
+    def _abandonSection(self, section, slots):
+        #Gives the slot of a section that took longer than its timeout to
+        #  the sections waiting for one and kills what it started.  Its
+        #  thread is left to end once its commands are killed.
+        section.abandoned = True
+        self.log.error("Section [%s@%s %s] did not finish within %s seconds, its results are not captured",
+            section.key,
+            section.tag,
+            section.prefix,
+            section.timeout )
+        self._releaseSlot(section, slots)
+        section.processes.kill()
+
+    def _executeConcurrently(self, sections):
+        #Each section fills its own part of a private manifest, the parts
+        #  are merged in csversionfile order so the result doesn't
+        #  depend on which section finished first.
+        #  Daemon threads are used so a hung section can be abandoned.
+        #  The timeout of a section counts from when it gets a slot, not
+        #  from when it was queued, and every running section's timeout
+        #  is watched, whichever order the sections get their slots in.
+        #  Sections captured with their container's batch only merge.
+        slots = threading.Semaphore(max(1, self.workers))
+        progress = threading.Event()
+        running = [ section for section in sections if not section.batched ]
+        for section in running:
+            section.processes = CommandLines.ProcessTracker(self.log)
+            thread = threading.Thread(
+                target=self._runSectionThread,
+                args=(section, slots, progress),
+                name="csversion-%s@%s" % (section.key, section.tag) )
+            thread.daemon = True
+            thread.start()
+        pending = list(running)
+        while len(pending) > 0:
+            progress.clear()
+            wait = None
+            for section in list(pending):
+                if section.finished.is_set():
+                    pending.remove(section)
+                    continue
+                if section.timeout is None or section.started is None:
+                    continue
+                left = section.started + section.timeout - time.time()
+                if left <= 0:
+                    self._abandonSection(section, slots)
+                    pending.remove(section)
+                elif wait is None or left < wait:
+                    wait = left
+            if len(pending) > 0:
+                progress.wait(wait)
+        for section in sections:
+            if section.abandoned:
+                continue
+            if section.error is not None:
+                raise section.error[0], section.error[1], section.error[2]
+            self._mergeInto(self._manifestPart(section.prefix), section.result)
+
+    def _captureContainers(self, sections):
+        #Sections that declare csversionContainerQueries for a docker
+        #  container have their queries run together with those of the
+        #  other sections for the same container, in one docker exec.
+        #  Each section gets its output in a '**container-output' option
+        #  and is captured as that output streams in, one after another
+        #  in the order of the queries.  A section whose output didn't
+        #  all arrive is captured alone afterwards, with the others.
+        #  Sections also using chroot, or with docker-batch=False, do
+        #  their own docker exec.
+        sessions = []
+        byContainer = {}
+        for index, section in enumerate(sections):
+            options = section.options
+            if 'docker' not in options or 'chroot' in options \
+              or options.get('docker-batch', 'True').lower() != 'true' \
+              or not hasattr(section.instance, 'csversionContainerQueries'):
+                continue
+            queries = section.instance.csversionContainerQueries(
+                options,
+                section.key,
+                section.tag,
+                section.prefix )
+            container = options['docker']
+            if container not in byContainer:
+                byContainer[container] = (ContainerSession.ContainerSession(container, self.log), [])
+                sessions.append(byContainer[container])
+            session, members = byContainer[container]
+            for name, script in queries:
+                session.add((index, name), script)
+            members.append((index, section, [ name for name, _ in queries ]))
+        for session, members in sessions:
+            #The queries of the sections run one after another, the exec
+            #  gets as long as the sections would have had between them
+            timeouts = [ section.timeout for _, section, _ in members ]
+            timeout = None
+            if None not in timeouts:
+                timeout = sum(timeouts)
+            with PROFILER.phase('container', container=session.container):
+                session.start(timeout)
+                try:
+                    for index, section, names in members:
+                        section.options['**container-output'] = dict(
+                            [ (name, session.output((index, name))) for name in names ] )
+                        result = self._captureSection(section)
+                        if self._outputComplete(section):
+                            section.result = result
+                            section.batched = True
+                        else:
+                            self.log.info("The batched query of container '%s' failed, section [%s@%s %s] queries it alone",
+                                session.container, section.key, section.tag, section.prefix)
+                        del section.options['**container-output']
+                finally:
+                    session.finish()
+
+    def _closeState(self, state):
+        for name, value in state.iteritems():
+            close = getattr(value, 'close', None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception as e:
+                self.log.debug("Closing the capture's '%s' failed: %s", name, str(e))
+
+    def execute(self):
+        state = {}
+        try:
+            self._execute(state)
+        finally:
+            self._closeState(state)
+
+    def _execute(self, state):
+        sections = self._prepareSections(state)
+        self._captureContainers(sections)
+        tags = []
+        for section in sections:
+            if section.tag not in tags:
+                tags.append(section.tag)
+
+        #Captured one after another, sections write into the manifest in
+        #  place, so a section sees what those before it wrote.  Reused,
+        #  concurrent and batched captures each have their own result,
+        #  merged in csversionfile order.
+        timeouts = [ section for section in sections if section.timeout is not None ]
+        if self.workers <= 1 and len(timeouts) == 0:
+            for section in sections:
+                if section.batched:
+                    self._mergeInto(self._manifestPart(section.prefix), section.result)
+                elif self.incremental:
+                    self._mergeInto(self._manifestPart(section.prefix), self._captureSection(section))
+                else:
+                    self._runSection(section, self._manifestPart(section.prefix))
+        else:
+            self._executeConcurrently(sections)
 
         if 'product' not in self.manifest:
             self.manifest['product'] = {}
@@ -0,0 +1,185 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import re
+import threading
+import uuid
+from CommandLines import CommandLines, ProcessTracker
+
+class ContainerSession(object):
+    """Purpose: Run many shell queries in a docker container with a
+       single docker exec.  The queries are run one after another by one
+       bash script, each between sentinel lines carrying the name and
+       return code of the query.  Each query's lines are handed on as
+       they stream in between its sentinels, none are held back.  The
+       sentinels are written to stderr too, so what each query writes
+       there can be logged.
+    """
+
+    def __init__(self, container, log=logging, sudo=True):
+        self.container = container
+        self.log = log
+        self.sudo = sudo
+        self.queries = []
+        self.outputs = {}
+        self.source = None
+        #Unique per session so query output can't be mistaken for it
+        self.sentinel = '<<<csversion-%s' % uuid.uuid4().hex
+        self.sentinelRe = re.compile(
+            r'^%s (?P<event>begin|end) (?P<index>\d+)(?: (?P<returncode>\d+))?>>>$'
+                % re.escape(self.sentinel) )
+
+    def add(self, name, script):
+        self.queries.append((name, script))
+
+    def _script(self):
+        parts = []
+        for index, (name, script) in enumerate(self.queries):
+            parts.append(
+                "echo '%(sentinel)s begin %(index)d>>>'; echo '%(sentinel)s begin %(index)d>>>' >&2\n"
+                "( %(script)s\n)\n"
+                "r=$?; printf '\\n%(sentinel)s end %(index)d %%d>>>\\n' $r; echo \"%(sentinel)s end %(index)d $r>>>\" >&2" % {
+                    'sentinel' : self.sentinel, 'index' : index, 'script' : script })
+        return '\n'.join(parts) + '\n'
+
+    def command(self):
+        command = ["docker", "exec", self.container, "bash", "-c", self._script()]
+        if self.sudo:
+            command = ["sudo", "-E"] + command
+        return command
+
+    def _logErrors(self, err):
+        #Logs what each query wrote to stderr, split by the sentinels
+        name = None
+        errors = []
+        for line in err.splitlines():
+            match = self.sentinelRe.match(line)
+            if match is None:
+                if name is not None:
+                    errors.append(line)
+                elif len(line.strip()) > 0:
+                    self.log.debug("docker exec into '%s': %s", self.container, line)
+                continue
+            if match.group('event') == 'begin':
+                name = self.queries[int(match.group('index'))][0]
+                errors = []
+                continue
+            if len(errors) > 0:
+                self.log.debug("Query '%s' in container '%s' wrote to stderr:\n%s",
+                    name, self.container, '\n'.join(errors))
+            name = None
+        if name is not None and len(errors) > 0:
+            self.log.debug("Query '%s' in container '%s' wrote to stderr:\n%s",
+                name, self.container, '\n'.join(errors))
+
+    def _timedOut(self, tracker, timeout):
+        self.log.error("docker exec into '%s' did not finish within %s seconds, it is killed",
+            self.container, timeout)
+        tracker.kill()
+
+    def start(self, timeout=None):
+        """Starts the docker exec, the output of each query is then read
+           through output.  finish must be called once they are read.
+           The docker exec is killed after timeout seconds, None is no limit.
+        """
+        self.outputs = dict([ (name, QueryOutput(self, index))
+            for index, (name, _) in enumerate(self.queries) ])
+        self.next = 0
+        self.pending = 0
+        self.tracker = ProcessTracker(self.log)
+        self.timer = None
+        if len(self.queries) == 0:
+            return
+        self.log.debug("Running %d queries in container '%s' with one exec",
+            len(self.queries), self.container)
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self._timedOut, (self.tracker, timeout))
+            self.timer.daemon = True
+            self.timer.start()
+        self.lines = CommandLines(self.command(), self.log, tracker=self.tracker)
+        self.source = iter(self.lines)
+
+    def output(self, name):
+        """Returns the QueryOutput of the query added as name"""
+        return self.outputs[name]
+
+    def _read(self, output):
+        #The queries run in order, the lines of those before this one
+        #  that weren't read are skipped
+        while self.next < output.index:
+            for _ in self._read(self.outputs[self.queries[self.next][0]]):
+                pass
+        if self.next != output.index or self.source is None:
+            return
+        self.next += 1
+        begun = False
+        for line in self.source:
+            match = self.sentinelRe.match(line)
+            if match is None or int(match.group('index')) != output.index:
+                if not begun:
+                    continue
+                if line == '':
+                    #The end sentinel follows a newline of its own, so a
+                    #  query's output needn't end with one.  Empty lines
+                    #  are held until it is known the sentinel isn't next.
+                    self.pending += 1
+                    continue
+                while self.pending > 0:
+                    self.pending -= 1
+                    yield ''
+                yield line
+            elif match.group('event') == 'begin':
+                begun = True
+                self.pending = 0
+            else:
+                for _ in range(self.pending - 1):
+                    yield ''
+                self.pending = 0
+                output.returncode = int(match.group('returncode'))
+                return
+
+    def finish(self):
+        """Waits for the docker exec to end, skipping what wasn't read"""
+        if self.source is None:
+            return
+        try:
+            for _ in self.source:
+                pass
+        finally:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.source = None
+        if self.lines.returncode != 0:
+            self.log.info("docker exec into '%s' returned %d", self.container, self.lines.returncode)
+        self._logErrors(self.lines.err)
+
+class QueryOutput(object):
+    """Purpose: The output lines of one query of a ContainerSession,
+       read from the docker exec as they arrive.  They can be read once.
+       Once they have been, returncode is that of the query, or None if
+       the query didn't run to completion.
+    """
+
+    def __init__(self, session, index):
+        self.session = session
+        self.index = index
+        self.started = False
+        self.returncode = None
+
+    def __iter__(self):
+        self.started = True
+        return self.session._read(self)
@@ -14,17 +14,73 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
+import bisect
+import calendar
 import CliDriver
-import ConfigDriver
+import CsversionModules
+import LruCache
+import ManifestCache
+import copy_reg
 import datetime
-import glob
-import json
+import gc
+import hashlib
 import os.path
 import re
-import yaml
+import sys
 import logging
+from Profiler import PROFILER
 from sys import stdout, stderr
 
+#yaml, json, glob, multiprocessing and ConfigDriver (with what captures
+#  need) are imported by the code that uses them, many runs need only a
+#  few of them and the imports dominate the startup of a short run
+yaml = None
+YamlLoader = None
+YamlDumper = None
+YAML_BACKEND = None
+
+def _importYaml(log=logging):
+    global yaml, YamlLoader, YamlDumper, YAML_BACKEND
+    if yaml is not None:
+        return
+    import yaml as module
+    #Use the libyaml bindings when they are available, they are many times
+    #  faster than the pure python implementation on large manifests
+    try:
+        YamlLoader = module.CSafeLoader
+        YamlDumper = module.CSafeDumper
+        YAML_BACKEND = 'libyaml'
+    except AttributeError:
+        YamlLoader = module.SafeLoader
+        YamlDumper = module.SafeDumper
+        YAML_BACKEND = 'python'
+    log.debug("Using the %s yaml backend", YAML_BACKEND)
+
+    #Manifests written by earlier versions of csversion may carry python
+    #  string tags, keep those readable with the safe loaders
+    YamlLoader.add_constructor(
+        u'tag:yaml.org,2002:python/unicode',
+        YamlLoader.construct_yaml_str )
+    YamlLoader.add_constructor(
+        u'tag:yaml.org,2002:python/str',
+        YamlLoader.construct_yaml_str )
+
+    _registerYamlTimezone()
+    yaml = module
+
+def _registerYamlTimezone():
+    #yaml attaches its own tzinfo class to the timestamps it loads, which
+    #  cannot be pickled as is.  Manifests crossing process boundaries
+    #  need it to be.  Manifests read from the cache bring the class
+    #  without yaml being imported through _importYaml.
+    constructor = sys.modules.get('yaml.constructor')
+    timezone = getattr(constructor, 'timezone', None)
+    if timezone is not None:
+        copy_reg.pickle(timezone, _reduceYamlTimezone)
+
+def _reduceYamlTimezone(tz):
+    return (type(tz), (tz.utcoffset(),))
+
 class Output(object):
     def __init__(self):
         self.stream = stdout
@@ -43,7 +99,79 @@ class Output(object):
     def output(self, dictionary):
         self.stream.write(str(dictionary))
 
-class XmlOutput(Output):
+    #Outputs {name : {...}} a record at a time: begin, then record for
+    #  each (key path, value) in sorted key path order, then end.
+    #  Gathered here and output whole, outputs that can write the
+    #  records as they come override the _open, _item, _leaf and
+    #  _close steps of StreamedOutput.
+    def begin(self, name):
+        self.records = {}
+        self.recordsName = name
+
+    def record(self, path, value):
+        current = self.records
+        for key in path[:-1]:
+            if key not in current:
+                current[key] = {}
+            current = current[key]
+        current[path[-1]] = value
+
+    def end(self):
+        self.output({self.recordsName : self.records})
+        self.records = None
+
+class StreamedOutput(Output):
+    def begin(self, name):
+        #The keys of the open dictionaries, and how many items each has
+        self.openPath = []
+        self.counts = [0]
+        self._begin()
+        self._openKey(name)
+
+    def _openKey(self, key):
+        self._item()
+        self._open(key)
+        self.openPath.append(key)
+        self.counts.append(0)
+
+    def _closeKey(self):
+        self._close(self.openPath.pop(), self.counts.pop())
+
+    def _item(self):
+        self._separate(self.counts[-1])
+        self.counts[-1] += 1
+
+    def record(self, path, value):
+        path = [self.openPath[0]] + list(path)
+        common = 0
+        while common < min(len(self.openPath), len(path) - 1) \
+          and self.openPath[common] == path[common]:
+            common += 1
+        while len(self.openPath) > common:
+            self._closeKey()
+        for key in path[common:-1]:
+            self._openKey(key)
+        self._item()
+        self._leaf(path[-1], value)
+
+    def end(self):
+        while len(self.openPath) > 0:
+            self._closeKey()
+        self._end()
+
+    def _depth(self):
+        return len(self.openPath)
+
+    def _begin(self):
+        pass
+
+    def _end(self):
+        pass
+
+    def _separate(self, count):
+        pass
+
+class XmlOutput(StreamedOutput):
     def _outputHelper(self, item, indent=0):
         indentString = " " * 4 * indent
         if issubclass(type(item), dict):
@@ -62,26 +190,346 @@ class XmlOutput(Output):
     def output(self, dictionary):
         self._outputHelper(dictionary)
 
-class JsonOutput(Output):
+    def _open(self, key):
+        self.stream.write("%s<%s>\n" % (" " * 4 * self._depth(), key))
+
+    def _leaf(self, key, value):
+        self._outputHelper({key : value}, self._depth())
+
+    def _close(self, key, count):
+        self.stream.write("%s</%s>\n" % (" " * 4 * self._depth(), key))
+
+class JsonOutput(StreamedOutput):
     def output(self, dictionary):
+        import json
         json.dump(dict(dictionary), self.stream)
 
-class YamlOutput(Output):
+    def _begin(self):
+        self.stream.write('{')
+
+    def _end(self):
+        self.stream.write('}')
+
+    def _separate(self, count):
+        if count > 0:
+            self.stream.write(', ')
+
+    def _open(self, key):
+        import json
+        self.stream.write('%s: {' % json.dumps(key))
+
+    def _leaf(self, key, value):
+        import json
+        self.stream.write('%s: %s' % (json.dumps(key), json.dumps(value)))
+
+    def _close(self, key, count):
+        self.stream.write('}')
+
+class YamlOutput(StreamedOutput):
     def output(self, dictionary):
-        yaml.dump(dict(dictionary), self.stream)
+        _importYaml()
+        yaml.dump(dict(dictionary), self.stream, Dumper=YamlDumper)
+
+    def _write(self, dumped):
+        #dumped indented to the depth of the open dictionaries
+        indent = '  ' * self._depth()
+        self.stream.write(''.join([ indent + line for line in dumped.splitlines(True) ]))
+
+    def _separate(self, count):
+        #A key is written without the line break after it until it is
+        #  known whether its dictionary is empty
+        if count == 0 and self._depth() > 0:
+            self.stream.write('\n')
+
+    def _open(self, key):
+        _importYaml()
+        #The key as yaml writes it, without the placeholder value
+        self._write(yaml.dump({key : 0}, Dumper=YamlDumper)[:-len(' 0\n')])
+
+    def _leaf(self, key, value):
+        _importYaml()
+        self._write(yaml.dump({key : value}, Dumper=YamlDumper))
+
+    def _close(self, key, count):
+        if count == 0:
+            self.stream.write(' {}\n')
+
+TARGET_FILENAME_RE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+def _targetFilename(target):
+    #The manifest filename of a capture target, <type>-<name>.csversion.  A
+    #  name with characters that are replaced, e.g., the / of a chroot path,
+    #  gets a short hash of the whole name too, as chroot:/srv/a/b and
+    #  chroot:/srv/a_b would otherwise both be chroot-srv_a_b.csversion
+    targetType, targetName = target
+    name = TARGET_FILENAME_RE.sub('_', targetName.strip('/')) or 'root'
+    if name != targetName:
+        name = '%s-%s' % (name, hashlib.sha1(targetName).hexdigest()[:8])
+    return '%s-%s.csversion' % (targetType, name)
 
 OUTPUT_TYPES = {
     'yaml': YamlOutput,
     'json': JsonOutput,
     'xml' : XmlOutput }
 
+def _loadManifestData(args):
+    #Executed in a loader pool process, only the parsed dictionary
+    #  is handed back to the parent,
+    #  with the phases and counters recorded while it was parsed
+    filepath, cache, sections, profiling = args
+    if profiling:
+        PROFILER.enable()
+    #Drop what the process inherited from the parent when it forked
+    PROFILER.takeRecords()
+    manifest = Manifest([], cache=cache, sections=sections)
+    manifest.loadManifest(filepath)
+    _registerYamlTimezone()
+    records = PROFILER.takeRecords()
+    return dict(manifest), manifest.fingerprints, records if profiling else None
+
+def _parseVersionKey(version):
+    #Versions compare part by part on '.'.  Each part is split into a main
+    #  and a sub part on its first '-', or when it has none on its first
+    #  '+'.  Numeric main parts compare as numbers and before any
+    #  non-numeric part, the rest and the sub parts compare as strings.
+    #  A part without a sub part is older than the same part with one.
+    #  When all common parts are equal the version with more parts is the
+    #  newer.  None is older than any version.
+    if version is None:
+        return ()
+    key = []
+    for part in version.split('.'):
+        sub = ()
+        if '-' in part:
+            part, sub = part.split('-',1)
+            sub = (sub,)
+        elif '+' in part:
+            part, sub = part.split('+',1)
+            sub = (sub,)
+        if part.isdigit():
+            key.append(((0, int(part)), sub))
+        else:
+            key.append(((1, part), sub))
+    return tuple(key)
+
+_versionKeys = LruCache.LruCache(_parseVersionKey, 16384)
+
+def versionKey(version):
+    #Returns a key for version that sorts in version order, e.g.,
+    #  sorted(versions, key=versionKey).  Each version string is parsed
+    #  once.  Versions yaml loaded as numbers are keyed by their text, the
+    #  memo can't tell 1 from 1.0.
+    if version is not None and not isinstance(version, basestring):
+        version = str(version)
+    return _versionKeys(version)
+
+ISO_TIME_RE = re.compile(
+    r'\s*(\d{4})-(\d{1,2})-(\d{1,2})'
+    r'(?:[Tt ]+(\d{1,2}):(\d{2})(?::(\d{2})(\.\d*)?)?)?'
+    r'\s*(?:(Z|z)|([+-])(\d{1,2})(?::?(\d{2}))?)?\s*$' )
+
+def _parseTimeKey(time):
+    #Converts an ISO 8601 time to seconds since the epoch (UTC).  Naive
+    #  times are taken as UTC.  Returns None for anything else.
+    match = ISO_TIME_RE.match(time)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, _, sign, tzhour, tzminute = match.groups()
+    try:
+        #Rejects what timegm would roll over, e.g., February 30
+        seconds = calendar.timegm(datetime.datetime(
+            int(year), int(month), int(day),
+            int(hour or 0), int(minute or 0), int(second or 0) ).timetuple())
+    except ValueError:
+        return None
+    if fraction is not None and len(fraction) > 1:
+        seconds += float(fraction)
+    if sign is not None:
+        offset = int(tzhour) * 3600 + int(tzminute or 0) * 60
+        if sign == '+':
+            seconds -= offset
+        else:
+            seconds += offset
+    return seconds
+
+_timeKeys = LruCache.LruCache(_parseTimeKey, 16384)
+
+def timeKey(time):
+    #Returns the seconds since the epoch for an ISO 8601 time, or a date
+    #  or datetime yaml made of one, so times compare by subtraction.
+    #  Each time string is parsed once.  Returns None for anything else.
+    if isinstance(time, basestring):
+        return _timeKeys(time)
+    #Not memoized, a naive and an aware datetime can't be compared
+    if isinstance(time, datetime.datetime):
+        return calendar.timegm(time.utctimetuple()) + time.microsecond / 1000000.0
+    if isinstance(time, datetime.date):
+        return calendar.timegm(time.timetuple())
+    return None
+
+def _fingerprint(value, strip=True):
+    #Merkle style digest of a manifest subtree: each dictionary or list is
+    #  hashed from the digests of its children.  With strip, '__older'
+    #  entries of dictionaries are left out, as compareTagDict ignores them,
+    #  so equal fingerprints mean compareTagDict finds the subtrees equal.
+    valuetype = type(value)
+    if valuetype is dict:
+        digest = hashlib.sha1('d')
+        for key in sorted(value.keys()):
+            if strip and key == '__older':
+                continue
+            digest.update(_fingerprint(key, False))
+            digest.update(_fingerprint(value[key], strip))
+        return digest.digest()
+    if valuetype is list or valuetype is tuple:
+        #compareTagDict compares lists whole, __older entries included
+        digest = hashlib.sha1(valuetype.__name__)
+        for item in value:
+            digest.update(_fingerprint(item, False))
+        return digest.digest()
+    text = repr(value)
+    if value != value:
+        #Not even equal to itself, e.g., nan, never match anything else
+        text = '%s@%d' % (text, id(value))
+    return hashlib.sha1('%s:%s' % (valuetype.__name__, text)).digest()
+
+def _tagFingerprints(manifest, fingerprints=None):
+    #Returns the fingerprint (hex digest) of every tag of every section
+    #  part of manifest keyed by (section, part, tag), and of every entry
+    #  in the tag's __older stash keyed by
+    #  (section, part, tag, '__older', older key).
+    #  Those already in fingerprints are not computed again.
+    if fingerprints is None:
+        fingerprints = {}
+    for key, section in manifest.iteritems():
+        if type(section) is not dict:
+            continue
+        for part, tags in section.iteritems():
+            if type(tags) is not dict:
+                continue
+            for tag, data in tags.iteritems():
+                path = (key, part, tag)
+                if path not in fingerprints:
+                    fingerprints[path] = _fingerprint(data).encode('hex')
+                if type(data) is not dict or type(data.get('__older')) is not dict:
+                    continue
+                for old, olddata in data['__older'].iteritems():
+                    path = (key, part, tag, '__older', old)
+                    if path not in fingerprints:
+                        fingerprints[path] = _fingerprint(olddata).encode('hex')
+    return fingerprints
+
+def _hasContent(data):
+    #Whether a tag holds anything besides its __older stash
+    if type(data) is not dict:
+        return True
+    return len(data) > (1 if '__older' in data else 0)
+
+def _countRecords(manifest):
+    #Counts the package records in the sources of a parsed manifest by
+    #  type, e.g., 'dpkg records parsed', those of __older stashes too
+    if type(manifest) is not dict or type(manifest.get('sources')) is not dict:
+        return
+    counts = {}
+    for tags in manifest['sources'].itervalues():
+        if type(tags) is not dict:
+            continue
+        for data in tags.itervalues():
+            if type(data) is not dict:
+                continue
+            entries = [data]
+            if type(data.get('__older')) is dict:
+                entries.extend(data['__older'].itervalues())
+            for entry in entries:
+                if type(entry) is not dict:
+                    continue
+                for kind, records in entry.iteritems():
+                    if kind != '__older' and type(records) is dict:
+                        counts[kind] = counts.get(kind, 0) + len(records)
+    for kind, count in counts.iteritems():
+        PROFILER.count('%s records parsed' % kind, count)
+
+_MISSING = object()
+
+def _mergeSorted(new, old):
+    #Walks the keys of two dictionaries in sorted order, yielding
+    #  (key, new value, old value) with _MISSING for an absent side
+    newkeys = sorted(new.keys()) if isinstance(new, dict) else []
+    oldkeys = sorted(old.keys()) if isinstance(old, dict) else []
+    newindex = 0
+    oldindex = 0
+    while newindex < len(newkeys) or oldindex < len(oldkeys):
+        if oldindex >= len(oldkeys) or \
+          newindex < len(newkeys) and newkeys[newindex] < oldkeys[oldindex]:
+            key = newkeys[newindex]
+            newindex += 1
+            yield (key, new[key], _MISSING)
+        elif newindex >= len(newkeys) or oldkeys[oldindex] < newkeys[newindex]:
+            key = oldkeys[oldindex]
+            oldindex += 1
+            yield (key, _MISSING, old[key])
+        else:
+            key = newkeys[newindex]
+            newindex += 1
+            oldindex += 1
+            yield (key, new[key], old[key])
+
+def _withoutOlder(data):
+    #data without the __older entries of its dictionaries at any depth,
+    #  those compareTagDict ignores
+    if data is _MISSING:
+        return {}
+    if type(data) is not dict:
+        return data
+    return dict([ (key, _withoutOlder(value))
+        for key, value in data.iteritems() if key != '__older' ])
+
+def _diffSection(key, newsection, oldsection, processor):
+    #Yields ((key, part, tag), {'old' : ..., 'new' : ...}) for each tag
+    #  of a section that was added, removed or changed, in sorted order,
+    #  after processor's handler for it has seen it
+    for part, newtags, oldtags in _mergeSorted(newsection, oldsection):
+        for tag, newdata, olddata in _mergeSorted(newtags, oldtags):
+            newdata = _withoutOlder(newdata)
+            olddata = _withoutOlder(olddata)
+            if newdata == olddata:
+                continue
+            tagdiff = {'old' : olddata, 'new' : newdata}
+            processor.doHandler((key, part, tag), tagdiff)
+            yield (key, part, tag), tagdiff
+
 class Manifest(dict):
-    def __init__(self, filepaths, preprocessed=[], log=logging):
+    #Top level lines of a block style yaml document and the plain keys
+    #  that start a section of the manifest.  A '- ' at the start of a
+    #  line is an entry of an indentless sequence, yaml's default block
+    #  style for a list, and belongs to the section above it.
+    TOP_LEVEL_LINE_RE = re.compile(r'^(?!-(?:\s|$))[^\s#]', re.M)
+    SEQUENCE_ENTRY_RE = re.compile(r'^-(?:\s|$)', re.M)
+    SECTION_KEY_RE = re.compile(r'([A-Za-z0-9_.-]+):(\s|$)')
+    #The plain keys of the entries of a section, e.g., package names
+    #  such as libstdc++6
+    ENTRY_KEY_RE = re.compile(r'([A-Za-z0-9_.+~-][^\s:#]*):(\s|$)')
+
+    def __init__(self, filepaths, preprocessed=[], log=logging, workers=1, cache=None, sections=None):
         #filepaths is a list of files to load as manifests
         #preprocessed is a list of manifest dictionaries to subsume
         #   into this manifest
+        #workers is the number of processes used to parse the manifest
+        #   files, 1 parses them serially in this process
+        #cache is a ManifestCache to consult before parsing a file
+        #sections is a list of the top level sections to load from the
+        #   files, None loads all of them
         self.preprocessed = []
         self.log = log
+        self.workers = workers
+        self.cache = cache
+        self.sections = sections
+        self.timelines = None
+        #The known fingerprints of the tags of the manifest, see
+        #  getFingerprints.  Those of manifests read from the cache are
+        #  stored with them and are kept as the manifests are collated,
+        #  the others are only computed when asked for.
+        self.fingerprints = {}
         for pre in preprocessed:
             m = Manifest([], log=log)
             m.update(pre)
@@ -146,101 +594,72 @@ class Manifest(dict):
                 return None
 
     def compareVersions(self, version1, version2):
-        try:
-            dotparts1 = version1.split('.')
-            dotparts2 = version2.split('.')
-            dotzip = zip(dotparts1,dotparts2)
-            result = 0
-            for part1, part2 in dotzip:
-                part1sub = None
-                part2sub = None
-                if '-' in part1:
-                    part1, part1sub = part1.split('-',1)
-                elif '+' in part1:
-                    part1, part1sub = part1.split('+',1)
-                if '-' in part2:
-                    part2, part2sub = part2.split('-',1)
-                elif '+' in part2:
-                    part2, part2sub = part2.split('+',1)
-                try:
-                    intpart1 = int(part1)
-                    intpart2 = int(part2)
-                    result = intpart1 - intpart2
-                    if result == 0:
-                        intpart1sub = int(part1)
-                        intpart2sub = int(part2)
-                        result = intpart1sub - intpart2sub
-                except (ValueError, TypeError):
-                    if part1 == part2:
-                        if part1sub > part2sub:
-                            return 1
-                        elif part1sub < part2sub:
-                            return -1
-                    else:
-                        if part1 > part2:
-                            return 1
-                        elif part1 < part2:
-                            return -1
-
-                if result != 0:
-                    break
-            else:
-                return result if result != 0 else len(dotparts1) - len(dotparts2)
-        except (TypeError, AttributeError):
-            if version1 is None:
-                if version2 is None:
-                    return 0
-                else:
-                    return -1
-            if version2 is None:
-                return 1
-            raise
+        if PROFILER.enabled:
+            PROFILER.count('compareVersions')
+        return cmp(versionKey(version1), versionKey(version2))
 
     def convertIsoToDateTime(self, time):
-        tz = datetime.timedelta(0)
-        if 'Z' in time:
-            time = time.split('Z',1)[0]
-        elif '+' in time:
-            time,zone = time.split('+',1)
-            zoneparts = zone.split(':')
-            zoneparts.reverse()
-            tz = -datetime.timedelta(0,0,0,0,*map(int,zoneparts))
-        elif '-' in time:
-            time,zone = time.split('-',1)
-            zoneparts = zone.split(':')
-            zoneparts.reverse()
-            tz = datetime.timedelta(0,0,0,0,*map(int,zoneparts))
-        return datetime.datetime(*map(int, re.split('[^\d]', time))) + tz
+        seconds = timeKey(time)
+        if seconds is None:
+            raise ValueError("'%s' is not an ISO 8601 time" % str(time))
+        return datetime.datetime(1970,1,1) + datetime.timedelta(0, seconds)
 
     def compareTimes(self, time1, time2):
-        try:
-            dttime1 = self.convertIsoToDateTime(time1)
-            dttime2 = self.convertIsoToDateTime(time2)
-            #Preserve tenths of a second for int comparisons
-            return (dttime1 - dttime2).total_seconds()*10.0
-        except (TypeError,AttributeError,ValueError):
-            if time1 is None:
-                if time2 is None:
-                    return 0
-                return -1
-            if time2 is None:
-                return 1
+        if PROFILER.enabled:
+            PROFILER.count('compareTimes')
+        seconds1 = timeKey(time1)
+        seconds2 = timeKey(time2)
+        if seconds1 is None or seconds2 is None:
+            return cmp(seconds1 is not None, seconds2 is not None)
+        #Preserve tenths of a second for int comparisons
+        return (seconds1 - seconds2)*10.0
 
     def olderKey(self, version, time):
         return "%s__%s" % (version, time)
 
     def subsumeTag(self, version, date, tag):
+        self.subsumeTags({tag : (version, date)})
+
+    def subsumeTags(self, tagAges):
+        #tagAges maps each tag to subsume to its (version, date)
+        #  Every tagged entry is visited once, no matter how many tags
+        self.timelines = None
+        fingerprints = self.fingerprints
         for key, value in self.iteritems():
             for subkey, subvalue in value.iteritems():
-                if tag not in subvalue:
+                if type(subvalue) is not dict:
                     continue
-                olderStash = {}
-                if '__older' in subvalue[tag]:
-                    olderStash = subvalue[tag].pop('__older')
-                verskey = self.olderKey(version,date)
-                olderStash[verskey] = dict(subvalue[tag])
-                subvalue[tag].clear()
-                subvalue[tag]['__older'] = olderStash
+                for tag in subvalue.keys():
+                    if tag not in tagAges:
+                        continue
+                    version, date = tagAges[tag]
+                    olderStash = {}
+                    if '__older' in subvalue[tag]:
+                        olderStash = subvalue[tag].pop('__older')
+                    verskey = self.olderKey(version,date)
+                    olderStash[verskey] = dict(subvalue[tag])
+                    subvalue[tag].clear()
+                    subvalue[tag]['__older'] = olderStash
+                    #The tag's fingerprint moves with its entries
+                    path = (key, subkey, tag)
+                    olderpath = path + ('__older', verskey)
+                    if path in fingerprints:
+                        fingerprints[olderpath] = fingerprints[path]
+                    else:
+                        fingerprints.pop(olderpath, None)
+                    fingerprints[path] = self.EMPTY_FINGERPRINT
+
+    def getProductTagNames(self):
+        result = set()
+        product = self.get('product')
+        if type(product) is not dict:
+            return result
+        for place in ['metadata', 'build', 'capture']:
+            try:
+                result.update(product[place].keys())
+            except (KeyError, AttributeError):
+                pass
+        return result
 
     def captureAllTagAges(self):
         tags = self.getProductTags()
@@ -265,50 +684,40 @@ class Manifest(dict):
             date = None
         return (version, date)
 
+    def getTagTimelines(self):
+        #Built on first use after the manifest is loaded and collated
+        if self.timelines is None:
+            self.timelines = {}
+            for tag, olders in self.getProductTags().iteritems():
+                self.timelines[tag] = TagTimeline(
+                    [ self._splitOlderKey(old) + (old,) for old in olders['__older-keys'] ] )
+        return self.timelines
+
     def captureAllOldestTagAges(self, specificVersion=None, specificDate=None):
         ages = self.captureAllTagAges()
+        timelines = self.getTagTimelines()
         for k in ages.keys():
-            oldestVersion = ages[k][0]
-            oldestDate = ages[k][1]
-            oldestKeypath = ages[k][2]
-            olders = ages[k][3]['__older-keys']
-            for old in olders:
-                version, date = self._splitOlderKey(old)
-                if specificVersion is not None and \
-                    self.compareVersions(version, specificVersion) != 0:
-                        continue
-                if specificDate is not None and \
-                    self.compareTimes(date, specificDate) < 0:
-                        continue
-                ans = self.compareVersions(oldestVersion, version)
-                if ans == 0:
-                    ans = self.compareTimes(oldestDate, date)
-                if ans > 0:
-                    oldestVersion = version
-                    oldestDate = date
+            oldestVersion, oldestDate, oldestKeypath, _ = ages[k]
+            if k in timelines:
+                entry = timelines[k].oldest(specificVersion, specificDate)
+                if entry is not None and \
+                  entry[0] < TagTimeline.orderKey(oldestVersion, oldestDate):
+                    _, oldestVersion, oldestDate, old = entry
                     oldestKeypath = (k, '__older', old)
             ages[k] = (oldestVersion, oldestDate, oldestKeypath)
         return ages
 
     def captureAllLatestOldTagAges(self):
         ages = self.captureAllTagAges()
+        timelines = self.getTagTimelines()
         for k in ages.keys():
-            olders = ages[k][3]['__older-keys']
-            if len(olders) < 1:
+            if k not in timelines:
+                continue
+            entry = timelines[k].latest()
+            if entry is None:
                 continue
-            old = olders[0]
-            newestOldVersion, newestOldDate = self._splitOlderKey(old)
-            newestOldKeypath = (k, '__older', old)
-            for old in olders:
-                version, date = self._splitOlderKey(old)
-                ans = self.compareVersions(newestOldVersion, version)
-                if ans == 0:
-                    ans = self.compareTimes(newestOldDate, date)
-                if ans < 0:
-                    newestOldVersion = version
-                    newestOldDate = date
-                    newestOldKeypath = (k, '__older', old)
-            ages[k] = (newestOldVersion, newestOldDate, newestOldKeypath)
+            _, newestOldVersion, newestOldDate, old = entry
+            ages[k] = (newestOldVersion, newestOldDate, (k, '__older', old))
         return ages
 
     def subsumeManifests(self, manifests):
@@ -321,50 +730,103 @@ class Manifest(dict):
         #  into an "__older" dictionary tagged by <version-full>__<time>
         #  If a manifest is not versioned for a given tag, it's just treated
         #  as a partial manifest and ignored here.
-        allTags = {}
-        for manifest in manifests:
-            allTags.update(manifest.captureAllTagAges())
+        #The stashes below allocate a lot of containers without creating
+        #  any cycles, don't let the cyclic collector rescan every
+        #  manifest over and over while they are built
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            with PROFILER.phase('subsumeManifests', manifests=len(manifests)):
+                self._subsumeManifests(manifests)
+        finally:
+            if gcEnabled:
+                gc.enable()
 
-        for tag in allTags.keys():
-            #Collect the versions across the manifests for the tag
-            taggedManifests = []
-            for manifest in manifests:
+    def _subsumeManifests(self, manifests):
+        #Index the (version, time, manifest) of every tag in one pass
+        taggedManifests = {}
+        for manifest in manifests:
+            for tag in manifest.getProductTagNames():
                 version = manifest.getVersionFullForTag(tag)
                 time = manifest.getTimeForTag(tag)
                 if version is None and time is None:
                     continue
-                taggedManifests.append((version, time, manifest))
-            latestVersion = version
-            latestTime = time
-            latestManifest = manifest
-            for version, time, manifest in taggedManifests:
+                if tag not in taggedManifests:
+                    taggedManifests[tag] = []
+                taggedManifests[tag].append((version, time, manifest))
+
+        #Find the latest for each tag, ties go to the later manifest,
+        #  and collect everything each older manifest has to subsume
+        subsumes = {}
+        for tag, tagged in taggedManifests.iteritems():
+            if len(tagged) < 2:
+                continue
+            latest = 0
+            for index in range(1, len(tagged)):
+                version, time, manifest = tagged[index]
+                latestVersion, latestTime, _ = tagged[latest]
                 result = manifest.compareVersions(version, latestVersion)
-                if result > 0:
-                    latestVersion = version
-                    latestTime = time
-                    latestManifest = manifest
-                elif result == 0:
-                    if manifest.compareTimes(time, latestTime) > 0:
-                        latestVersion = version
-                        latestTime = time
-                        latestManifest = manifest
-            taggedManifests.remove((latestVersion, latestTime, latestManifest))
-            for version, time, manifest in taggedManifests:
-                manifest.subsumeTag(version, time, tag)
+                if result > 0 or result == 0 \
+                  and manifest.compareTimes(time, latestTime) >= 0:
+                    latest = index
+            for index, (version, time, manifest) in enumerate(tagged):
+                if index == latest:
+                    continue
+                if id(manifest) not in subsumes:
+                    subsumes[id(manifest)] = (manifest, {})
+                subsumes[id(manifest)][1][tag] = (version, time)
+
+        for manifest, tagAges in subsumes.itervalues():
+            manifest.subsumeTags(tagAges)
+
+    def _loadManifests(self, filepaths):
+        if self.workers <= 1 or len(filepaths) <= 1:
+            return [
+                Manifest(
+                    [filepath],
+                    log=self.log,
+                    cache=self.cache,
+                    sections=self.sections )
+                for filepath in filepaths ]
+        workers = min(self.workers, len(filepaths))
+        self.log.debug("Loading %d manifests with %d workers", len(filepaths), workers)
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            #map preserves the order of filepaths so the subsume/merge
+            #  that follows sees exactly what the serial load would give
+            loaded = pool.map(
+                _loadManifestData,
+                [ (filepath, self.cache, self.sections, PROFILER.enabled) for filepath in filepaths ] )
+        finally:
+            pool.terminate()
+            pool.join()
+        result = []
+        for data, fingerprints, records in loaded:
+            if records is not None:
+                PROFILER.mergeRecords(records)
+            manifest = Manifest([], log=self.log)
+            manifest.update(data)
+            manifest.fingerprints = fingerprints
+            result.append(manifest)
+        return result
 
     def joinManifests(self, filepaths):
+        self.timelines = None
+        self.fingerprints = {}
         if len(filepaths) == 1 and len(self.preprocessed) == 0:
             #Don't do work if there's only one manifest
             self.loadManifest(filepaths[0])
             return
         loadedManifests = list(self.preprocessed)
-        for filepath in filepaths:
-            loadedManifests.append(Manifest([filepath], log=self.log))
+        loadedManifests.extend(self._loadManifests(filepaths))
         if len(loadedManifests) == 1:
             #Don't do work if there's only one manifest
             self.update(loadedManifests[0])
+            self.fingerprints = loadedManifests[0].fingerprints
             return
         self.subsumeManifests(loadedManifests)
+        fingerprints = self.fingerprints
         for manifest in loadedManifests:
             for key, value in manifest.iteritems():
                 if key not in self:
@@ -376,11 +838,41 @@ class Manifest(dict):
                         if tagkey not in self[key][subkey]:
                             self[key][subkey][tagkey] = {}
                         fullManifestTag = self[key][subkey][tagkey]
+                        self._mergeFingerprints(
+                            (key, subkey, tagkey),
+                            fullManifestTag,
+                            tagvalue,
+                            manifest.fingerprints )
                         if '__older' in fullManifestTag \
                           and '__older' in tagvalue:
                             tagvalue['__older'].update(fullManifestTag['__older'])
                         fullManifestTag.update(tagvalue)
 
+    def _mergeFingerprints(self, path, fullManifestTag, tagvalue, known):
+        #Keeps the fingerprints of path that stay valid when tagvalue, with
+        #  the fingerprints known for its manifest, is merged into
+        #  fullManifestTag.  Entries of both are only combined when both
+        #  have some, older stash entries already merged win.
+        fingerprints = self.fingerprints
+        if _hasContent(tagvalue):
+            if not _hasContent(fullManifestTag) and path in known:
+                fingerprints[path] = known[path]
+            else:
+                fingerprints.pop(path, None)
+        elif not _hasContent(fullManifestTag):
+            fingerprints[path] = self.EMPTY_FINGERPRINT
+        if type(tagvalue) is not dict or type(tagvalue.get('__older')) is not dict:
+            return
+        merged = fullManifestTag.get('__older', {})
+        for old in tagvalue['__older']:
+            if old in merged:
+                continue
+            olderpath = path + ('__older', old)
+            if olderpath in known:
+                fingerprints[olderpath] = known[olderpath]
+            else:
+                fingerprints.pop(olderpath, None)
+
     def _translateOldToNewProduct(self):
         if 'sources' in self:
             newpackage = {}
@@ -429,12 +921,160 @@ class Manifest(dict):
                     break
             if isOld:
                 self['sources'] = newpackage
+            return isOld
+        return False
 
-    def loadManifest(self, filepath):
+    def _splitSections(self, text, keyRe=None):
+        #Splits a block style yaml mapping into the text of each of its
+        #  top level entries without parsing any of them, their keys
+        #  matching keyRe, SECTION_KEY_RE by default.
+        #  Returns None when the document isn't laid out that way.
+        if keyRe is None:
+            keyRe = self.SECTION_KEY_RE
+        starts = [ m.start() for m in self.TOP_LEVEL_LINE_RE.finditer(text) ]
+        if len(starts) > 0 and text.startswith('---', starts[0]) \
+          and len(text[starts[0]:].split('\n',1)[0].strip()) == 3:
+            starts = starts[1:]
+        starts.append(len(text))
+        #Sequence entries ahead of the first key make the document a list
+        if self.SEQUENCE_ENTRY_RE.search(text, 0, starts[0]) is not None:
+            return None
+        result = {}
+        for start, end in zip(starts[:-1], starts[1:]):
+            match = keyRe.match(text, start)
+            if match is None:
+                return None
+            key = match.group(1)
+            if key in result:
+                return None
+            result[key] = text[start:end]
+        return result
+
+    def _splitEntries(self, chunk):
+        #Splits the text of a section from _splitSections into the text
+        #  of each of its entries, each a yaml document of its own, the
+        #  way _splitSections splits a document.
+        #  Returns None when the section isn't laid out that way.
+        header, _, body = chunk.partition('\n')
+        match = self.SECTION_KEY_RE.match(header)
+        if match is None or header.rstrip() != match.group(1) + ':':
+            return None
+        lines = body.split('\n')
+        indent = None
+        for line in lines:
+            stripped = line.lstrip(' ')
+            if len(stripped) > 0 and not stripped.startswith('#'):
+                indent = len(line) - len(stripped)
+                break
+        if indent is None:
+            return {}
+        if indent == 0:
+            return None
+        dedented = []
+        for line in lines:
+            if line.startswith(' ' * indent):
+                dedented.append(line[indent:])
+            elif len(line.strip()) == 0 or line.lstrip().startswith('#'):
+                dedented.append('')
+            else:
+                return None
+        return self._splitSections('\n'.join(dedented), self.ENTRY_KEY_RE)
+
+    def _parseManifestSections(self, filepath, f):
+        _importYaml(self.log)
+        text = f.read()
+        chunks = self._splitSections(text)
+        if chunks is not None:
+            try:
+                y = yaml.load(
+                    ''.join([ chunks[s] for s in self.sections if s in chunks ]),
+                    Loader=YamlLoader )
+                return y if y is not None else {}
+            except yaml.YAMLError as e:
+                #E.g., an alias to an anchor in a section that was skipped
+                self.log.debug("Loading sections of '%s' failed: %s", filepath, str(e))
+        self.log.debug("Loading all of '%s' to get sections: %s", filepath, ', '.join(self.sections))
+        y = yaml.load(text, Loader=YamlLoader)
+        if type(y) is dict:
+            y = { k:v for k, v in y.iteritems() if k in self.sections }
+        return y
+
+    def _parseManifestFile(self, filepath):
+        _importYaml(self.log)
         with open(filepath) as f:
-            y = yaml.load(f)
+            if self.sections is not None:
+                y = self._parseManifestSections(filepath, f)
+            else:
+                y = yaml.load(f, Loader=YamlLoader)
+        if PROFILER.enabled:
+            _countRecords(y)
+        return y
+
+    def readSections(self, filepath):
+        #Returns the text of each top level section of a manifest file
+        #  without parsing it, or None if the file can't be split into
+        #  sections
+        with open(filepath) as f:
+            return self._splitSections(f.read())
+
+    def loadSection(self, filepath, chunks, section):
+        #Returns a manifest of one section out of the chunks readSections
+        #  returned for filepath, so the file isn't read again
+        manifest = Manifest([], log=self.log, sections=[section])
+        with PROFILER.phase('loadManifest', file=filepath, sections=[section]):
+            _importYaml(self.log)
+            try:
+                y = yaml.load(chunks.get(section, ''), Loader=YamlLoader)
+                if PROFILER.enabled:
+                    _countRecords(y)
+            except yaml.YAMLError as e:
+                #E.g., an alias to an anchor in another section
+                self.log.debug("Loading section %s of '%s' failed: %s", section, filepath, str(e))
+                y = manifest._parseManifestFile(filepath)
+            manifest.update(y if y is not None else {})
+            manifest._translateOldToNewProduct()
+        return manifest
+
+    def loadEntry(self, filepath, chunks, section, text):
+        #Returns a manifest of one entry of a section, from the text
+        #  _splitEntries gave for it, or of the entry's part of the whole
+        #  section when the text doesn't load on its own
+        manifest = Manifest([], log=self.log, sections=[section])
+        _importYaml(self.log)
+        y = None
+        try:
+            y = yaml.load(text, Loader=YamlLoader)
+        except yaml.YAMLError as e:
+            self.log.debug("Loading an entry of section %s of '%s' failed: %s", section, filepath, str(e))
+        if type(y) is not dict or len(y) != 1:
+            name = self.ENTRY_KEY_RE.match(text).group(1)
+            whole = self.loadSection(filepath, chunks, section).get(section)
+            y = {}
+            if type(whole) is dict and name in whole:
+                y[name] = whole[name]
+        elif PROFILER.enabled:
+            _countRecords({section : y})
+        manifest[section] = y
+        manifest._translateOldToNewProduct()
+        return manifest
+
+    def loadManifest(self, filepath):
+        with PROFILER.phase('loadManifest', file=filepath):
+            fingerprints = None
+            if self.cache is None:
+                y = self._parseManifestFile(filepath)
+            else:
+                #The fingerprints are only worth computing when they are
+                #  kept for the next run
+                y, fingerprints = self.cache.loadDigested(
+                    filepath,
+                    self._parseManifestFile,
+                    _tagFingerprints,
+                    ','.join(self.sections) if self.sections is not None else '' )
             self.update(y)
-            self._translateOldToNewProduct()
+            if self._translateOldToNewProduct() or fingerprints is None:
+                fingerprints = {}
+            self.fingerprints = fingerprints
 
     def compareTagDict(self, dict1, dict2):
         if type(dict1) is not type(dict2):
@@ -455,6 +1095,16 @@ class Manifest(dict):
                 return False
         return True
 
+    EMPTY_FINGERPRINT = _fingerprint({}).encode('hex')
+
+    def getFingerprints(self):
+        #Returns a content fingerprint (hex digest) for every tag of every
+        #  section part keyed by (section, part, tag), and for every entry
+        #  in the tag's __older stash keyed by
+        #  (section, part, tag, '__older', older key).
+        #  Those not already known are computed on first use.
+        return _tagFingerprints(self, self.fingerprints)
+
     def _fillDictToTag(self, key, part, tag, dictionary):
         if key not in dictionary:
             dictionary[key] = {}
@@ -471,6 +1121,10 @@ class Manifest(dict):
         else:
             oldests = self.captureAllOldestTagAges(specificVersion, specificDate)
         self.log.debug("oldests answer: %s", oldests)
+        #Only the fingerprints already known are used, hashing the
+        #  subtrees here costs more than comparing them
+        fingerprints = self.fingerprints
+        emptyprint = self.EMPTY_FINGERPRINT
         for key, section in self.iteritems():
             for part, tags in section.iteritems():
                 for tag, data in tags.iteritems():
@@ -481,8 +1135,14 @@ class Manifest(dict):
                             oldest = self[pathtuple]
                         except:
                             pass
+                        oldprint = fingerprints.get(pathtuple)
                         if data is oldest:
                             oldest = {}
+                            oldprint = emptyprint
+                        if oldprint is not None and \
+                          oldprint == fingerprints.get((key,part,tag)):
+                            #Unchanged, no need to walk it
+                            continue
                         if not self.compareTagDict(data, oldest):
                             self._fillDictToTag(key,part,tag,result['diff'])
                             tagdiff = result['diff'][key][part][tag]
@@ -493,6 +1153,99 @@ class Manifest(dict):
                             processor.doHandler((key,part,tag),tagdiff)
         return result
 
+    def iterDiffAgainst(self, old, processor):
+        #Diffs this manifest against an older one without collating them:
+        #  the sections, parts and tags of both are walked in sorted order
+        #  and a record is yielded for each tag that was added, removed
+        #  or changed, see _diffSection.  __older history is ignored.
+        for key, newsection, oldsection in _mergeSorted(self, old):
+            for record in _diffSection(key, newsection, oldsection, processor):
+                yield record
+
+    def diffAgainst(self, old, processor, result=None):
+        #The records of iterDiffAgainst gathered in result
+        if result is None:
+            result = {'diff' : {}}
+        for (key, part, tag), tagdiff in self.iterDiffAgainst(old, processor):
+            self._fillDictToTag(key, part, tag, result['diff'])
+            result['diff'][key][part][tag] = tagdiff
+        return result
+
+class TagTimeline(object):
+    """Purpose: Index of the __older entries of one product tag
+       Entries are (order key, version, time, older key) tuples, ordered
+       by version then time.  They are also bucketed by version and
+       ordered by time so the oldest entry for a version or at or after
+       a time is a dictionary probe or a binary search.
+    """
+
+    @staticmethod
+    def orderKey(version, time):
+        seconds = timeKey(time)
+        if seconds is None:
+            #Matches compareTimes, where no time is older than any time
+            seconds = float('-inf')
+        return (versionKey(version), seconds)
+
+    def __init__(self, olders):
+        #olders is a list of (version, time, older key)
+        self.entries = [
+            (self.orderKey(version, time), version, time, old)
+            for version, time, old in olders ]
+        #Stable sorts keep the first of equal entries first
+        self.entries.sort(key=lambda entry: entry[0])
+        self.byTime = sorted(self.entries, key=lambda entry: entry[0][1])
+        self.times = [ entry[0][1] for entry in self.byTime ]
+
+        #The oldest entry from each position of byTime to the end
+        self.oldestFrom = [None] * len(self.byTime)
+        oldest = None
+        for index in range(len(self.byTime)-1, -1, -1):
+            entry = self.byTime[index]
+            if oldest is None or entry[0] <= oldest[0]:
+                oldest = entry
+            self.oldestFrom[index] = oldest
+
+        self.byVersion = {}
+        for entry in self.byTime:
+            versionkey = entry[0][0]
+            if versionkey not in self.byVersion:
+                self.byVersion[versionkey] = ([], [])
+            self.byVersion[versionkey][0].append(entry)
+            self.byVersion[versionkey][1].append(entry[0][1])
+
+    def oldest(self, version=None, time=None):
+        #Returns the oldest entry matching version, if given, with a
+        #  time at or after time, if given, or None
+        seconds = None
+        if time is not None:
+            seconds = timeKey(time)
+        if version is not None:
+            entries, times = self.byVersion.get(versionKey(version), ([], []))
+            index = 0
+            if seconds is not None:
+                index = bisect.bisect_left(times, seconds)
+            if index < len(entries):
+                return entries[index]
+            return None
+        if seconds is None:
+            return self.entries[0] if len(self.entries) > 0 else None
+        index = bisect.bisect_left(self.times, seconds)
+        if index < len(self.oldestFrom):
+            return self.oldestFrom[index]
+        return None
+
+    def latest(self):
+        if len(self.entries) == 0:
+            return None
+        #The first of the newest, as equal entries keep their order
+        newest = self.entries[-1][0]
+        for entry in reversed(self.entries):
+            if entry[0] != newest:
+                break
+            latest = entry
+        return latest
+
 class DiffProcessor(object):
     def __init__(self):
         self.lookups = {}
@@ -520,12 +1273,46 @@ class DiffProcessor(object):
         return False
 
 class CsversionCli(CliDriver.CliDriver):
+    def _getOptions(self):
+        #The options decide whether the profiler is on, so their own
+        #  phase is recorded once they are read
+        begun = PROFILER.begin()
+        CliDriver.CliDriver._getOptions(self)
+        if self.settings['profile-report'] is not None \
+          or self.settings['profile-trace'] is not None:
+            PROFILER.enable()
+            PROFILER.end('options', begun)
+
+    def _mainEnd(self):
+        #Written however the run ended, as long as the settings were read
+        try:
+            reportpath = self.settings['profile-report']
+            tracepath = self.settings['profile-trace']
+        except Exception:
+            return
+        if reportpath is not None:
+            PROFILER.writeReport(reportpath)
+        if tracepath is not None:
+            PROFILER.writeTrace(tracepath)
+
+    def showVersion(self):
+        CliDriver.CliDriver.showVersion(self)
+        #Which bindings yaml loads depends on how PyYAML was installed,
+        #  only importing it tells for sure
+        try:
+            _importYaml(self.log)
+            backend = YAML_BACKEND
+        except ImportError:
+            backend = 'yaml is not installed'
+        stderr.write("yaml backend: %s\n" % backend)
+
     def _prepSettings(self):
         origManifests = self.settings['manifests']
         self.settings['manifests'] = [ x.strip() for x in self.settings['manifests'].split(',') ]
         manifestFiles=[]
         for manifest in self.settings['manifests']:
             if os.path.isdir(manifest):
+                import glob
                 manifestFiles.extend(glob.glob(os.path.join(manifest,"*.csversion")))
             else:
                 manifestFiles.append(manifest)
@@ -537,6 +1324,71 @@ class CsversionCli(CliDriver.CliDriver):
 
         self.settings['csversionfile'] = [ x.strip() for x in self.settings['csversionfile'].split(',') ]
 
+        if self.settings['diff-files'] is not None:
+            self.settings['diff-files'] = [ x.strip() for x in self.settings['diff-files'].split(',') ]
+            if len(self.settings['diff-files']) != 2:
+                self.log.error("--diff-files takes exactly two manifests, got: %s", ', '.join(self.settings['diff-files']))
+                raise ValueError("--diff-files requires <old manifest>,<new manifest>")
+
+        try:
+            workers = int(self.settings['manifest-workers'])
+        except ValueError:
+            self.log.error("--manifest-workers must be a number, got: %s", self.settings['manifest-workers'])
+            raise
+        if workers <= 0:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.settings['manifest-workers'] = workers
+
+        if self.settings['capture-timeout'] is not None:
+            self.settings['capture-timeout'] = float(self.settings['capture-timeout'])
+
+        if self.settings['section-modules'] is not None:
+            for entry in self.settings['section-modules'].split(','):
+                entry = entry.strip()
+                if len(entry) == 0:
+                    continue
+                if '=' in entry:
+                    name, modulePath = [ x.strip() for x in entry.split('=', 1) ]
+                else:
+                    name, modulePath = entry.split('.')[-1], entry
+                CsversionModules.register(name, modulePath)
+
+        if self.settings['capture-targets'] is not None:
+            targets = []
+            for target in self.settings['capture-targets'].split(','):
+                target = target.strip()
+                if len(target) == 0:
+                    continue
+                if target.startswith('chroot:') or target.startswith('docker:'):
+                    targets.append(tuple(target.split(':', 1)))
+                elif target.startswith('/'):
+                    targets.append(('chroot', target))
+                else:
+                    targets.append(('docker', target))
+            self.settings['capture-targets'] = targets
+
+        for key in ['cache-max-size', 'cache-max-age', 'capture-workers', 'capture-target-workers']:
+            try:
+                self.settings[key] = int(self.settings[key])
+            except ValueError:
+                self.log.error("--%s must be a number, got: %s", key, self.settings[key])
+                raise
+
+    def _setupManifestCache(self):
+        self.cache = None
+        if self.settings['no-cache']:
+            return
+        cachedir = os.path.expanduser(self.settings['cache-dir'])
+        try:
+            self.cache = ManifestCache.ManifestCache(
+                cachedir,
+                self.log,
+                self.settings['cache-max-size'],
+                self.settings['cache-max-age'] )
+        except (IOError, OSError) as e:
+            self.log.info("Manifest cache '%s' is not usable, continuing without it: %s", cachedir, str(e))
+
     def _setupProcessedOutput(self):
         self.outputs = []
 
@@ -553,7 +1405,19 @@ class CsversionCli(CliDriver.CliDriver):
 
     def output(self, dictionary):
         for o in self.outputs:
-            o.output(dictionary)
+            with PROFILER.phase('output', backend=type(o).__name__):
+                o.output(dictionary)
+
+    def outputRecords(self, name, records):
+        #Outputs {name : {...}} from records of (key path, value) in
+        #  sorted key path order, each handed on as it comes
+        for o in self.outputs:
+            o.begin(name)
+        for path, value in records:
+            for o in self.outputs:
+                o.record(path, value)
+        for o in self.outputs:
+            o.end()
 
     def listVersions(self, manifest):
         output = {'version':{}}
@@ -572,6 +1436,113 @@ class CsversionCli(CliDriver.CliDriver):
                     'version' : version })
         self.output(output)
 
+    def listFingerprints(self, manifest):
+        output = {'fingerprints':{}}
+        for path, fingerprint in manifest.getFingerprints().iteritems():
+            if len(path) != 3:
+                continue
+            key, part, tag = path
+            manifest._fillDictToTag(key, part, tag, output['fingerprints'])
+            output['fingerprints'][key][part][tag] = fingerprint
+        self.output(output)
+
+    def diffFiles(self, oldpath, newpath):
+        #Yields the records of the tags added, removed or changed from
+        #  oldpath to newpath as they are found, see _diffSection.  Each
+        #  file is read and split once.  The entries of a section, e.g.,
+        #  the packages of sources, are then loaded from both files one
+        #  at a time as they are diffed, whole sections when they can't
+        #  be split into entries.
+        loader = Manifest([], log=self.log)
+        oldChunks = loader.readSections(oldpath)
+        newChunks = loader.readSections(newpath)
+        if oldChunks is None or newChunks is None:
+            old = Manifest([oldpath], log=self.log, cache=self.cache)
+            new = Manifest([newpath], log=self.log, cache=self.cache)
+            for record in new.iterDiffAgainst(old, self.diffprocessor):
+                yield record
+            return
+        for section, newChunk, oldChunk in _mergeSorted(newChunks, oldChunks):
+            oldEntries = {} if oldChunk is _MISSING else loader._splitEntries(oldChunk)
+            newEntries = {} if newChunk is _MISSING else loader._splitEntries(newChunk)
+            if oldEntries is None or newEntries is None:
+                old = loader.loadSection(oldpath, oldChunks, section)
+                new = loader.loadSection(newpath, newChunks, section)
+                for record in new.iterDiffAgainst(old, self.diffprocessor):
+                    yield record
+                continue
+            for _, newEntry, oldEntry in _mergeSorted(newEntries, oldEntries):
+                old = {}
+                if oldEntry is not _MISSING:
+                    old = loader.loadEntry(oldpath, oldChunks, section, oldEntry).get(section)
+                new = {}
+                if newEntry is not _MISSING:
+                    new = loader.loadEntry(newpath, newChunks, section, newEntry).get(section)
+                for record in _diffSection(section, new, old, self.diffprocessor):
+                    yield record
+
+    def capture(self, manifest, target=None):
+        capturecache = None
+        if self.cache is not None:
+            capturecache = self.cache.captureDir()
+        elif self.settings['capture-incremental']:
+            self.log.info("--capture-incremental needs the cache, capturing everything")
+        import ConfigDriver
+        execer = ConfigDriver.ConfigDriver(
+            self.settings['csversionfile'],
+            self.log,
+            manifest,
+            self.settings['capture-workers'],
+            self.settings['capture-timeout'],
+            capturecache,
+            self.settings['capture-incremental'],
+            target )
+        execer.execute()
+
+    def _captureTarget(self, target):
+        #Returns None on success, or why the target's capture failed
+        targetType, targetName = target
+        manifest = {}
+        try:
+            with PROFILER.phase('capture', target=targetName):
+                self.capture(manifest, target)
+            output = YamlOutput()
+            output.setFileAsStream(os.path.join(self.settings['capture-output-dir'], _targetFilename(target)))
+            try:
+                output.output(manifest)
+            finally:
+                output.close()
+        except Exception as e:
+            self.log.exception("Capture of %s '%s' failed", targetType, targetName)
+            return str(e)
+        return None
+
+    def captureTargets(self, targets):
+        #Captures each target with the csversionfile as a template,
+        #  writing one manifest per target to the capture output directory
+        filenames = {}
+        for target in targets:
+            filename = _targetFilename(target)
+            if filename in filenames:
+                raise ValueError("Capture targets %s:%s and %s:%s would both be written to %s" % (
+                    filenames[filename] + target + (filename,)))
+            filenames[filename] = target
+        outputdir = self.settings['capture-output-dir']
+        if not os.path.isdir(outputdir):
+            os.makedirs(outputdir)
+        workers = max(1, min(self.settings['capture-target-workers'], len(targets)))
+        self.log.debug("Capturing %d targets with %d workers", len(targets), workers)
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            failures = pool.map(self._captureTarget, targets)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [ target for target, failure in zip(targets, failures) if failure is not None ]
+        if len(failed) != 0:
+            raise ValueError("Capture failed for: %s" % ', '.join([ name for _, name in failed ]))
+
     def _getDiffProcessor(self):
         return DiffProcessor()
 
@@ -579,24 +1550,53 @@ class CsversionCli(CliDriver.CliDriver):
         self.diffprocessor = self._getDiffProcessor()
         self._prepSettings()
         self._setupProcessedOutput()
+        self._setupManifestCache()
+        try:
+            self._dispatch()
+        finally:
+            if self.cache is not None:
+                self.cache.prune()
+
+    def _dispatch(self):
+        if self.settings['diff-files'] is not None:
+            with PROFILER.phase('diffFiles'):
+                self.outputRecords('diff', self.diffFiles(*self.settings['diff-files']))
+            return
+
+        if self.settings['capture-targets'] is not None:
+            self.captureTargets(self.settings['capture-targets'])
+            return
 
         preprocessed = []
         if self.settings['capture']:
-            configs = self.settings['csversionfile']
             newmanifest = {}
             preprocessed.append(newmanifest)
-            execer = ConfigDriver.ConfigDriver(
-                configs,
-                self.log,
-                newmanifest )
-            execer.execute()
-        self.manifest = Manifest(self.settings['manifests'], preprocessed, log=self.log)
+            with PROFILER.phase('capture'):
+                self.capture(newmanifest)
+        sections = None
+        if not self.settings['diff'] and not self.settings['verbose'] \
+          and not self.settings['fingerprints']:
+            #Listing versions only needs the product information
+            sections = ['product']
+        with PROFILER.phase('manifests'):
+            self.manifest = Manifest(
+                self.settings['manifests'],
+                preprocessed,
+                log=self.log,
+                workers=self.settings['manifest-workers'],
+                cache=self.cache,
+                sections=sections )
         if self.settings['diff']:
-            self.output(self.manifest.diffManifest(
-                self.diffprocessor,
-                self.settings['diff-version'],
-                self.settings['diff-date'],
-                self.settings['diff-latest']))
+            with PROFILER.phase('diffManifest'):
+                diff = self.manifest.diffManifest(
+                    self.diffprocessor,
+                    self.settings['diff-version'],
+                    self.settings['diff-date'],
+                    self.settings['diff-latest'])
+            self.output(diff)
+            return
+        if self.settings['fingerprints']:
+            self.listFingerprints(self.manifest)
             return
         if self.settings['verbose']:
             self.output(self.manifest)
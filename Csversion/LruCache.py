@@ -0,0 +1,50 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+
+class LruCache(object):
+    """Purpose: Bounded memo for a function of one hashable argument
+       Entries are kept in two generations of at most maxsize/2 each.
+       A hit in the older generation promotes the entry, and when the
+       current generation fills the older one is dropped, so the least
+       recently used entries are the ones discarded while a hit costs
+       no more than a dictionary lookup.
+    """
+
+    def __init__(self, function, maxsize=8192):
+        self.function = function
+        self.generationSize = max(1, maxsize // 2)
+        self.current = {}
+        self.previous = {}
+
+    def __call__(self, arg):
+        try:
+            return self.current[arg]
+        except KeyError:
+            pass
+        try:
+            value = self.previous[arg]
+        except KeyError:
+            value = self.function(arg)
+        if len(self.current) >= self.generationSize:
+            self.previous = self.current
+            self.current = {}
+        self.current[arg] = value
+        return value
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
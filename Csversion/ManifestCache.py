@@ -0,0 +1,191 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import cPickle
+import hashlib
+import logging
+import os
+import os.path
+import stat
+import time
+
+def prepareCacheDir(cachedir):
+    """Creates cachedir, only accessible by this user, when it's missing.
+       Raises OSError when cachedir isn't a directory owned by this user
+       that no one else can write to, as the entries in it are unpickled,
+       e.g., root running csversion with sudo and the user's HOME.
+    """
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, 0700)
+    st = os.stat(cachedir)
+    if st.st_uid != os.geteuid():
+        raise OSError("'%s' is owned by uid %d, not %d" % (cachedir, st.st_uid, os.geteuid()))
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise OSError("'%s' is writable by other users" % cachedir)
+
+class ManifestCache(object):
+    """Purpose: Keep parsed manifests on disk between csversion runs
+       Entries are keyed by the absolute path of the manifest and are
+       only used when the size, mtime and content hash of the manifest
+       still match what was recorded when the entry was written.
+       Entries not used within maxAge seconds are evicted, and the least
+       recently used entries are evicted to keep the cache under maxSize
+       bytes.  What csversionfile sections keep between captures, in the
+       CAPTURE_DIR subdirectory, is evicted the same way, each file
+       as an entry.
+    """
+
+    CACHE_FORMAT = 2
+    ENTRY_SUFFIX = '.manifest'
+    CAPTURE_DIR = 'capture'
+
+    def __init__(self, cachedir, log=logging, maxSize=64*1024*1024, maxAge=7*24*60*60):
+        self.cachedir = cachedir
+        self.log = log
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        prepareCacheDir(cachedir)
+
+    def __getstate__(self):
+        #Loggers don't travel to manifest loading worker processes
+        state = dict(self.__dict__)
+        del state['log']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = logging
+
+    def _entryPath(self, filepath, variant):
+        return os.path.join(
+            self.cachedir,
+            hashlib.sha1('%s\0%s' % (filepath, variant)).hexdigest() + self.ENTRY_SUFFIX )
+
+    def _digest(self, filepath):
+        digest = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _readEntry(self, entrypath):
+        try:
+            with open(entrypath, 'rb') as f:
+                return cPickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            self.log.debug("Discarding unreadable cache entry '%s': %s", entrypath, str(e))
+            self._remove(entrypath)
+            return None
+
+    def _writeEntry(self, entrypath, entry):
+        import tempfile
+        fd, temppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temppath, entrypath)
+        except Exception as e:
+            self.log.debug("Could not write cache entry '%s': %s", entrypath, str(e))
+            self._remove(temppath)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def load(self, filepath, parser, variant=''):
+        """Returns the parsed manifest for filepath from the cache.
+           On a miss parser(filepath) is called and its result is stored.
+           variant distinguishes different parses of the same file, e.g.,
+           when only some sections of the manifest are loaded.
+        """
+        return self.loadDigested(filepath, parser, None, variant)[0]
+
+    def loadDigested(self, filepath, parser, digester, variant=''):
+        """Returns (parsed manifest, digests) for filepath from the cache.
+           On a miss digester(manifest) is called after parsing, when
+           given, and what it returns is stored with the manifest, so it
+           is only computed again when the file changes.
+        """
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        fingerprint = (filepath, variant, stat.st_size, stat.st_mtime, self._digest(filepath))
+        entrypath = self._entryPath(filepath, variant)
+        entry = self._readEntry(entrypath)
+        if entry is not None \
+          and entry.get('format') == self.CACHE_FORMAT \
+          and entry.get('fingerprint') == fingerprint \
+          and (digester is None or entry.get('digests') is not None):
+            self.log.debug("Manifest cache hit: %s", filepath)
+            try:
+                os.utime(entrypath, None)
+            except OSError:
+                pass
+            return entry['manifest'], entry.get('digests')
+        self.log.debug("Manifest cache miss: %s", filepath)
+        manifest = parser(filepath)
+        digests = None
+        if digester is not None:
+            digests = digester(manifest)
+        self._writeEntry(entrypath, {
+            'format' : self.CACHE_FORMAT,
+            'fingerprint' : fingerprint,
+            'manifest' : manifest,
+            'digests' : digests })
+        return manifest, digests
+
+    def captureDir(self):
+        return os.path.join(self.cachedir, self.CAPTURE_DIR)
+
+    def _entries(self):
+        #Yields (path, is an entry) for the files of the cache
+        for name in os.listdir(self.cachedir):
+            yield os.path.join(self.cachedir, name), name.endswith(self.ENTRY_SUFFIX)
+        for dirpath, _, names in os.walk(self.captureDir()):
+            for name in names:
+                yield os.path.join(dirpath, name), not name.endswith('.tmp')
+
+    def prune(self):
+        """Evicts entries by age, then the least recently used entries
+           until the cache fits in maxSize"""
+        entries = []
+        now = time.time()
+        for path, isEntry in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not isEntry:
+                #Left over from an interrupted write
+                if path.endswith('.tmp') and now - stat.st_mtime > 60*60:
+                    self._remove(path)
+                continue
+            if now - stat.st_mtime > self.maxAge:
+                self.log.debug("Evicting expired cache entry: %s", path)
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum([ size for _, size, _ in entries ])
+        for _, size, path in entries:
+            if total <= self.maxSize:
+                break
+            self.log.debug("Evicting cache entry to reduce cache size: %s", path)
+            self._remove(path)
+            total -= size
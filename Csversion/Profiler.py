@@ -0,0 +1,168 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import contextlib
+import os
+import threading
+import time
+
+class _NoPhase(object):
+    #What phase returns while the profiler is off
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_PHASE = _NoPhase()
+
+class Profiler(object):
+    """Purpose: Record the wall and CPU time of named phases of a run
+       and count events, for a JSON report and a Chrome trace-event file
+       (load it in chrome://tracing or https://ui.perfetto.dev).
+       Phases and counters are only kept once enabled so the hot paths
+       that time or count cost nothing otherwise.
+       CPU time is that of the whole process, threads aren't separated.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.time()
+        self.phases = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def _cpu(self):
+        times = os.times()
+        return times[0] + times[1]
+
+    def begin(self):
+        """Returns where a phase starts, for end to record it"""
+        return (time.time(), self._cpu())
+
+    def end(self, name, begun, args={}):
+        start, cpu = begun
+        self.record(
+            name,
+            start - self.origin,
+            time.time() - start,
+            self._cpu() - cpu,
+            args )
+
+    def phase(self, name, **args):
+        if not self.enabled:
+            return _NO_PHASE
+        return self._phase(name, args)
+
+    @contextlib.contextmanager
+    def _phase(self, name, args):
+        begun = self.begin()
+        try:
+            yield
+        finally:
+            self.end(name, begun, args)
+
+    def record(self, name, start, wall, cpu, args={}, pid=None, tid=None):
+        if pid is None:
+            pid = os.getpid()
+        if tid is None:
+            tid = threading.current_thread().ident
+        with self.lock:
+            self.phases.append({
+                'name' : name,
+                'start' : start,
+                'wall' : wall,
+                'cpu' : cpu,
+                'pid' : pid,
+                'tid' : tid,
+                'args' : args })
+
+    def count(self, name, increment=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def takeRecords(self):
+        """Returns and forgets the phases and counters recorded so far,
+           e.g., to hand them from a worker process to the parent"""
+        with self.lock:
+            records = (self.origin, self.phases, self.counters)
+            self.phases = []
+            self.counters = {}
+        return records
+
+    def mergeRecords(self, records):
+        origin, phases, counters = records
+        with self.lock:
+            for phase in phases:
+                phase = dict(phase)
+                phase['start'] += origin - self.origin
+                self.phases.append(phase)
+            for name, value in counters.iteritems():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        summary = {}
+        for phase in self.phases:
+            if phase['name'] not in summary:
+                summary[phase['name']] = {'calls' : 0, 'wall' : 0.0, 'cpu' : 0.0}
+            summary[phase['name']]['calls'] += 1
+            summary[phase['name']]['wall'] += phase['wall']
+            summary[phase['name']]['cpu'] += phase['cpu']
+        return {
+            'wall' : time.time() - self.origin,
+            'summary' : summary,
+            'phases' : sorted(self.phases, key=lambda x: x['start']),
+            'counters' : self.counters }
+
+    def traceEvents(self):
+        events = []
+        for phase in self.phases:
+            events.append({
+                'name' : phase['name'],
+                'cat' : 'csversion',
+                'ph' : 'X',
+                'ts' : int(phase['start'] * 1000000),
+                'dur' : int(phase['wall'] * 1000000),
+                'pid' : phase['pid'],
+                'tid' : phase['tid'],
+                'args' : dict(phase['args'], cpu=phase['cpu']) })
+        now = int((time.time() - self.origin) * 1000000)
+        for name, value in self.counters.iteritems():
+            events.append({
+                'name' : name,
+                'cat' : 'csversion',
+                'ph' : 'C',
+                'ts' : now,
+                'pid' : os.getpid(),
+                'args' : {name : value} })
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+    def writeReport(self, path):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def writeTrace(self, path):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.traceEvents(), f)
+
+PROFILER = Profiler()
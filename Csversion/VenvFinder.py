@@ -0,0 +1,236 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import cPickle
+import fnmatch
+import hashlib
+import logging
+import os
+import os.path
+import re
+import stat
+import tempfile
+import threading
+import ManifestCache
+
+class VenvFinder(object):
+    """Purpose: Find the virtualenvs installed under a root directory
+       A virtualenv is a directory with a bin/activate_this.py.
+       Mounted pseudo, network and container overlay filesystems are not
+       walked, nor are paths matching the exclude globs, and with
+       oneDevice only the device of the root directory is walked.
+       The top level directories are walked in parallel.
+       When a cache directory is given, the subdirectories of every walked
+       directory are remembered with its mtime, and a directory whose mtime
+       is unchanged on the next run is not listed again.
+    """
+
+    CACHE_FORMAT = 1
+    CACHE_SUFFIX = '.venvs'
+    MARKER = 'activate_this.py'
+    MOUNTS = '/proc/mounts'
+    PRUNED_FSTYPES = set([
+        'proc', 'sysfs', 'devtmpfs', 'devpts', 'cgroup', 'cgroup2',
+        'securityfs', 'debugfs', 'tracefs', 'pstore', 'bpf', 'mqueue',
+        'hugetlbfs', 'configfs', 'fusectl', 'autofs', 'binfmt_misc',
+        'rpc_pipefs', 'nfsd', 'selinuxfs', 'efivarfs', 'nsfs',
+        'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'ncpfs', 'afs', '9p',
+        'fuse.sshfs', 'sshfs', 'davfs', 'glusterfs', 'ceph', 'lustre',
+        'overlay', 'aufs', 'shiftfs' ])
+    MOUNT_ESCAPE_RE = re.compile(r'\\([0-7]{3})')
+
+    def __init__(self, root='/', log=logging, excludes=[], oneDevice=False, workers=8, cachedir=None):
+        #excludes are globs matched against paths relative to root,
+        #   e.g., /home/*/.cache
+        self.root = os.path.abspath(root)
+        self.log = log
+        self.excludes = excludes
+        self.oneDevice = oneDevice
+        self.workers = max(1, workers)
+        if cachedir is not None:
+            try:
+                ManifestCache.prepareCacheDir(cachedir)
+            except (IOError, OSError) as e:
+                self.log.info("Venv cache '%s' is not usable, continuing without it: %s", cachedir, str(e))
+                cachedir = None
+        self.cachedir = cachedir
+        self.device = None
+        self.prunedMounts = set()
+
+    def _readPrunedMounts(self):
+        #Mount points under the root with a filesystem that is not walked.
+        #  The root itself is always walked, even in an overlay container.
+        pruned = set()
+        try:
+            with open(self.MOUNTS) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 3 or fields[2] not in self.PRUNED_FSTYPES:
+                        continue
+                    mountpoint = self.MOUNT_ESCAPE_RE.sub(
+                        lambda m: chr(int(m.group(1), 8)), fields[1] )
+                    if mountpoint != self.root:
+                        pruned.add(mountpoint)
+        except (IOError, OSError) as e:
+            self.log.debug("Could not read %s, no mounts are pruned: %s", self.MOUNTS, str(e))
+        return pruned
+
+    def _relative(self, path):
+        if self.root == '/':
+            return path
+        return '/' + os.path.relpath(path, self.root)
+
+    def _pruned(self, path, st):
+        if path in self.prunedMounts:
+            self.log.debug("Not searching mount: %s", path)
+            return True
+        if self.oneDevice and st.st_dev != self.device:
+            return True
+        relative = self._relative(path)
+        for exclude in self.excludes:
+            if fnmatch.fnmatch(relative, exclude):
+                self.log.debug("Not searching excluded: %s", relative)
+                return True
+        return False
+
+    def _listDirectory(self, path, st, previous, current):
+        #Returns the subdirectories of path and if it holds the marker
+        cached = previous.get(path)
+        if cached is not None and cached[0] == st.st_mtime:
+            current[path] = cached
+            return cached[1], cached[2]
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            self.log.debug("Could not list %s: %s", path, str(e))
+            return [], False
+        subdirs = []
+        marker = self.MARKER in names
+        #Every name is looked at, the link count of a directory only
+        #  counts its subdirectories on some filesystems, e.g., not on
+        #  btrfs or many FUSE and overlay filesystems
+        for name in names:
+            if name == self.MARKER:
+                continue
+            try:
+                if stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode):
+                    subdirs.append(name)
+            except OSError:
+                continue
+        current[path] = (st.st_mtime, subdirs, marker)
+        return subdirs, marker
+
+    def _walk(self, top, previous, current, venvs):
+        stack = [top]
+        while len(stack) > 0:
+            path = stack.pop()
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(st.st_mode) or self._pruned(path, st):
+                continue
+            subdirs, marker = self._listDirectory(path, st, previous, current)
+            if marker and os.path.basename(path) == 'bin':
+                venvs.append(self._relative(os.path.dirname(path)))
+            stack.extend([ os.path.join(path, name) for name in subdirs ])
+
+    def _walkThread(self, tops, lock, previous, current, venvs):
+        while True:
+            with lock:
+                if len(tops) == 0:
+                    return
+                top = tops.pop()
+            self._walk(top, previous, current, venvs)
+
+    def _cachePath(self):
+        return os.path.join(
+            self.cachedir,
+            hashlib.sha1(self.root).hexdigest() + self.CACHE_SUFFIX )
+
+    def _loadCache(self):
+        if self.cachedir is None:
+            return {}
+        try:
+            with open(self._cachePath(), 'rb') as f:
+                entry = cPickle.load(f)
+        except (IOError, OSError):
+            return {}
+        except Exception as e:
+            self.log.debug("Discarding unreadable venv cache: %s", str(e))
+            return {}
+        if entry.get('format') != self.CACHE_FORMAT:
+            return {}
+        return entry['directories']
+
+    def _saveCache(self, directories):
+        if self.cachedir is None:
+            return
+        temppath = None
+        try:
+            fd, temppath = tempfile.mkstemp(dir=self.cachedir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump({
+                    'format' : self.CACHE_FORMAT,
+                    'directories' : directories }, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temppath, self._cachePath())
+        except Exception as e:
+            self.log.debug("Could not write the venv cache: %s", str(e))
+            if temppath is not None and os.path.exists(temppath):
+                os.remove(temppath)
+
+    def cached(self):
+        """Returns the sorted virtualenv paths, relative to the root, that
+           the last find() cached, without walking anything, or None when
+           nothing is cached"""
+        directories = self._loadCache()
+        if len(directories) == 0:
+            return None
+        return sorted([ self._relative(os.path.dirname(path))
+            for path, (_, _, marker) in directories.iteritems()
+            if marker and os.path.basename(path) == 'bin' ])
+
+    def find(self):
+        """Returns the sorted virtualenv paths, relative to the root"""
+        self.prunedMounts = self._readPrunedMounts()
+        rootstat = os.lstat(self.root)
+        self.device = rootstat.st_dev
+        previous = self._loadCache()
+        current = {}
+        venvs = []
+        subdirs, _ = self._listDirectory(self.root, rootstat, previous, current)
+
+        #Each thread fills its own results, they are combined at the end
+        tops = [ os.path.join(self.root, name) for name in sorted(subdirs) ]
+        lock = threading.Lock()
+        results = []
+        threads = []
+        for _ in range(min(self.workers, len(tops))):
+            result = ({}, [])
+            results.append(result)
+            thread = threading.Thread(
+                target=self._walkThread,
+                args=(tops, lock, previous, result[0], result[1]) )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        for directories, found in results:
+            current.update(directories)
+            venvs.extend(found)
+        self._saveCache(current)
+        return sorted(venvs)
@@ -15,18 +15,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
-import subprocess
+import os.path
 import re
+from Csversion import CommandLines
+from Csversion.Profiler import PROFILER
 
 class CollectDpkgs:
     """Purpose: Record the version of all the dpkg installations on the
                 created image.
     Options: chroot - (OPTIONAL) Path to the chroot environment to query
              docker - (OPTIONAL) Name of container
+             docker-batch - (OPTIONAL) Query the container in the same
+                 docker exec as the other sections for it, default is True
+             backend - (OPTIONAL) How the packages are read:
+                 status - parse <chroot>/var/lib/dpkg/status directly
+                 dpkg-query - run dpkg-query (with sudo)
+                 auto - status when the file is readable and no docker
+                        container is given, otherwise dpkg-query (default)
         """
 
     PACKAGE_RE = re.compile(r'(?P<package>[^\s(:]*)(:[^\s(]*)?\s*\((?P<version>[^-+)]*)((-|\+)(?P<release>[^)]*))\)\s*\((?P<arch>[^)]*)\)')
     ESCAPE_RE = re.compile(r'( |"|\')')
+    #What csversion --capture-targets may point this section at
+    TARGET_TYPES = ['chroot', 'docker']
+    STATUS_FILE = 'var/lib/dpkg/status'
 
     def __init__(self, log):
         self.log = log
@@ -34,10 +46,128 @@ class CollectDpkgs:
     def defaultPrefix(self):
         return 'sources'
 
+    def _nativeArch(self, statuspath):
+        #dpkg is always installed for the native architecture, the one
+        #  dpkg-query doesn't add to the names of packages
+        package = None
+        with open(statuspath) as f:
+            for line in f:
+                if line.startswith('Package:'):
+                    package = line[8:].strip()
+                elif package == 'dpkg' and line.startswith('Architecture:'):
+                    return line[13:].strip()
+        return None
+
+    def _statusLines(self, statuspath):
+        #Streams the stanzas of a dpkg status file, yielding each package
+        #  that dpkg-query --show would list in the same format
+        #  dpkg-query is asked for by this module
+        native = self._nativeArch(statuspath)
+        fields = {}
+        with open(statuspath) as f:
+            for line in f:
+                if line[0] in ' \t':
+                    continue
+                line = line.rstrip('\n')
+                if len(line) == 0:
+                    if len(fields) > 0:
+                        result = self._statusLine(fields, native)
+                        if result is not None:
+                            yield result
+                    fields = {}
+                    continue
+                field, _, value = line.partition(':')
+                if field in ('Package', 'Status', 'Version', 'Architecture', 'Multi-Arch'):
+                    fields[field] = value.strip()
+        if len(fields) > 0:
+            result = self._statusLine(fields, native)
+            if result is not None:
+                yield result
+
+    def _statusLine(self, fields, native):
+        #Packages of another architecture than the native one are named
+        #  with theirs, as are those that can be installed for several
+        if 'Package' not in fields:
+            return None
+        if fields.get('Status', '').endswith(' not-installed'):
+            return None
+        package = fields['Package']
+        arch = fields.get('Architecture', '')
+        if fields.get('Multi-Arch') == 'same' and len(arch) > 0 \
+          or native is not None and arch not in (native, 'all', ''):
+            package = '%s:%s' % (package, arch)
+        return "%s (%s) (%s)" % (package, fields.get('Version', ''), arch)
+
+    def _addDpkg(self, versdict, tag, dpkg):
+        dpkg = dpkg.strip()
+        if len(dpkg) == 0:
+            return
+        match = self.PACKAGE_RE.match(dpkg)
+        if match is None:
+            self.log.debug("Didn't match: %s", dpkg)
+            return
+        package = match.group('package')
+        version = match.group('version')
+        release = match.group('release')
+        arch = match.group('arch')
+        if len(arch) > 0:
+            arch = arch.lstrip(':')
+        else:
+            arch = '__global'
+        if package not in versdict:
+            versdict[package] = {}
+        if tag not in versdict[package]:
+            versdict[package][tag] = {}
+        if 'dpkg' not in versdict[package][tag]:
+            versdict[package][tag]['dpkg'] = {}
+        if arch in versdict[package][tag]['dpkg']:
+            self.log.debug(
+                "Package: %s, Tag: %s, Type: dpkg, Arch: %s :: Overwriting %s",
+                package,
+                tag,
+                arch,
+                str(versdict[package][tag]['dpkg'][arch]))
+
+        PROFILER.count('dpkg records')
+        versdict[package][tag]['dpkg'][arch] = {
+             'PACKAGE' : package,
+             'VERSION' : version }
+        if arch != '__global':
+            versdict[package][tag]['dpkg'][arch]['ARCH'] = arch
+        if len(release) > 0:
+            versdict[package][tag]['dpkg'][arch]['RELEASE'] = release
+        self.log.debug(
+            "Package: %s, Tag: %s, Type: dpkg, Arch: %s :: Added %s",
+            package,
+            tag,
+            arch,
+            str(versdict[package][tag]['dpkg'][arch]) )
+
+    def csversionInputFingerprint(self, options, key, tag, prefix):
+        #The dpkg status file changes with every package change,
+        #  a container's can't be checked
+        if 'docker' in options:
+            return None
+        statuspath = os.path.join(options.get('chroot', '/'), self.STATUS_FILE)
+        st = os.stat(statuspath)
+        return (statuspath, st.st_size, st.st_mtime)
+
+    def csversionContainerQueries(self, options, key, tag, prefix):
+        #Run in the docker container by ConfigDriver with the queries
+        #  of the other sections, see '**container-output' below
+        return [('dpkg-query', "dpkg-query --show -f '${binary:Package} (${Version}) (${Architecture})\\n'")]
+
     def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
         versdict = manifest
+        if '**container-output' in options:
+            #Read as the batched docker exec streams it, ConfigDriver
+            #  captures the section alone if it didn't all arrive
+            for dpkg in options['**container-output']['dpkg-query']:
+                self._addDpkg(versdict, tag, dpkg)
+            return versdict
         docker = False
         sudo = True
+        backend = options.get('backend', 'auto').strip()
         if 'chroot' in options:
             mountpath = options['chroot']
             chroot = True
@@ -49,9 +179,27 @@ class CollectDpkgs:
             docker = True
             container = options['docker']
 
+        statuspath = os.path.join(mountpath, self.STATUS_FILE)
+        if backend == 'auto':
+            if not docker and os.access(statuspath, os.R_OK):
+                backend = 'status'
+            else:
+                backend = 'dpkg-query'
+        if backend == 'status':
+            if docker:
+                self.log.warning("The dpkg status backend can't read container '%s', using dpkg-query", container)
+            else:
+                self.log.debug("Reading: %s", statuspath)
+                for dpkg in self._statusLines(statuspath):
+                    self._addDpkg(versdict, tag, dpkg)
+                return versdict
+        elif backend != 'dpkg-query':
+            self.log.error("Unknown CollectDpkgs backend '%s'", backend)
+            raise ValueError("Unknown CollectDpkgs backend '%s'" % backend)
+
         command = ["dpkg-query", "--show", "-f", "${binary:Package} (${Version}) (${Architecture})\\n"]
         if chroot:
-            command = ["chroot", mountpath]
+            command = ["chroot", mountpath] + command
         if docker:
             command = [ self.ESCAPE_RE.sub(r'\\\1', x.replace('\\','\\\\\\')) for x in command ]
             command = ["docker", "exec", "-it", container, 'bash', '-c', "%s" % ' '.join(command)]
@@ -59,54 +207,6 @@ class CollectDpkgs:
             command = ["sudo", "-E"] + command
 
         self.log.debug("Executing: %s", " ".join(command))
-        p = subprocess.Popen(command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE )
-            
-        out, err = p.communicate()
-        dpkgs = out.split('\n')
-        for dpkg in dpkgs:
-            dpkg = dpkg.strip()
-            if len(dpkg) == 0:
-                continue
-            match = self.PACKAGE_RE.match(dpkg)
-            if match is None:
-                self.log.debug("Didn't match: %s", dpkg)
-                continue
-            package = match.group('package')
-            version = match.group('version')
-            release = match.group('release')
-            arch = match.group('arch')
-            if len(arch) > 0:
-                arch = arch.lstrip(':')
-            else:
-                arch = '__global'
-            if package not in versdict:
-                versdict[package] = {}
-            if tag not in versdict[package]:
-                versdict[package][tag] = {}
-            if 'dpkg' not in versdict[package][tag]:
-                versdict[package][tag]['dpkg'] = {}
-            if arch in versdict[package][tag]['dpkg']:
-                self.log.debug(
-                    "Package: %s, Tag: %s, Type: dpkg, Arch: %s :: Overwriting %s",
-                    package,
-                    tag,
-                    arch,
-                    str(versdict[package][tag]['dpkg'][arch]))
-
-            versdict[package][tag]['dpkg'][arch] = {
-                 'PACKAGE' : package,
-                 'VERSION' : version }
-            if arch != '__global':
-                versdict[package][tag]['dpkg'][arch]['ARCH'] = arch
-            if len(release) > 0:
-                versdict[package][tag]['dpkg'][arch]['RELEASE'] = release
-            self.log.debug(
-                "Package: %s, Tag: %s, Type: dpkg, Arch: %s :: Added %s",
-                package,
-                tag,
-                arch,
-                str(versdict[package][tag]['dpkg'][arch]) )
+        for dpkg in CommandLines.CommandLines(command, self.log):
+            self._addDpkg(versdict, tag, dpkg)
         return versdict
-
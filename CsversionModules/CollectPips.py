@@ -15,9 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
-import subprocess
 import re
+import glob
+import os
 import os.path
+from multiprocessing.pool import ThreadPool
+from Csversion import CommandLines
+from Csversion.Profiler import PROFILER
+from Csversion import VenvFinder
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
 
 class CollectPips:
     """Purpose: Record the version of all the pip installations on the
@@ -25,11 +34,194 @@ class CollectPips:
     Options: chroot - (OPTIONAL) Path to the chrootable built environment
              docker - (OPTIONAL) Docker container to interrogate
              find-venvs - (OPTIONAL) Search for venvs, default is False
+             venv-excludes - (OPTIONAL) Comma separated globs of paths not
+                 searched for venvs, e.g., /home/*/.cache,/var/lib/docker
+             venv-one-device - (OPTIONAL) Only search the filesystem of the
+                 root (or chroot) for venvs, default is False
+             venv-workers - (OPTIONAL) Number of top level directories
+                 searched for venvs at the same time, default is 8
+             venv-collect-workers - (OPTIONAL) Number of venvs run through
+                 pip freeze at the same time, default is 4
+             docker-batch - (OPTIONAL) Query the container, venvs included,
+                 in the same docker exec as the other sections for it,
+                 default is True
+             Pseudo, network and overlay filesystems mounted under the root
+             are not searched.  The search of a docker container uses find.
+             backend - (OPTIONAL) How the installed packages are read:
+                 freeze - run pip freeze in each environment (default)
+                 metadata - read the METADATA/PKG-INFO of the *.dist-info
+                            and *.egg-info entries in each environment's
+                            site-packages, no pip is run
+                 A docker container is always read with pip freeze.
+                 Like pip freeze, the metadata backend lists the packages
+                 of the python that the pip on the PATH runs with, found
+                 from its #! line: the user site of $HOME and the system
+                 site directories, the first of them holding a package
+                 giving its version.  When that python can't be told,
+                 the packages of every python in the system site
+                 directories are listed, the first version found of
+                 each.
     """
 
     #PACKAGE_RE = re.compile(r'(?P<package>[^\s(]*)\s*(\()?(?P<version>[^)]*)(\))?')
     PACKAGE_RE = re.compile(r'(?P<package>[^=]*)==(?P<version>.*)')
     ESCAPE_RE = re.compile(r'( |"|\')')
+    #What csversion --capture-targets may point this section at
+    TARGET_TYPES = ['chroot', 'docker']
+    #Packages pip freeze leaves out of its output
+    FREEZE_EXCLUDES = set(['pip', 'setuptools', 'wheel', 'distribute'])
+    #In the order python puts them on sys.path
+    GLOBAL_SITE_GLOBS = [
+        'usr/local/lib64/python*/site-packages',
+        'usr/local/lib/python*/site-packages',
+        'usr/local/lib/python*/dist-packages',
+        'usr/lib64/python*/site-packages',
+        'usr/lib/python*/site-packages',
+        'usr/lib/python*/dist-packages' ]
+    USER_SITE_GLOB = '.local/lib/python*/site-packages'
+    #Where pip is found on the PATH of sudo
+    PIP_DIRS = ['usr/local/sbin', 'usr/local/bin', 'usr/sbin', 'usr/bin', 'sbin', 'bin']
+    PYTHON_VERSION_RE = re.compile(r'^python(?P<version>(?P<major>\d+)\.\d+)$')
+    VENV_SITE_GLOBS = [
+        'lib/python*/site-packages',
+        'lib64/python*/site-packages' ]
+
+    def _siteDirs(self, root, patterns):
+        sitedirs = []
+        for pattern in patterns:
+            for sitedir in sorted(glob.glob(os.path.join(root, pattern))):
+                if os.path.isdir(sitedir) and sitedir not in sitedirs:
+                    sitedirs.append(sitedir)
+        return sitedirs
+
+    def _resolve(self, root, path):
+        #Follows the symlinks of path as if root were /
+        for _ in range(16):
+            full = os.path.join(root, path.lstrip('/'))
+            if not os.path.islink(full):
+                return path
+            target = os.readlink(full)
+            if not os.path.isabs(target):
+                target = os.path.join(os.path.dirname(path), target)
+            path = os.path.normpath(target)
+        return None
+
+    def _findCommand(self, root, name):
+        for directory in self.PIP_DIRS:
+            path = '/' + os.path.join(directory, name)
+            if os.path.isfile(os.path.join(root, path.lstrip('/'))):
+                return path
+        return None
+
+    def _pipPythonVersion(self, root):
+        #The (X.Y, X) version of the python that pip freeze would run
+        #  with, None when it can't be told
+        pip = self._findCommand(root, 'pip')
+        if pip is None:
+            return None
+        try:
+            with open(os.path.join(root, pip.lstrip('/'))) as f:
+                line = f.readline()
+        except (IOError, OSError) as e:
+            self.log.debug("Could not read %s: %s", pip, str(e))
+            return None
+        if not line.startswith('#!'):
+            return None
+        words = line[2:].split()
+        if len(words) == 0:
+            return None
+        interpreter = words[0]
+        if os.path.basename(interpreter) == 'env' and len(words) > 1:
+            interpreter = self._findCommand(root, words[1])
+            if interpreter is None:
+                return None
+        interpreter = self._resolve(root, interpreter)
+        if interpreter is None:
+            return None
+        match = self.PYTHON_VERSION_RE.match(os.path.basename(interpreter))
+        if match is None:
+            return None
+        return match.group('version'), match.group('major')
+
+    def _globalSiteDirs(self, root):
+        #The site directories pip freeze lists the global packages of
+        version = self._pipPythonVersion(root)
+        if version is None:
+            self.log.debug("Could not tell the python of pip under %s, reading every python's packages", root)
+            return self._siteDirs(root, self.GLOBAL_SITE_GLOBS)
+        version, major = version
+        self.log.debug("Reading the packages of python%s under %s", version, root)
+        patterns = []
+        home = os.environ.get('HOME')
+        if home is not None:
+            patterns.append(os.path.join(home.lstrip('/'), self.USER_SITE_GLOB).replace('python*', 'python' + version))
+        for pattern in self.GLOBAL_SITE_GLOBS:
+            patterns.append(pattern.replace('python*', 'python' + version))
+            #Debian's system packages are shared by its python3 versions
+            if pattern.endswith('dist-packages'):
+                patterns.append(pattern.replace('python*', 'python' + major))
+        return self._siteDirs(root, patterns)
+
+    def _readMetadata(self, path):
+        #Only the headers up to the first blank line are needed
+        name = None
+        version = None
+        with open(path) as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if len(line) == 0:
+                    break
+                if line.startswith('Name:') and name is None:
+                    name = line[5:].strip()
+                elif line.startswith('Version:') and version is None:
+                    version = line[8:].strip()
+                if name is not None and version is not None:
+                    break
+        return name, version
+
+    def _freezeName(self, name):
+        #pkg_resources.safe_name, the name pip freeze prints
+        return re.sub('[^A-Za-z0-9.]+', '-', name)
+
+    def _freezeVersion(self, version):
+        #pkg_resources.safe_version, the PEP 440 normal form pip freeze
+        #  prints, e.g., 1.0.0b1 for 1.0.0-Beta1
+        if pkg_resources is not None:
+            return pkg_resources.safe_version(version)
+        return re.sub('[^A-Za-z0-9.]+', '-', version.replace(' ', '.'))
+
+    def _metadataSpecs(self, sitedirs):
+        #Yields name==version, as pip freeze prints it, for every
+        #  distribution installed in sitedirs
+        seen = set()
+        for sitedir in sitedirs:
+            try:
+                entries = sorted(os.listdir(sitedir))
+            except OSError as e:
+                self.log.debug("Could not list %s: %s", sitedir, str(e))
+                continue
+            for entry in entries:
+                path = os.path.join(sitedir, entry)
+                if entry.endswith('.dist-info'):
+                    path = os.path.join(path, 'METADATA')
+                elif entry.endswith('.egg-info'):
+                    if os.path.isdir(path):
+                        path = os.path.join(path, 'PKG-INFO')
+                else:
+                    continue
+                try:
+                    name, version = self._readMetadata(path)
+                except (IOError, OSError) as e:
+                    self.log.debug("Could not read %s: %s", path, str(e))
+                    continue
+                if name is None or version is None:
+                    self.log.debug("No name or version in %s", path)
+                    continue
+                canonical = re.sub(r'[-_.]+', '-', name).lower()
+                if canonical in self.FREEZE_EXCLUDES or canonical in seen:
+                    continue
+                seen.add(canonical)
+                yield "%s==%s" % (self._freezeName(name), self._freezeVersion(version))
 
     def _appendPip(self, tag, versdict, virtualenv, specs):
         for spec in specs:
@@ -55,6 +247,7 @@ class CollectPips:
                      tag,
                      virtualenv,
                      str(versdict[package][tag]['pip'][virtualenv]) )
+            PROFILER.count('pip records')
             versdict[package][tag]['pip'][virtualenv] = {
                 'VENV' : virtualenv,
                 'PACKAGE' : package,
@@ -69,14 +262,94 @@ class CollectPips:
     def __init__(self, log):
         self.log = log
 
+    def _venvFinder(self, options, mountpath):
+        excludes = [ x.strip() for x in options.get('venv-excludes', '').split(',') if len(x.strip()) > 0 ]
+        return VenvFinder.VenvFinder(
+            mountpath,
+            self.log,
+            excludes,
+            options.get('venv-one-device', 'False').lower() == 'true',
+            int(options.get('venv-workers', '8')),
+            options.get('**cache-dir') )
+
+    def csversionInputFingerprint(self, options, key, tag, prefix):
+        #Installing or removing a package changes its site-packages
+        #  directory, a container's can't be checked.  The venvs are the
+        #  ones the last search found, not searched for again, with the
+        #  directories holding them so a venv added next to one is seen.
+        if 'docker' in options:
+            return None
+        mountpath = options.get('chroot', '/')
+        sitedirs = self._globalSiteDirs(mountpath)
+        venvs = []
+        if options.get('find-venvs', 'False').lower() == 'true':
+            venvs = self._venvFinder(options, mountpath).cached()
+            if venvs is None:
+                return None
+            venvroots = [ os.path.join(mountpath, venv.lstrip('/')) for venv in venvs ]
+            sitedirs.extend(sorted(set([ os.path.dirname(venvroot) for venvroot in venvroots ])))
+            for venvroot in venvroots:
+                sitedirs.extend(self._siteDirs(venvroot, self.VENV_SITE_GLOBS))
+        fingerprint = [ tuple(venvs) ]
+        for sitedir in sitedirs:
+            st = os.stat(sitedir)
+            fingerprint.append((sitedir, st.st_size, st.st_mtime))
+        return tuple(fingerprint)
+
     def defaultPrefix(self):
         return 'sources'
 
+    VENV_BEGIN = '<<<csversion-venv '
+    VENV_END = '<<<csversion-venv-end '
+
+    def csversionContainerQueries(self, options, key, tag, prefix):
+        #Run in the docker container by ConfigDriver with the queries
+        #  of the other sections, see '**container-output' below.
+        #  The venvs are found and frozen by the same query, each
+        #  venv's freeze is marked with its path and return code.
+        queries = [('global', 'pip freeze')]
+        if options.get('find-venvs', 'False').lower() == 'true':
+            queries.append(('venvs', """find / 2>/dev/null | grep 'bin/activate_this' | while read activate; do
+    venv=$(dirname "$(dirname "$activate")")
+    echo "%s$venv>>>"
+    ( source "$venv/bin/activate" && pip freeze )
+    echo "%s$?>>>"
+done""" % (self.VENV_BEGIN, self.VENV_END) ))
+        return queries
+
+    def _appendContainerOutput(self, tag, versdict, output):
+        self._appendPip(tag, versdict, '__global', output['global'])
+        if 'venvs' not in output:
+            return
+        venvs = []
+        venv = None
+        piplines = []
+        for line in output['venvs']:
+            if line.startswith(self.VENV_BEGIN) and line.endswith('>>>'):
+                venv = line[len(self.VENV_BEGIN):-3]
+                venvs.append(venv)
+                piplines = []
+            elif line.startswith(self.VENV_END) and line.endswith('>>>') and venv is not None:
+                if line[len(self.VENV_END):-3] == '0':
+                    self._appendPip(tag, versdict, venv, piplines)
+                else:
+                    self.log.info("Could not get information on %s", venv)
+                venv = None
+            elif venv is not None:
+                piplines.append(line)
+        self.log.info("CollectPips inspected the following virtualenvs: %s", str(venvs))
+
     def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
         versdict = manifest
+        if '**container-output' in options:
+            #Read as the batched docker exec streams it, ConfigDriver
+            #  captures the section alone if it didn't all arrive
+            self._appendContainerOutput(tag, versdict, options['**container-output'])
+            return versdict
         docker = False
         sudo = True
         find_venvs = False
+        backend = options.get('backend', 'freeze').strip()
         if 'find-venvs' in options:
             find_venvs = options['find-venvs'].lower() == 'true'
         if 'chroot' in options:
@@ -90,6 +363,13 @@ class CollectPips:
             docker = True
             container = options['docker']
 
+        if backend not in ('freeze', 'metadata'):
+            self.log.error("Unknown CollectPips backend '%s'", backend)
+            raise ValueError("Unknown CollectPips backend '%s'" % backend)
+        if backend == 'metadata' and docker:
+            self.log.warning("The pip metadata backend can't read container '%s', using pip freeze", container)
+            backend = 'freeze'
+
         commandPrefix = []
         dockerCommand = lambda x: x
         if chroot:
@@ -104,62 +384,80 @@ class CollectPips:
         grockCommand = lambda x: uberCommand(commandPrefix + x)
 
         venvs = []
-        if find_venvs:
+        if find_venvs and not docker:
+            venvs = self._venvFinder(options, mountpath).find()
+            self.log.info("CollectPips will inspect the following virtualenvs: %s", str(venvs))
+        elif find_venvs:
             command = grockCommand(["find", "/", "|", "grep", "'bin/activate_this'"])
-            p = subprocess.Popen(
-                ' '.join(command),
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE )
-            out, err = p.communicate()
-            if p.returncode != 0:
+            found = []
+            lines = CommandLines.CommandLines(' '.join(command), self.log, shell=True)
+            for raw in lines:
+                preppedpath = raw.strip().strip('.')
+                if len(preppedpath) == 0:
+                    continue
+                venv, _ = os.path.split(os.path.split(preppedpath)[0])
+                found.append(venv)
+            if lines.returncode != 0:
                 self.log.info("Search for virtual environments failed")
                 self.log.info("   It is possible that there are no virtual environments")
-                self.log.debug(err)
+                self.log.debug(lines.err)
             else:
-                venvraw = out.split('\n')
-                for raw in venvraw:
-                    preppedpath = raw.strip().strip('.')
-                    if len(preppedpath) == 0:
-                        continue
-                    venv, _ = os.path.split(os.path.split(preppedpath)[0])
-                    venvs.append(venv)
+                venvs = found
             self.log.info("CollectPips will inspect the following virtualenvs: %s", str(venvs))
+        if backend == 'metadata':
+            self._appendPip(tag, versdict, '__global', self._metadataSpecs(
+                self._globalSiteDirs(mountpath) ))
+            for venv in venvs:
+                venvroot = os.path.join(mountpath, venv.lstrip('/'))
+                self._appendPip(tag, versdict, venv, self._metadataSpecs(
+                    self._siteDirs(venvroot, self.VENV_SITE_GLOBS) ))
+            return versdict
+
         command = grockCommand(['pip', 'freeze'])
-        p = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE )
-        out, err = p.communicate()
-        #Iterate through all the freeze results
-        specs = out.split('\n')
-        self._appendPip(tag, versdict, '__global', specs)
-
-        #Iterate through all the venvs
-        delim = "=-=-=-=-=-=-=-=-="
-        for venv in venvs:
-            command = grockCommand([
-                '/bin/bash',
-                '-c',
-                "'source %s/bin/activate; echo %s; pip freeze; deactivate;'" % (
-                    venv, delim ) ])
-            p = subprocess.Popen(
-                ' '.join(command),
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE )
-            out, err = p.communicate()
-            if p.returncode != 0:
-                self.log.info("Could not get information on %s", venv)
-                self.log.debug(err)
-                continue
-            done = False
-            piplines = out.split('\n')
-            count = 0
-            while not done and count < len(piplines):
-                done = piplines[count].strip() == delim
-                count = count + 1
-            piplines = piplines[count:]
-            self._appendPip(tag, versdict, venv, piplines)
+        #Iterate through all the freeze results as pip prints them
+        self._appendPip(tag, versdict, '__global', CommandLines.CommandLines(command, self.log))
+
+        #Iterate through all the venvs, each is frozen by a pool thread and
+        #  the results are added in venv order so the manifest doesn't
+        #  depend on which finished first
+        workers = max(1, min(int(options.get('venv-collect-workers', '4')), len(venvs)))
+        if workers <= 1:
+            results = [ self._freezeVenv(grockCommand, venv) for venv in venvs ]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(
+                    CommandLines.ProcessTracker.carry(
+                        lambda venv: self._freezeVenv(grockCommand, venv) ),
+                    venvs )
+            finally:
+                pool.close()
+                pool.join()
+        for venv, piplines in zip(venvs, results):
+            if piplines is not None:
+                self._appendPip(tag, versdict, venv, piplines)
         return versdict
 
+    def _freezeVenv(self, grockCommand, venv):
+        #Returns the pip freeze lines of venv, None if it can't be frozen
+        delim = "=-=-=-=-=-=-=-=-="
+        command = grockCommand([
+            '/bin/bash',
+            '-c',
+            "'source %s/bin/activate; echo %s; pip freeze; deactivate;'" % (
+                venv, delim ) ])
+        #Only the lines after the delimiter are pip freeze output, they
+        #  are kept until pip is known to have succeeded
+        lines = CommandLines.CommandLines(' '.join(command), self.log, shell=True)
+        piplines = []
+        done = False
+        for line in lines:
+            if done:
+                piplines.append(line)
+            else:
+                done = line.strip() == delim
+        if lines.returncode != 0:
+            self.log.info("Could not get information on %s", venv)
+            self.log.debug(lines.err)
+            return None
+        return piplines
@@ -15,18 +15,52 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
-import subprocess
+import os.path
+import struct
 import re
+import sys
+from Csversion import CommandLines
+from Csversion.Profiler import PROFILER
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
 
 class CollectRpms:
     """Purpose: Record the version of all the rpm installations on the
                 created image.
     Options: chroot - (OPTIONAL) Path to the chroot environment to query
              docker - (OPTIONAL) Name of container
+             docker-batch - (OPTIONAL) Query the container in the same
+                 docker exec as the other sections for it, default is True
+             backend - (OPTIONAL) How the packages are read:
+                 rpmdb - read <chroot>/var/lib/rpm/rpmdb.sqlite directly
+                 rpm - run rpm -qa (with sudo)
+                 auto - rpmdb when the sqlite database is readable and no
+                        docker container is given, otherwise rpm (default)
+                 Berkeley DB and ndb databases are always read with rpm, as
+                 are sqlite databases when python's sqlite can't open them
+                 read-only
         """
 
     PACKAGE_RE = re.compile(r'(?P<package>[^\s]*)\s*(?P<version>[^\s]*)\s*(?P<release>[^\s]*)\s*(?P<arch>[^\s]*)')
     ESCAPE_RE = re.compile(r'( |"|\')')
+    #What csversion --capture-targets may point this section at
+    TARGET_TYPES = ['chroot', 'docker']
+    RPMDB_FILE = 'var/lib/rpm/rpmdb.sqlite'
+    RPMDB_INPUTS = ['rpmdb.sqlite', 'rpmdb.sqlite-wal', 'Packages', 'Packages.db']
+
+    #Header tags and types used from the rpm header blobs
+    RPMTAG_NAME = 1000
+    RPMTAG_VERSION = 1001
+    RPMTAG_RELEASE = 1002
+    RPMTAG_ARCH = 1022
+    RPM_STRING_TYPES = (6, 8, 9)
+    HEADER_INDEX = struct.Struct('>iiii')
 
     def __init__(self, log):
         self.log = log
@@ -34,10 +68,144 @@ class CollectRpms:
     def defaultPrefix(self):
         return 'sources'
 
+    def _headerStrings(self, blob, tags):
+        #Decodes the string values of tags from an rpm header blob:
+        #  two big endian counts (index entries, data bytes), the index
+        #  entries (tag, type, offset, count) and then the data store
+        il, dl = struct.unpack_from('>ii', blob, 0)
+        datastart = 8 + il * self.HEADER_INDEX.size
+        if il < 0 or dl < 0 or datastart + dl > len(blob):
+            raise ValueError("Malformed rpm header")
+        values = {}
+        for entry in range(il):
+            tag, datatype, offset, count = self.HEADER_INDEX.unpack_from(
+                blob, 8 + entry * self.HEADER_INDEX.size)
+            if tag not in tags or datatype not in self.RPM_STRING_TYPES:
+                continue
+            start = datastart + offset
+            end = blob.find('\0', start, datastart + dl)
+            if end < 0:
+                raise ValueError("Malformed rpm header")
+            values[tag] = blob[start:end]
+        return values
+
+    def _readOnlyUris(self):
+        #Whether sqlite3 can be asked to open a database read-only.  That
+        #  takes a file: URI, which python 2 can only pass to a sqlite
+        #  built to take them, others open a file named after the URI.
+        if sys.version_info[0] >= 3:
+            return True
+        connection = sqlite3.connect(':memory:')
+        try:
+            options = [ option for (option,) in connection.execute("PRAGMA compile_options") ]
+        finally:
+            connection.close()
+        return 'USE_URI' in options or 'USE_URI=1' in options
+
+    def _connectRpmdb(self, dbpath):
+        #Read-only, with a read-write connection to the live database a
+        #  WAL checkpoint or journal recovery could write to it as root
+        if not self._readOnlyUris():
+            raise sqlite3.NotSupportedError("This sqlite can't open '%s' read-only" % dbpath)
+        uri = 'file:%s?mode=ro' % quote(os.path.abspath(dbpath))
+        if sys.version_info[0] >= 3:
+            return sqlite3.connect(uri, uri=True)
+        return sqlite3.connect(uri)
+
+    def _rpmdbLines(self, dbpath):
+        #Yields each installed package in the format rpm -qa is asked for
+        #  by this module
+        tags = (self.RPMTAG_NAME, self.RPMTAG_VERSION, self.RPMTAG_RELEASE, self.RPMTAG_ARCH)
+        connection = self._connectRpmdb(dbpath)
+        try:
+            for (blob,) in connection.execute("SELECT blob FROM Packages"):
+                values = self._headerStrings(str(blob), tags)
+                if self.RPMTAG_NAME not in values:
+                    continue
+                yield "%s %s %s %s" % (
+                    values[self.RPMTAG_NAME],
+                    values.get(self.RPMTAG_VERSION, '(none)'),
+                    values.get(self.RPMTAG_RELEASE, '(none)'),
+                    values.get(self.RPMTAG_ARCH, '(none)') )
+        finally:
+            connection.close()
+
+    def _addRpm(self, versdict, tag, dpkg):
+        dpkg = dpkg.strip()
+        if len(dpkg) == 0:
+            return
+        match = self.PACKAGE_RE.match(dpkg)
+        if match is None:
+            self.log.debug("Didn't match: %s", dpkg)
+            return
+        package = match.group('package')
+        version = match.group('version')
+        arch = match.group('arch')
+        release = match.group('release')
+        if len(arch) > 0:
+            arch = arch.lstrip(':')
+        else:
+            arch = '__global'
+        if package not in versdict:
+            versdict[package] = {}
+        if tag not in versdict[package]:
+            versdict[package][tag] = {}
+        if 'rpm' not in versdict[package][tag]:
+            versdict[package][tag]['rpm'] = {}
+        if arch in versdict[package][tag]['rpm']:
+            self.log.debug(
+                "Package: %s, Tag: %s, Type: rpm, Arch: %s :: Overwriting %s",
+                package,
+                tag,
+                arch,
+                str(versdict[package][tag]['rpm'][arch]))
+
+        PROFILER.count('rpm records')
+        versdict[package][tag]['rpm'][arch] = {
+             'PACKAGE' : package,
+             'VERSION' : version,
+             'RELEASE' : release }
+        if arch != '__global':
+            versdict[package][tag]['rpm'][arch]['ARCH'] = arch
+        self.log.debug(
+            "Package: %s, Tag: %s, Type: rpm, Arch: %s :: Added %s",
+            package,
+            tag,
+            arch,
+            str(versdict[package][tag]['rpm'][arch]) )
+
+    def csversionInputFingerprint(self, options, key, tag, prefix):
+        #Whichever rpm database files exist change with every package
+        #  change, a container's can't be checked
+        if 'docker' in options:
+            return None
+        fingerprint = []
+        rpmdir = os.path.join(options.get('chroot', '/'), os.path.dirname(self.RPMDB_FILE))
+        for name in self.RPMDB_INPUTS:
+            path = os.path.join(rpmdir, name)
+            if os.path.exists(path):
+                st = os.stat(path)
+                fingerprint.append((path, st.st_size, st.st_mtime))
+        if len(fingerprint) == 0:
+            return None
+        return tuple(fingerprint)
+
+    def csversionContainerQueries(self, options, key, tag, prefix):
+        #Run in the docker container by ConfigDriver with the queries
+        #  of the other sections, see '**container-output' below
+        return [('rpm', "rpm -qa --qf '%{NAME} %{VERSION} %{RELEASE} %{ARCH}\\n'")]
+
     def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
         versdict = manifest
+        if '**container-output' in options:
+            #Read as the batched docker exec streams it, ConfigDriver
+            #  captures the section alone if it didn't all arrive
+            for rpm in options['**container-output']['rpm']:
+                self._addRpm(versdict, tag, rpm)
+            return versdict
         docker = False
         sudo = True
+        backend = options.get('backend', 'auto').strip()
         if 'chroot' in options:
             mountpath = options['chroot']
             chroot = True
@@ -49,9 +217,39 @@ class CollectRpms:
             docker = True
             container = options['docker']
 
+        dbpath = os.path.join(mountpath, self.RPMDB_FILE)
+        if backend == 'auto':
+            if not docker and sqlite3 is not None and os.access(dbpath, os.R_OK) \
+              and self._readOnlyUris():
+                backend = 'rpmdb'
+            else:
+                backend = 'rpm'
+        if backend == 'rpmdb':
+            if docker:
+                self.log.warning("The rpmdb backend can't read container '%s', using rpm", container)
+            elif sqlite3 is None:
+                self.log.warning("The rpmdb backend needs the python sqlite3 module, using rpm")
+            elif not os.path.exists(dbpath):
+                self.log.warning("No sqlite rpm database at '%s', using rpm", dbpath)
+            else:
+                self.log.debug("Reading: %s", dbpath)
+                try:
+                    #Decoded fully before anything is recorded, so a failed
+                    #  read leaves nothing behind for the rpm fallback
+                    rpms = list(self._rpmdbLines(dbpath))
+                except (sqlite3.Error, ValueError, struct.error) as e:
+                    self.log.warning("Could not read '%s' (%s), using rpm", dbpath, str(e))
+                else:
+                    for dpkg in rpms:
+                        self._addRpm(versdict, tag, dpkg)
+                    return versdict
+        elif backend != 'rpm':
+            self.log.error("Unknown CollectRpms backend '%s'", backend)
+            raise ValueError("Unknown CollectRpms backend '%s'" % backend)
+
         command = ["rpm", "-qa", "--qf", "%{NAME} %{VERSION} %{RELEASE} %{ARCH}\\n"]
         if chroot:
-            command = ["chroot", mountpath]
+            command = ["chroot", mountpath] + command
         if docker:
             command = [ self.ESCAPE_RE.sub(r'\\\1', x.replace('\\','\\\\\\')) for x in command ]
             command = ["docker", "exec", "-it", container, 'bash', '-c', "%s" % ' '.join(command)]
@@ -59,53 +257,6 @@ class CollectRpms:
             command = ["sudo", "-E"] + command
 
         self.log.debug("Executing: %s", " ".join(command))
-        p = subprocess.Popen(command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE )
-            
-        out, err = p.communicate()
-        dpkgs = out.split('\n')
-        for dpkg in dpkgs:
-            dpkg = dpkg.strip()
-            if len(dpkg) == 0:
-                continue
-            match = self.PACKAGE_RE.match(dpkg)
-            if match is None:
-                self.log.debug("Didn't match: %s", dpkg)
-                continue
-            package = match.group('package')
-            version = match.group('version')
-            arch = match.group('arch')
-            release = match.group('release')
-            if len(arch) > 0:
-                arch = arch.lstrip(':')
-            else:
-                arch = '__global'
-            if package not in versdict:
-                versdict[package] = {}
-            if tag not in versdict[package]:
-                versdict[package][tag] = {}
-            if 'rpm' not in versdict[package][tag]:
-                versdict[package][tag]['rpm'] = {}
-            if arch in versdict[package][tag]['rpm']:
-                self.log.debug(
-                    "Package: %s, Tag: %s, Type: rpm, Arch: %s :: Overwriting %s",
-                    package,
-                    tag,
-                    arch,
-                    str(versdict[package][tag]['rpm'][arch]))
-
-            versdict[package][tag]['rpm'][arch] = {
-                 'PACKAGE' : package,
-                 'VERSION' : version,
-                 'RELEASE' : release }
-            if arch != '__global':
-                versdict[package][tag]['rpm'][arch]['ARCH'] = arch
-            self.log.debug(
-                "Package: %s, Tag: %s, Type: rpm, Arch: %s :: Added %s",
-                package,
-                tag,
-                arch,
-                str(versdict[package][tag]['rpm'][arch]) )
+        for dpkg in CommandLines.CommandLines(command, self.log):
+            self._addRpm(versdict, tag, dpkg)
         return versdict
-
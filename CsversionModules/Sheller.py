@@ -14,8 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # </copyright>
+import cPickle
+import hashlib
+import os
+import os.path
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 import re
+import uuid
+from multiprocessing.pool import ThreadPool
+from Csversion import CommandLines
+from Csversion import ManifestCache
 
 class Sheller:
     """Purpose: Set specified shell script output to manifest paths
@@ -23,7 +35,7 @@ class Sheller:
                 below the key to set.
        Note:    If no prefix is defined, the default will be product.capture
                 The shells must succeed with a success (0) return code
-                Uses /bin/bash as the execution environment
+                Uses /bin/sh as the execution environment
        Example:
             [Sheller@myProduct product.metadata]
             version.build = echo 33
@@ -40,18 +52,314 @@ class Sheller:
              and the date is 'Tue Nov  6 10:29:08 MST 2018'
 
            {'product' : {'metadata' : {'myProduct' : { 'modified' : "auser\nTue Nov  6 10:29:08 MST 2018\nWhat a lovely day!" } } } }
+
+       Meta options (not shell commands):
+            **workers - Number of the section's commands run at the
+                        same time, default is 1
+            **command-timeout - Seconds a command may run before it
+                        is killed and recorded as failed
+            **cache - True reuses the output of a command string
+                        already run by a Sheller section in this capture
+            **cache-ttl - Seconds the output of a command string is
+                        reused across captures, implies **cache.
+                        Expired outputs are removed from the cache.
+            **session - True runs the commands in one /bin/sh process
+                        shared by every Sheller section of the capture
+                        instead of starting a shell per command.  Each
+                        command runs in its own subshell, one at a time.
+                        The shell ends with the capture.
+        """
+
+    class Session(object):
+        """Purpose: A /bin/sh process that runs commands one at a time,
+           each quoted and eval'ed in a subshell followed by a sentinel
+           line with its return code, so every command's output and
+           return code are read separately from the one stdout.  A
+           command the shell can't parse fails in its subshell as it
+           would with sh -c, and leaves the session running.
         """
 
+        def __init__(self, log):
+            self.log = log
+            self.process = None
+            self.lock = threading.Lock()
+            self.sentinel = '<<<Sheller-%s' % uuid.uuid4().hex
+
+        def _start(self):
+            self.process = subprocess.Popen(
+                ['/bin/sh'],
+                bufsize=-1,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                preexec_fn=os.setsid )
+
+        def close(self):
+            with self.lock:
+                self._close()
+
+        def _close(self):
+            if self.process is not None:
+                try:
+                    self.process.stdin.close()
+                    self.process.wait()
+                except (IOError, OSError):
+                    pass
+                self.process = None
+
+        def _kill(self, process, state):
+            state['timedout'] = True
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        def execute(self, command, timeout):
+            #Returns (return code, output) as Sheller._execute does
+            with self.lock:
+                if self.process is None:
+                    self._start()
+                process = self.process
+                tracker = CommandLines.ProcessTracker.current()
+                if tracker is not None:
+                    tracker.add(process)
+                state = {'timedout' : False}
+                timer = None
+                if timeout is not None:
+                    timer = threading.Timer(timeout, self._kill, (process, state))
+                    timer.daemon = True
+                    timer.start()
+                output = []
+                returncode = None
+                try:
+                    #Quoted, the command can't end the subshell or eat the
+                    #  sentinel, whatever it holds
+                    process.stdin.write("( eval '%s' ) </dev/null\nprintf '\\n%s %%d\\n' $?\n" % (
+                        command.replace("'", "'\\''"), self.sentinel))
+                    process.stdin.flush()
+                    for line in iter(process.stdout.readline, ''):
+                        if line.startswith(self.sentinel + ' '):
+                            returncode = int(line[len(self.sentinel) + 1:])
+                            break
+                        output.append(line)
+                except (IOError, OSError) as e:
+                    self.log.debug("Sheller session failed running '%s': %s", command, str(e))
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                    #Only this command's section may kill the session
+                    #  while the command runs, not once it is done
+                    if tracker is not None:
+                        tracker.remove(process)
+                if returncode is not None:
+                    #The newline printed before the sentinel
+                    output[-1] = output[-1][:-1]
+                else:
+                    #The session died or was killed, the next command
+                    #  gets a new one
+                    self._close()
+                    if not state['timedout']:
+                        returncode = -1
+                return returncode, ''.join(output)
+
+    #Guards the session of a capture using **session, kept in the
+    #  capture's '**capture-state', which ends it with the capture
+    sessionLock = threading.Lock()
+
+    #Guards the outputs of the command strings run in a capture when
+    #  **cache is used, kept in the capture's '**capture-state'
+    capturedOutputsLock = threading.Lock()
+    CACHE_FORMAT = 2
+    CACHE_SUFFIX = '.sheller'
+
     def __init__(self, log):
         self.log = log
 
     def defaultPrefix(self):
         return 'product.capture'
 
+    def _cachePath(self, cachedir, command):
+        return os.path.join(cachedir, hashlib.sha1(command).hexdigest() + self.CACHE_SUFFIX)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _loadCache(self, path):
+        #Returns the entry at path, None when there is none.  An unreadable
+        #  entry is removed.
+        try:
+            with open(path, 'rb') as f:
+                return cPickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            self.log.debug("Discarding unreadable Sheller cache '%s': %s", path, str(e))
+            self._remove(path)
+            return None
+
+    def _expired(self, entry, ttl):
+        return entry.get('format') != self.CACHE_FORMAT \
+          or time.time() - entry.get('time', 0) > ttl
+
+    def _readCache(self, cachedir, command, ttl):
+        path = self._cachePath(cachedir, command)
+        entry = self._loadCache(path)
+        if entry is None or entry.get('command') != command:
+            return None
+        if self._expired(entry, ttl):
+            self._remove(path)
+            return None
+        return entry['output']
+
+    def _pruneCache(self, cachedir):
+        #Removes the entries past the ttl they were written with, e.g.,
+        #  of commands no longer in the csversionfile
+        try:
+            names = os.listdir(cachedir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(self.CACHE_SUFFIX):
+                continue
+            path = os.path.join(cachedir, name)
+            entry = self._loadCache(path)
+            if entry is not None and self._expired(entry, entry.get('ttl', 0)):
+                self.log.debug("Evicting expired Sheller cache entry: %s", path)
+                self._remove(path)
+
+    def _writeCache(self, cachedir, command, output, ttl):
+        temppath = None
+        try:
+            fd, temppath = tempfile.mkstemp(dir=cachedir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump({
+                    'format' : self.CACHE_FORMAT,
+                    'command' : command,
+                    'time' : time.time(),
+                    'ttl' : ttl,
+                    'output' : output }, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temppath, self._cachePath(cachedir, command))
+        except Exception as e:
+            self.log.debug("Could not write the Sheller cache for '%s': %s", command, str(e))
+            if temppath is not None and os.path.exists(temppath):
+                os.remove(temppath)
+
+    def _kill(self, p, state):
+        #The command runs in its own process group so whatever the shell
+        #  started is killed with it
+        state['timedout'] = True
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _execute(self, command, timeout):
+        #Returns (return code, output), the return code is None when
+        #  the command was killed for taking longer than timeout
+        p = subprocess.Popen(
+            command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            preexec_fn=os.setsid )
+        tracker = CommandLines.ProcessTracker.current()
+        if tracker is not None:
+            tracker.add(p)
+        state = {'timedout' : False}
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._kill, (p, state))
+            timer.daemon = True
+            timer.start()
+        try:
+            out, _ = p.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if state['timedout']:
+            return None, out
+        return p.returncode, out
+
+    def _getSession(self, state):
+        with self.sessionLock:
+            if 'Sheller session' not in state:
+                state['Sheller session'] = Sheller.Session(self.log)
+            return state['Sheller session']
+
+    def _run(self, command, timeout, outputs, cachedir, ttl, session):
+        #Returns (return code, output) of command, from the caches if it
+        #  succeeded before.  outputs is the dict of the capture's outputs,
+        #  None when they aren't reused.  session is the Session to run
+        #  command in, None runs it alone.  Failures are never cached.
+        if outputs is not None:
+            with self.capturedOutputsLock:
+                if command in outputs:
+                    return 0, outputs[command]
+        if cachedir is not None:
+            output = self._readCache(cachedir, command, ttl)
+            if output is not None:
+                self.log.debug("Sheller reusing the cached output of: %s", command)
+                with self.capturedOutputsLock:
+                    outputs[command] = output
+                return 0, output
+        if session is not None:
+            returncode, output = session.execute(command, timeout)
+        else:
+            returncode, output = self._execute(command, timeout)
+        if returncode == 0:
+            if outputs is not None:
+                with self.capturedOutputsLock:
+                    outputs[command] = output
+            if cachedir is not None:
+                self._writeCache(cachedir, command, output, ttl)
+        return returncode, output
+
     def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
         if tag not in manifest:
             manifest[tag] = {}
         versdict = manifest[tag]
+        workers = int(options.get('**workers', '1'))
+        timeout = options.get('**command-timeout')
+        if timeout is not None:
+            timeout = float(timeout)
+        ttl = options.get('**cache-ttl')
+        cachedir = None
+        if ttl is not None:
+            ttl = float(ttl)
+            if '**cache-dir' in options:
+                cachedir = options['**cache-dir']
+                try:
+                    ManifestCache.prepareCacheDir(cachedir)
+                except (IOError, OSError) as e:
+                    self.log.info("Sheller cache '%s' is not usable, caching for this capture only: %s", cachedir, str(e))
+                    cachedir = None
+            else:
+                self.log.info("Sheller **cache-ttl needs the csversion cache, caching for this capture only")
+        cache = ttl is not None or options.get('**cache', 'False').lower() == 'true'
+        #Without a '**capture-state', e.g., when run outside of a
+        #  ConfigDriver, the outputs and session are the section's own
+        state = options.get('**capture-state')
+        ownState = state is None
+        if ownState:
+            state = {}
+        outputs = None
+        if cache:
+            with self.capturedOutputsLock:
+                outputs = state.setdefault('Sheller outputs', {})
+                if cachedir is not None:
+                    pruned = state.setdefault('Sheller pruned', set())
+                    prune = cachedir not in pruned
+                    pruned.add(cachedir)
+            if cachedir is not None and prune:
+                self._pruneCache(cachedir)
+        session = None
+        if options.get('**session', 'False').lower() == 'true':
+            session = self._getSession(state)
+            #The session runs one command at a time
+            workers = 1
+
+        entries = []
         for option, value in options.iteritems():
             if option.startswith('**'):
                 continue
@@ -63,16 +371,42 @@ class Sheller:
                 if part not in manifestPart:
                     manifestPart[part] = {}
                 manifestPart = manifestPart[part]
-            try:
-                previousManifestPart[part] = subprocess.check_output(
-                    value,
-                    shell=True ).strip()
-            except subprocess.CalledProcessError as cpe:
-                previousManifestPart[part] = "<<<Sheller FAILED>>> Return code: %d, Execution attempted: %s" % (cpe.returncode, cpe.cmd)
+            entries.append((option, value, previousManifestPart, part))
+
+        run = CommandLines.ProcessTracker.carry(
+            lambda entry: self._run(entry[1], timeout, outputs, cachedir, ttl, session) )
+        workers = max(1, min(workers, len(entries)))
+        try:
+            if workers <= 1:
+                results = [ run(entry) for entry in entries ]
+            else:
+                pool = ThreadPool(workers)
+                try:
+                    results = pool.map(run, entries)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            if ownState and session is not None:
+                session.close()
+
+        for (option, value, previousManifestPart, part), (returncode, output) in zip(entries, results):
+            if returncode == 0:
+                previousManifestPart[part] = output.strip()
+            elif returncode is None:
+                previousManifestPart[part] = "<<<Sheller FAILED>>> Timed out after %s seconds, Execution attempted: %s" % (timeout, value)
+                self.log.error("Sheller FAILED for tag '%s' prefix '%s' entry '%s' (Timed out after %s seconds) when attempting: %s",
+                    tag,
+                    prefix,
+                    option,
+                    timeout,
+                    value )
+            else:
+                previousManifestPart[part] = "<<<Sheller FAILED>>> Return code: %d, Execution attempted: %s" % (returncode, value)
                 self.log.error("Sheller FAILED for tag '%s' prefix '%s' entry '%s' (Return code: %d) when attempting: %s",
                     tag,
                     prefix,
                     option,
-                    cpe.returncode,
-                    cpe.cmd )
+                    returncode,
+                    value )
         return manifest
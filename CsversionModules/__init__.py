@@ -1,5 +1,29 @@
-from os.path import dirname, basename, isfile
-import glob
-modules = glob.glob(dirname(__file__)+"/*.py")
-__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
-from . import *
+import importlib
+import os
+
+#Section modules are registered by name and only imported when a
+#  csversionfile section uses them.  The modules in this directory are
+#  registered here, others (e.g., third party collectors) can be added
+#  with register without being imported.
+registry = {}
+
+def register(name, modulePath):
+    """Registers the section name to be imported from modulePath when a
+       csversionfile section first uses it,
+       e.g., register('CollectFoo', 'mycollectors.CollectFoo')
+       The module must define a class with the section name."""
+    registry[name] = modulePath
+
+def lookup(name):
+    """Returns the module for the section name, None if it isn't registered"""
+    if name not in registry:
+        return None
+    return importlib.import_module(registry[name])
+
+def names():
+    return sorted(registry.keys())
+
+for _filename in os.listdir(os.path.dirname(__file__)):
+    if _filename.endswith('.py') and _filename != '__init__.py':
+        register(_filename[:-3], '%s.%s' % (__name__, _filename[:-3]))
+del _filename
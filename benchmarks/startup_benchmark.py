@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+"""Times the startup of short csversion runs, end to end.
+
+   Each case runs csversion as a new process, the way it is run from a
+   shell or a script: csversion --version, and a query of one small
+   manifest that is already in the manifest cache.  The median of the
+   runs is compared to the case's threshold, and the benchmark exits
+   with 1 when any case is over, so it can gate a change that brings
+   an import back onto the startup path.
+
+   Usage: startup_benchmark.py [runs] [version-threshold] [query-threshold]
+          (thresholds in seconds)
+"""
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+CSVERSION = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'csversion')
+
+MANIFEST = """product:
+  metadata:
+    product:
+      name: product
+      version-full: 1.0.0
+  capture:
+    product:
+      time: 2018-01-01T00:00:00Z
+      command: csversion --capture
+sources:
+  bash:
+    product:
+      dpkg:
+        amd64: {PACKAGE: bash, VERSION: '4.3', ARCH: amd64}
+"""
+
+def timeRun(command):
+    #Not every case exits with 0, e.g., --version exits through usage
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.call(command, stdout=devnull, stderr=devnull)
+        return time.time() - start
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    versionThreshold = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    queryThreshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.3
+    tempdir = tempfile.mkdtemp()
+    try:
+        manifest = os.path.join(tempdir, 'product.csversion')
+        with open(manifest, 'w') as f:
+            f.write(MANIFEST)
+        cases = [
+            ('version', versionThreshold,
+                [sys.executable, CSVERSION, '--version']),
+            ('query', queryThreshold,
+                [sys.executable, CSVERSION,
+                    '--manifests=%s' % manifest,
+                    '--cache-dir=%s' % os.path.join(tempdir, 'cache')]) ]
+        sys.stdout.write("%d runs\n" % runs)
+        sys.stdout.write("%10s %12s %12s %12s\n" % ('case', 'min', 'median', 'threshold'))
+        failed = False
+        for name, threshold, command in cases:
+            #The first run fills the manifest cache and the .pyc files
+            timeRun(command)
+            times = sorted([ timeRun(command) for _ in range(runs) ])
+            median = times[len(times) // 2]
+            sys.stdout.write("%10s %12.4f %12.4f %12.4f%s\n" % (
+                name, times[0], median, threshold,
+                '  OVER' if median > threshold else ''))
+            failed = failed or median > threshold
+    finally:
+        shutil.rmtree(tempdir)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
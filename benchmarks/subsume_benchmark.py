@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+"""Times Manifest.subsumeManifests over growing numbers of manifests.
+
+   Each synthetic manifest carries the same product tags and package set,
+   the way a directory of captures of one product over time does.  The
+   time per manifest should stay flat as the manifest count grows.
+
+   Usage: subsume_benchmark.py [packages-per-manifest] [tags]
+"""
+import logging
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.Csversion import Manifest
+
+COUNTS = [10, 50, 100, 250, 500, 1000]
+
+def makeManifest(index, packages, tags):
+    manifest = Manifest([], log=logging)
+    manifest['product'] = {'metadata' : {}, 'capture' : {}}
+    manifest['sources'] = {}
+    for t in range(tags):
+        tag = 'product%d' % t
+        manifest['product']['metadata'][tag] = {
+            'name' : tag,
+            'version-full' : '1.%d.%d' % (index // 100, index % 100) }
+        manifest['product']['capture'][tag] = {
+            'command' : 'csversion --capture',
+            'time' : '2018-01-01T00:00:00Z' }
+        for p in range(packages):
+            package = 'package%d' % p
+            if package not in manifest['sources']:
+                manifest['sources'][package] = {}
+            manifest['sources'][package][tag] = {
+                'dpkg' : { 'amd64' : {
+                    'PACKAGE' : package,
+                    'VERSION' : '%d.%d' % (p, index),
+                    'ARCH' : 'amd64' } } }
+    return manifest
+
+def main():
+    packages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    tags = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    sys.stdout.write("%d packages, %d tags per manifest\n" % (packages, tags))
+    sys.stdout.write("%10s %12s %16s\n" % ('manifests', 'seconds', 'usec/manifest'))
+    for count in COUNTS:
+        manifests = [ makeManifest(i, packages, tags) for i in range(count) ]
+        start = time.time()
+        Manifest([]).subsumeManifests(manifests)
+        elapsed = time.time() - start
+        sys.stdout.write("%10d %12.4f %16.1f\n" % (
+            count, elapsed, elapsed / count * 1000000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.Csversion import CsversionCli, _targetFilename
+
+class CaptureTargetsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_plainNames(self):
+        self.assertEqual(_targetFilename(('docker', 'web')), 'docker-web.csversion')
+        self.assertEqual(_targetFilename(('docker', 'web-1.2_x')), 'docker-web-1.2_x.csversion')
+
+    def test_replacedNamesAreUnique(self):
+        names = [ _targetFilename(('chroot', path)) for path in ['/srv/a/b', '/srv/a_b', 'srv/a/b', '/srv/a/b/'] ]
+        self.assertEqual(len(set(names)), len(names))
+        for name in names:
+            self.assertTrue(name.startswith('chroot-srv_a_b-'), name)
+        self.assertTrue(_targetFilename(('chroot', '/')).startswith('chroot-root-'))
+
+    def test_duplicateTargetsFail(self):
+        cli = CsversionCli.__new__(CsversionCli)
+        cli.log = logging.getLogger('test_capturetargets')
+        cli.settings = {
+            'capture-output-dir' : os.path.join(self.tempdir, 'out'),
+            'capture-target-workers' : 1 }
+        captured = []
+        cli._captureTarget = captured.append
+        with self.assertRaises(ValueError):
+            cli.captureTargets([ ('docker', 'web'), ('chroot', '/srv/a'), ('docker', 'web') ])
+        self.assertEqual(captured, [])
+
+if __name__ == '__main__':
+    unittest.main()
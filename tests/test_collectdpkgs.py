@@ -0,0 +1,95 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from CsversionModules.CollectDpkgs import CollectDpkgs
+
+#A dpkg database and what dpkg-query --show lists for it with the format
+#  CollectDpkgs uses, recorded on an amd64 system with:
+#  dpkg-query --admindir=tests/fixtures/dpkg --show \
+#      -f '${binary:Package} (${Version}) (${Architecture})\n'
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'dpkg')
+STATUS = os.path.join(FIXTURES, 'status')
+DPKG_QUERY_OUT = os.path.join(FIXTURES, 'dpkg-query.out')
+DPKG_QUERY_FORMAT = '${binary:Package} (${Version}) (${Architecture})\\n'
+
+def _hasAmd64DpkgQuery():
+    try:
+        return subprocess.check_output(
+            ['dpkg', '--print-architecture'], stderr=subprocess.STDOUT ).strip() == 'amd64'
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+class CollectDpkgsStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = CollectDpkgs(logging)
+
+    def _queryRecords(self):
+        versdict = {}
+        with open(DPKG_QUERY_OUT) as f:
+            for line in f:
+                self.collector._addDpkg(versdict, 'tag', line)
+        return versdict
+
+    def test_statusLinesMatchDpkgQuery(self):
+        with open(DPKG_QUERY_OUT) as f:
+            expected = f.read().splitlines()
+        self.assertEqual(sorted(self.collector._statusLines(STATUS)), expected)
+
+    def test_statusBackendRecords(self):
+        chroot = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(chroot, 'var', 'lib', 'dpkg'))
+            shutil.copy(STATUS, os.path.join(chroot, CollectDpkgs.STATUS_FILE))
+            versdict = self.collector.csversionPopulateManifest(
+                {}, {'chroot' : chroot, 'backend' : 'status'}, 'CollectDpkgs', 'tag', 'sources' )
+        finally:
+            shutil.rmtree(chroot)
+        self.assertEqual(versdict, self._queryRecords())
+
+    def test_records(self):
+        versdict = self._queryRecords()
+        self.assertEqual(sorted(versdict['libc6']['tag']['dpkg'].keys()), ['amd64', 'i386'])
+        self.assertEqual(versdict['libgcc-s1']['tag']['dpkg']['i386']['VERSION'], '12.1.0')
+        self.assertEqual(versdict['perl-base']['tag']['dpkg']['amd64'], {
+            'PACKAGE' : 'perl-base', 'VERSION' : '1:5.34.0',
+            'RELEASE' : '3ubuntu1', 'ARCH' : 'amd64' })
+        self.assertEqual(versdict['python3-apt']['tag']['dpkg']['amd64']['RELEASE'], 'ubuntu1')
+        #Removed packages that dpkg still knows are listed
+        self.assertIn('libssl-dev', versdict)
+        self.assertIn('nginx-common', versdict)
+        self.assertNotIn('oldpkg', versdict)
+
+    @unittest.skipUnless(_hasAmd64DpkgQuery(), "needs dpkg-query on amd64")
+    def test_dpkgQuery(self):
+        output = subprocess.check_output(
+            ['dpkg-query', '--admindir=%s' % FIXTURES, '--show', '-f', DPKG_QUERY_FORMAT],
+            stderr=open(os.devnull, 'w') )
+        with open(DPKG_QUERY_OUT) as f:
+            self.assertEqual(output, f.read())
+
+if __name__ == '__main__':
+    unittest.main()
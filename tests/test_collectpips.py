@@ -0,0 +1,283 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion import CommandLines
+from Csversion import VenvFinder
+from CsversionModules.CollectPips import CollectPips
+
+class CollectPipsMetadataTest(unittest.TestCase):
+    """A root with a python3.10 and a python2.7, with different versions
+       of foo, the way Debian lays out their packages"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.home = os.environ.get('HOME')
+        os.environ['HOME'] = '/home/user'
+        self.collector = CollectPips(logging)
+        self._python('python3', 'python3.10')
+        self._python('python2', 'python2.7')
+        self._dist('usr/lib/python3/dist-packages', 'foo', '1.0')
+        self._dist('usr/lib/python3/dist-packages', 'Bar', '2.0')
+        self._dist('usr/lib/python3/dist-packages', 'pip', '22.0')
+        self._dist('usr/local/lib/python3.10/dist-packages', 'Bar', '3.0')
+        self._egg('usr/lib/python3/dist-packages', 'baz', '0.1')
+        self._dist('usr/lib/python2.7/dist-packages', 'foo', '2.0')
+        self._dist('usr/lib/python2.7/dist-packages', 'py2only', '1.0')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        if self.home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.home
+
+    def _path(self, path):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def _python(self, link, name):
+        with open(self._path('usr/bin/' + name), 'w') as f:
+            f.write('')
+        os.symlink(name, self._path('usr/bin/' + link))
+
+    def _pip(self, shebang):
+        with open(self._path('usr/bin/pip'), 'w') as f:
+            f.write('#!%s\nimport sys\n' % shebang)
+
+    def _dist(self, sitedir, name, version):
+        with open(self._path('%s/%s-%s.dist-info/METADATA' % (sitedir, name, version)), 'w') as f:
+            f.write('Metadata-Version: 2.1\nName: %s\nVersion: %s\n\nVersion: 0\n' % (name, version))
+
+    def _egg(self, sitedir, name, version):
+        with open(self._path('%s/%s-%s.egg-info' % (sitedir, name, version)), 'w') as f:
+            f.write('Metadata-Version: 1.0\nName: %s\nVersion: %s\n' % (name, version))
+
+    def _global(self):
+        versdict = self.collector.csversionPopulateManifest(
+            {}, {'chroot' : self.root, 'backend' : 'metadata'}, 'CollectPips', 'tag', 'sources' )
+        return dict([ (package, entry['tag']['pip']['__global']['VERSION'])
+            for package, entry in versdict.iteritems() ])
+
+    def test_python3(self):
+        self._pip('/usr/bin/python3')
+        self.assertEqual(self._global(), {'foo' : '1.0', 'Bar' : '3.0', 'baz' : '0.1'})
+
+    def test_envPython2(self):
+        self._pip('/usr/bin/env python2')
+        self.assertEqual(self._global(), {'foo' : '2.0', 'py2only' : '1.0'})
+
+    def test_userSiteFirst(self):
+        self._pip('/usr/bin/python3 -s')
+        self._dist('home/user/.local/lib/python3.10/site-packages', 'foo', '1.5')
+        self.assertEqual(self._global(), {'foo' : '1.5', 'Bar' : '3.0', 'baz' : '0.1'})
+
+    def test_absoluteSymlink(self):
+        os.remove(self._path('usr/bin/python3'))
+        os.symlink('/usr/bin/python3.10', self._path('usr/bin/python3'))
+        self._pip('/usr/bin/python3')
+        self.assertEqual(self._global(), {'foo' : '1.0', 'Bar' : '3.0', 'baz' : '0.1'})
+
+    def test_withoutPip(self):
+        #Every python's packages, the first version found of each
+        self.assertEqual(self._global(),
+            {'foo' : '2.0', 'Bar' : '3.0', 'baz' : '0.1', 'py2only' : '1.0'})
+
+def _pipFreezePath(sitedir):
+    #pip freeze of the distributions in sitedir, None without a pip
+    #  that has --path (19.2 and later)
+    try:
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'pip', 'freeze', '--path', sitedir],
+            stderr=open(os.devnull, 'w') )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output
+
+class CollectPipsFreezeNamesTest(unittest.TestCase):
+    """The metadata backend prints names and versions as pip freeze does"""
+
+    #(directory name, metadata Name, metadata Version), laid out the way
+    #  pip installs them
+    DISTS = [
+        ('Foo_Bar-1.0.dist-info', 'Foo_Bar', '1.0'),
+        ('typing_extensions-3.10.0.0.dist-info', 'typing_extensions', '3.10.0.0'),
+        ('Baz-1.0.0_Beta1.dist-info', 'Baz', '1.0.0-Beta1'),
+        ('zope.interface-4.7.1.dist-info', 'zope.interface', '4.7.1'),
+        ('Odd_Egg-2.0.post1-py2.7.egg-info', 'Odd Egg', '2.0-post1') ]
+
+    def setUp(self):
+        self.sitedir = tempfile.mkdtemp()
+        for directory, name, version in self.DISTS:
+            path = os.path.join(self.sitedir, directory)
+            os.makedirs(path)
+            metadata = 'PKG-INFO' if directory.endswith('.egg-info') else 'METADATA'
+            with open(os.path.join(path, metadata), 'w') as f:
+                f.write('Metadata-Version: 2.1\nName: %s\nVersion: %s\n\n' % (name, version))
+
+    def tearDown(self):
+        shutil.rmtree(self.sitedir)
+
+    def _specs(self):
+        return sorted(CollectPips(logging)._metadataSpecs([self.sitedir]), key=str.lower)
+
+    def test_normalized(self):
+        self.assertEqual(self._specs(), [
+            'Baz==1.0.0b1',
+            'Foo-Bar==1.0',
+            'Odd-Egg==2.0.post1',
+            'typing-extensions==3.10.0.0',
+            'zope.interface==4.7.1' ])
+
+    def test_sameAsPipFreeze(self):
+        frozen = _pipFreezePath(self.sitedir)
+        if frozen is None:
+            self.skipTest("needs pip freeze --path")
+        self.assertEqual(
+            self._specs(),
+            sorted([ line for line in frozen.splitlines() if len(line) > 0 ], key=str.lower) )
+
+class CollectPipsFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'root')
+        self.options = {
+            'chroot' : self.root,
+            'find-venvs' : 'True',
+            '**cache-dir' : os.path.join(self.tempdir, 'cache') }
+        self.collector = CollectPips(logging)
+        os.makedirs(os.path.join(self.root, 'usr/lib/python3/dist-packages'))
+        self._venv('opt/venvs/one')
+        VenvFinder.VenvFinder.MOUNTS = os.devnull
+
+    def tearDown(self):
+        del VenvFinder.VenvFinder.MOUNTS
+        shutil.rmtree(self.tempdir)
+
+    def _venv(self, path):
+        os.makedirs(os.path.join(self.root, path, 'lib/python3.10/site-packages'))
+        os.makedirs(os.path.join(self.root, path, 'bin'))
+        with open(os.path.join(self.root, path, 'bin/activate_this.py'), 'w') as f:
+            f.write('')
+
+    def _fingerprint(self):
+        return self.collector.csversionInputFingerprint(self.options, 'CollectPips', 'tag', 'sources')
+
+    def _touch(self, path, mtime):
+        os.utime(os.path.join(self.root, path), (mtime, mtime))
+
+    def test_cachedVenvsNotSearched(self):
+        #Nothing to go on before a search
+        self.assertEqual(self._fingerprint(), None)
+        self.assertEqual(self.collector._venvFinder(self.options, self.root).find(), ['/opt/venvs/one'])
+        find = VenvFinder.VenvFinder.find
+        def noSearch(finder):
+            self.fail("The venvs were searched for")
+        VenvFinder.VenvFinder.find = noSearch
+        try:
+            fingerprint = self._fingerprint()
+            self.assertEqual(fingerprint[0], ('/opt/venvs/one',))
+            self.assertEqual(self._fingerprint(), fingerprint)
+            #A package installed in the venv
+            self._touch('opt/venvs/one/lib/python3.10/site-packages', 1)
+            changed = self._fingerprint()
+            self.assertNotEqual(changed, fingerprint)
+            #A venv next to it
+            self._touch('opt/venvs', 1)
+            self.assertNotEqual(self._fingerprint(), changed)
+        finally:
+            VenvFinder.VenvFinder.find = find
+
+class NoLines(object):
+    #Stands in for the global pip freeze
+    returncode = 0
+    err = ''
+
+    def __init__(self, command, log, shell=False):
+        pass
+
+    def __iter__(self):
+        return iter([])
+
+class CollectPipsVenvOrderTest(unittest.TestCase):
+    """Venvs frozen concurrently are added in the order they were found"""
+
+    VENVS = [ '/opt/venvs/v%d' % index for index in range(6) ]
+
+    def setUp(self):
+        self.collector = CollectPips(logging)
+        self.appended = []
+        self.finished = []
+        lock = threading.Lock()
+        venvs = self.VENVS
+        class Finder(object):
+            def find(self):
+                return list(venvs)
+        self.collector._venvFinder = lambda options, mountpath: Finder()
+        def freezeVenv(grockCommand, venv):
+            #The later venvs finish first
+            time.sleep(0.02 * (len(venvs) - venvs.index(venv)))
+            with lock:
+                self.finished.append(venv)
+            return [ 'pkg%d==1.0' % venvs.index(venv), 'shared==%d' % venvs.index(venv) ]
+        self.collector._freezeVenv = freezeVenv
+        appendPip = self.collector._appendPip
+        def recordingAppendPip(tag, versdict, virtualenv, specs):
+            self.appended.append(virtualenv)
+            return appendPip(tag, versdict, virtualenv, specs)
+        self.collector._appendPip = recordingAppendPip
+        self.commandLines = CommandLines.CommandLines
+        CommandLines.CommandLines = NoLines
+
+    def tearDown(self):
+        CommandLines.CommandLines = self.commandLines
+
+    def _populate(self, workers):
+        del self.appended[:]
+        del self.finished[:]
+        return self.collector.csversionPopulateManifest(
+            {},
+            {'chroot' : '/nonexistent', 'find-venvs' : 'True', 'venv-collect-workers' : str(workers)},
+            'CollectPips', 'tag', 'sources' )
+
+    def test_venvOrder(self):
+        serial = self._populate(1)
+        self.assertEqual(self.finished, self.VENVS)
+        self.assertEqual(self.appended, ['__global'] + self.VENVS)
+        for workers in (2, 6):
+            parallel = self._populate(workers)
+            self.assertNotEqual(self.finished, self.VENVS)
+            self.assertEqual(self.appended, ['__global'] + self.VENVS)
+            self.assertEqual(parallel, serial)
+        self.assertEqual(sorted(serial['shared']['tag']['pip'].keys()), self.VENVS)
+        self.assertEqual(serial['pkg3']['tag']['pip']['/opt/venvs/v3']['VERSION'], '1.0')
+
+if __name__ == '__main__':
+    unittest.main()
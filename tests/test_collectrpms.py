@@ -0,0 +1,112 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from CsversionModules.CollectRpms import CollectRpms, sqlite3
+
+#rpmdb.sqlite holds, in rpm's Packages table, the headers of packages
+#  built by rpmbuild for the rpmlint test suite (test/binary of the
+#  rpmlint 2.10.0 release).  rpm-qa.out is what
+#  rpm -qa --qf '%{NAME} %{VERSION} %{RELEASE} %{ARCH}\n' lists for
+#  them, as read from the packages with the rpmfile python module.
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'rpm')
+RPMDB = os.path.join(FIXTURES, 'rpmdb.sqlite')
+RPM_QA_OUT = os.path.join(FIXTURES, 'rpm-qa.out')
+
+@unittest.skipIf(sqlite3 is None, "needs the python sqlite3 module")
+class CollectRpmsRpmdbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = CollectRpms(logging)
+
+    def _blobs(self):
+        connection = sqlite3.connect(RPMDB)
+        try:
+            return [ str(blob) for (blob,) in connection.execute("SELECT blob FROM Packages") ]
+        finally:
+            connection.close()
+
+    def test_rpmdbLinesMatchRpmQa(self):
+        with open(RPM_QA_OUT) as f:
+            expected = f.read().splitlines()
+        self.assertEqual(list(self.collector._rpmdbLines(RPMDB)), expected)
+
+    def test_rpmdbBackendRecords(self):
+        chroot = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(chroot, 'var', 'lib', 'rpm'))
+            shutil.copy(RPMDB, os.path.join(chroot, CollectRpms.RPMDB_FILE))
+            versdict = self.collector.csversionPopulateManifest(
+                {}, {'chroot' : chroot, 'backend' : 'rpmdb'}, 'CollectRpms', 'tag', 'sources' )
+        finally:
+            shutil.rmtree(chroot)
+        expected = {}
+        with open(RPM_QA_OUT) as f:
+            for line in f:
+                self.collector._addRpm(expected, 'tag', line)
+        self.assertEqual(versdict, expected)
+        self.assertEqual(versdict['ngircd']['tag']['rpm']['x86_64'], {
+            'PACKAGE' : 'ngircd', 'VERSION' : '22',
+            'RELEASE' : '2.fc22', 'ARCH' : 'x86_64' })
+
+    def test_readOnly(self):
+        chroot = tempfile.mkdtemp()
+        try:
+            #Characters a file: URI gives a meaning to
+            dbpath = os.path.join(chroot, 'a ?#%b.sqlite')
+            shutil.copy(RPMDB, dbpath)
+            connection = self.collector._connectRpmdb(dbpath)
+            try:
+                self.assertEqual(connection.execute("SELECT count(*) FROM Packages").fetchall(), [(6,)])
+                self.assertRaises(sqlite3.OperationalError, connection.execute, "DELETE FROM Packages")
+            finally:
+                connection.close()
+            self.assertEqual(os.listdir(chroot), ['a ?#%b.sqlite'])
+        finally:
+            shutil.rmtree(chroot)
+
+    def test_noReadOnlyUris(self):
+        self.collector._readOnlyUris = lambda: False
+        self.assertRaises(sqlite3.Error, self.collector._connectRpmdb, RPMDB)
+
+    def test_headerStrings(self):
+        blob = self._blobs()[0]
+        self.assertEqual(
+            self.collector._headerStrings(blob, (CollectRpms.RPMTAG_NAME, CollectRpms.RPMTAG_ARCH)),
+            {CollectRpms.RPMTAG_NAME : 'hello', CollectRpms.RPMTAG_ARCH : 'x86_64'} )
+
+    def test_malformedHeaders(self):
+        blob = self._blobs()[0]
+        il, dl = struct.unpack_from('>ii', blob, 0)
+        tags = (CollectRpms.RPMTAG_NAME,)
+        #Cut short in the data store and in the index
+        self.assertRaises(ValueError, self.collector._headerStrings, blob[:-1], tags)
+        self.assertRaises(ValueError, self.collector._headerStrings, blob[:8 + 16 * il - 4], tags)
+        #A data length that doesn't fit the blob
+        self.assertRaises(ValueError, self.collector._headerStrings,
+            struct.pack('>ii', il, dl + 1) + blob[8:], tags)
+
+if __name__ == '__main__':
+    unittest.main()
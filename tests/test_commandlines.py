@@ -0,0 +1,47 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.CommandLines import CommandLines
+
+class CommandLinesTest(unittest.TestCase):
+
+    def test_lines(self):
+        lines = CommandLines(['sh', '-c', 'echo one; echo two >&2; printf "two\\nthree"; exit 3'], logging)
+        self.assertEqual(list(lines), ['one', 'two', 'three'])
+        self.assertEqual(lines.returncode, 3)
+        self.assertEqual(lines.err, 'two\n')
+
+    def test_shell(self):
+        lines = CommandLines('seq 3 | tac', logging, shell=True)
+        self.assertEqual(list(lines), ['3', '2', '1'])
+        self.assertEqual(lines.returncode, 0)
+
+    def test_manyLines(self):
+        lines = CommandLines(['seq', '200000'], logging)
+        count = 0
+        for line in lines:
+            count += 1
+        self.assertEqual(count, 200000)
+        self.assertEqual(line, '200000')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,330 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion import CommandLines
+from Csversion.ConfigDriver import ConfigDriver
+import CsversionModules
+
+class Sleeper:
+    """A section that sleeps for its 'seconds' option in a child process"""
+
+    #The pid of every sleep started
+    pids = []
+
+    def __init__(self, log):
+        self.log = log
+
+    def defaultPrefix(self):
+        return 'product.capture'
+
+    def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
+        lines = iter(CommandLines.CommandLines(
+            ['sh', '-c', 'echo $$; exec sleep %s' % options['seconds']], self.log ))
+        self.pids.append(int(next(lines)))
+        for line in lines:
+            pass
+        manifest[tag] = {'slept' : options['seconds']}
+        return manifest
+
+CsversionModules.register('Sleeper', __name__)
+
+class Counted:
+    """A section recording its 'value' option under product.<tag> and in a
+       list, its inputs only change when the class' inputs do"""
+
+    #The number of times each tag was captured
+    runs = {}
+    inputs = 1
+
+    def __init__(self, log):
+        self.log = log
+
+    def defaultPrefix(self):
+        return 'sources'
+
+    def csversionInputFingerprint(self, options, key, tag, prefix):
+        if options.get('fingerprint', 'True') != 'True':
+            return None
+        return self.inputs
+
+    def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
+        self.runs[tag] = self.runs.get(tag, 0) + 1
+        package = manifest.setdefault('shared', {}).setdefault('tag', {})
+        package[tag] = {'value' : options['value'], 'run' : self.runs[tag]}
+        package.setdefault('notes', []).append(tag)
+        package['last'] = tag
+        return manifest
+
+CsversionModules.register('Counted', __name__)
+
+class Seen:
+    """A section recording which entries of its part of the manifest the
+       sections before it wrote"""
+
+    def __init__(self, log):
+        self.log = log
+
+    def defaultPrefix(self):
+        return 'sources'
+
+    def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
+        manifest[tag] = {'saw' : sorted(manifest.keys())}
+        return manifest
+
+CsversionModules.register('Seen', __name__)
+
+class ConfigDriverTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        Sleeper.pids = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _execute(self, text, workers=1, timeout=None):
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write(text)
+        manifest = {}
+        start = time.time()
+        ConfigDriver([path], logging, manifest, workers, timeout).execute()
+        return manifest, time.time() - start
+
+    def _assertKilled(self, pid):
+        #The killed sleep is reaped by its abandoned section thread
+        for _ in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return
+            time.sleep(0.1)
+        self.fail("sleep %d was not killed" % pid)
+
+    def test_hungSectionDoesNotStallTheOthers(self):
+        manifest, elapsed = self._execute("""
+[Sleeper@hung product.metadata]
+seconds = 30
+
+[Setter@after product.metadata]
+name = after
+
+[Sleeper@quick product.metadata]
+seconds = 0
+""", workers=1, timeout=1)
+        self.assertLess(elapsed, 10)
+        metadata = manifest['product']['metadata']
+        self.assertNotIn('hung', metadata)
+        self.assertEqual(metadata['after'], {'name' : 'after'})
+        self.assertEqual(metadata['quick'], {'slept' : '0'})
+        self._assertKilled(Sleeper.pids[0])
+
+    def test_sectionTimeoutOption(self):
+        manifest, elapsed = self._execute("""
+[Sleeper@quick product.metadata]
+seconds = 0.2
+
+[Sleeper@hung product.metadata]
+seconds = 30
+**timeout = 0.5
+""", workers=2)
+        self.assertLess(elapsed, 10)
+        metadata = manifest['product']['metadata']
+        self.assertEqual(metadata['quick'], {'slept' : '0.2'})
+        self.assertNotIn('hung', metadata)
+
+    def test_timeoutCountsFromTheSectionStart(self):
+        #Each section fits its timeout, not all of them one after another
+        manifest, elapsed = self._execute("""
+[Sleeper@first product.metadata]
+seconds = 0.6
+
+[Sleeper@second product.metadata]
+seconds = 0.6
+""", workers=1, timeout=1)
+        metadata = manifest['product']['metadata']
+        self.assertEqual(sorted(metadata.keys()), ['first', 'second'])
+
+class ConfigDriverInPlaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'csversionfile')
+        with open(self.path, 'w') as f:
+            f.write("[Counted@first]\nvalue = 1\n\n[Seen@second]\n")
+        Counted.runs = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_serialSectionsSeeEarlierOnes(self):
+        manifest = {}
+        ConfigDriver([self.path], logging, manifest).execute()
+        self.assertEqual(manifest['sources']['second'], {'saw' : ['shared']})
+
+    def test_ownResultsWhenConcurrent(self):
+        manifest = {}
+        ConfigDriver([self.path], logging, manifest, 2).execute()
+        self.assertEqual(manifest['sources']['second'], {'saw' : []})
+        self.assertEqual(manifest['sources']['shared']['tag']['first']['value'], '1')
+
+class ConfigDriverIncrementalTest(unittest.TestCase):
+
+    CSVERSIONFILE = """
+[Counted@reused]
+value = 1
+
+[Counted@fresh]
+value = 2
+fingerprint = False
+"""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        Counted.runs = {}
+        Counted.inputs = 1
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _execute(self, text, incremental=True, workers=1):
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write(text)
+        manifest = {}
+        ConfigDriver([path], logging, manifest, workers, None, self.cachedir, incremental).execute()
+        return manifest
+
+    def _expected(self, reusedRun, freshRun):
+        return {'tag' : {
+            'reused' : {'value' : '1', 'run' : reusedRun},
+            'fresh' : {'value' : '2', 'run' : freshRun},
+            'notes' : ['reused', 'fresh'],
+            'last' : 'fresh' }}
+
+    def test_reusedAndFreshMerge(self):
+        for run in range(1, 4):
+            manifest = self._execute(self.CSVERSIONFILE)
+            self.assertEqual(Counted.runs, {'reused' : 1, 'fresh' : run})
+            self.assertEqual(manifest['sources']['shared'], self._expected(1, run))
+        Counted.inputs = 2
+        manifest = self._execute(self.CSVERSIONFILE, workers=2)
+        self.assertEqual(Counted.runs, {'reused' : 2, 'fresh' : 4})
+        self.assertEqual(manifest['sources']['shared'], self._expected(2, 4))
+
+    def test_sameAsFullCapture(self):
+        self._execute(self.CSVERSIONFILE)
+        incremental = self._execute(self.CSVERSIONFILE)
+        Counted.runs = {'reused' : 0, 'fresh' : 1}
+        for workers in (1, 2):
+            full = self._execute(self.CSVERSIONFILE, False, workers)
+            self.assertEqual(full['sources'], incremental['sources'])
+            Counted.runs = {'reused' : 0, 'fresh' : 1}
+
+    def test_sharedCacheDirIsNotUsed(self):
+        self._execute(self.CSVERSIONFILE)
+        os.chmod(self.cachedir, 0777)
+        self._execute(self.CSVERSIONFILE)
+        self.assertEqual(Counted.runs, {'reused' : 2, 'fresh' : 2})
+
+    def test_runOptionsAreNotKeys(self):
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write(self.CSVERSIONFILE)
+        driver = ConfigDriver([path], logging, {}, 1, None, self.cachedir, True)
+        section = driver._prepareSections({})[0]
+        cachepath = driver._sectionCachePath(section)
+        section.options['**container-output'] = {'dpkg' : (['bash 4.3'], 0)}
+        self.assertEqual(driver._sectionCachePath(section), cachepath)
+        section.options['value'] = '3'
+        self.assertNotEqual(driver._sectionCachePath(section), cachepath)
+
+class ConfigDriverLocalModulesTest(unittest.TestCase):
+    """CsversionLocalModules, with a module of each kind, on sys.path"""
+
+    MODULES = {
+        '__init__.py' : "",
+        'Local.py' : """
+class Local:
+    def __init__(self, log):
+        self.log = log
+
+    def defaultPrefix(self):
+        return 'product.capture'
+
+    def csversionPopulateManifest(self, manifest, options, key, tag, prefix):
+        manifest[tag] = {'local' : options['value']}
+        return manifest
+""",
+        'Broken.py' : "import CsversionNoSuchDependency\n" }
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        package = os.path.join(self.tempdir, 'CsversionLocalModules')
+        os.mkdir(package)
+        for name, text in self.MODULES.iteritems():
+            with open(os.path.join(package, name), 'w') as f:
+                f.write(text)
+        sys.path.insert(0, self.tempdir)
+
+    def tearDown(self):
+        sys.path.remove(self.tempdir)
+        for name in list(sys.modules):
+            if name.split('.')[0] == 'CsversionLocalModules':
+                del sys.modules[name]
+        shutil.rmtree(self.tempdir)
+
+    def _execute(self, text):
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write(text)
+        manifest = {}
+        ConfigDriver([path], logging, manifest).execute()
+        return manifest
+
+    def test_localModule(self):
+        manifest = self._execute("[Local@mine product.metadata]\nvalue = 1\n")
+        self.assertEqual(manifest['product']['metadata']['mine'], {'local' : '1'})
+
+    def test_missingModule(self):
+        with self.assertRaises(ValueError):
+            self._execute("[Missing@mine product.metadata]\n")
+
+    def test_moduleImportErrorIsRaised(self):
+        with self.assertRaises(ImportError) as raised:
+            self._execute("[Broken@mine product.metadata]\n")
+        self.assertIn('CsversionNoSuchDependency', str(raised.exception))
+
+    def test_packageImportErrorIsRaised(self):
+        with open(os.path.join(self.tempdir, 'CsversionLocalModules', '__init__.py'), 'w') as f:
+            f.write("from Broken import *\n")
+        with self.assertRaises(ImportError) as raised:
+            self._execute("[Local@mine product.metadata]\nvalue = 1\n")
+        self.assertIn('CsversionNoSuchDependency', str(raised.exception))
+
+if __name__ == '__main__':
+    unittest.main()
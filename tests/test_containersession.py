@@ -0,0 +1,182 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.ContainerSession import ContainerSession
+from Csversion.ConfigDriver import ConfigDriver
+
+#docker and sudo shims that run the commands on this system
+SHIMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'bin')
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def _hasDpkgQuery():
+    try:
+        subprocess.check_output(['dpkg-query', '--version'])
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+class ContainerSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.shimlog = os.path.join(self.tempdir, 'docker.log')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = SHIMS + os.pathsep + os.environ['PATH']
+        os.environ['DOCKER_SHIM_LOG'] = self.shimlog
+        self.handler = RecordingHandler()
+        self.log = logging.getLogger('test_containersession')
+        self.log.setLevel(logging.DEBUG)
+        self.log.addHandler(self.handler)
+        self.log.propagate = False
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tempdir)
+
+    def _execs(self):
+        if not os.path.exists(self.shimlog):
+            return []
+        with open(self.shimlog) as f:
+            return f.read().splitlines()
+
+    def _run(self, session, timeout=None, names=None):
+        #Reads the output of the queries named, all of them in order by
+        #  default, returns {name : (output lines, return code)}
+        if names is None:
+            names = [ name for name, _ in session.queries ]
+        results = {}
+        session.start(timeout)
+        try:
+            for name in names:
+                output = session.output(name)
+                results[name] = (list(output), output.returncode)
+        finally:
+            session.finish()
+        return results
+
+    def test_queries(self):
+        session = ContainerSession('web', self.log)
+        session.add('first', 'echo one; echo two')
+        session.add('failing', 'echo out; echo broken >&2; exit 3')
+        session.add('blank', 'echo; echo a; echo; echo')
+        session.add('empty', 'true')
+        session.add('last', "printf 'no newline'")
+        results = self._run(session)
+        self.assertEqual(results, {
+            'first' : (['one', 'two'], 0),
+            'failing' : (['out'], 3),
+            'blank' : (['', 'a', '', ''], 0),
+            'empty' : ([], 0),
+            'last' : (['no newline'], 0) })
+        self.assertEqual(self._execs(), ['exec web'])
+        self.assertIn("Query 'failing' in container 'web' wrote to stderr:\nbroken", self.handler.messages)
+
+    def test_unreadQueriesAreSkipped(self):
+        session = ContainerSession('web', self.log)
+        session.add('first', 'echo one')
+        session.add('second', 'echo two')
+        session.add('third', 'echo three')
+        results = self._run(session, names=['second'])
+        self.assertEqual(results, {'second' : (['two'], 0)})
+        #Its lines are gone, but it was seen to finish
+        self.assertEqual(list(session.output('first')), [])
+        self.assertEqual(session.output('first').returncode, 0)
+        self.assertEqual(session.output('third').returncode, None)
+
+    def test_linesStreamIn(self):
+        session = ContainerSession('web', self.log)
+        session.add('slow', 'echo first; sleep 2; echo second')
+        session.start()
+        try:
+            start = time.time()
+            lines = iter(session.output('slow'))
+            self.assertEqual(next(lines), 'first')
+            self.assertLess(time.time() - start, 1.5)
+            self.assertEqual(session.output('slow').returncode, None)
+            self.assertEqual(list(lines), ['second'])
+            self.assertGreater(time.time() - start, 1.5)
+            self.assertEqual(session.output('slow').returncode, 0)
+        finally:
+            session.finish()
+
+    def test_timeout(self):
+        os.environ['DOCKER_SHIM_DELAY'] = '30'
+        session = ContainerSession('web', self.log)
+        session.add('slow', 'echo never')
+        start = time.time()
+        results = self._run(session, 1)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(results, {'slow' : ([], None)})
+
+    def test_killedMidQuery(self):
+        session = ContainerSession('web', self.log)
+        session.add('partial', 'echo started; sleep 30; echo never')
+        session.add('after', 'echo never')
+        start = time.time()
+        results = self._run(session, 1)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(results, {'partial' : (['started'], None), 'after' : ([], None)})
+
+    @unittest.skipUnless(_hasDpkgQuery(), "needs dpkg-query")
+    def test_batchedSections(self):
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write("[CollectDpkgs@web]\ndocker = web\n\n[CollectRpms@web]\ndocker = web\n")
+        manifest = {}
+        ConfigDriver([path], self.log, manifest).execute()
+        self.assertEqual(self._execs(), ['exec web'])
+        #The shim runs the queries on this host, so they match a direct run
+        hostPath = os.path.join(self.tempdir, 'hostfile')
+        with open(hostPath, 'w') as f:
+            f.write("[CollectDpkgs@web]\n")
+        expected = {}
+        ConfigDriver([hostPath], self.log, expected).execute()
+        self.assertGreater(len(expected['sources']), 0)
+        self.assertEqual(manifest['sources'], expected['sources'])
+
+    def test_sectionTimeoutBoundsTheExec(self):
+        os.environ['DOCKER_SHIM_DELAY'] = '30'
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write("[CollectDpkgs@web]\ndocker = web\n**timeout = 1\n")
+        manifest = {}
+        start = time.time()
+        ConfigDriver([path], self.log, manifest).execute()
+        self.assertLess(time.time() - start, 10)
+        self.assertNotIn('sources', manifest)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,682 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import StringIO
+import datetime
+import json
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion import Csversion
+from Csversion.Csversion import DiffProcessor, Manifest, TagTimeline, timeKey, versionKey
+from Csversion.ManifestCache import ManifestCache
+
+#Written the way yaml.safe_dump writes a manifest by default, the list
+#  under notes is an indentless sequence
+INDENTLESS = """product:
+  metadata:
+    prod:
+      name: prod
+      version-full: 1.0.1
+notes:
+- first
+- second: 2
+  third: 3
+-
+  - nested
+sources:
+  bash:
+    prod:
+      dpkg:
+        amd64: {PACKAGE: bash, VERSION: '4.3', ARCH: amd64}
+"""
+
+class ManifestSectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, text):
+        path = os.path.join(self.tempdir, 'test.csversion')
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_indentlessSequenceStaysInItsSection(self):
+        chunks = Manifest([])._splitSections(INDENTLESS)
+        self.assertEqual(sorted(chunks.keys()), ['notes', 'product', 'sources'])
+        self.assertTrue(chunks['notes'].startswith('notes:\n- first\n'))
+        self.assertTrue(chunks['notes'].endswith('  - nested\n'))
+
+    def test_indentlessSequenceSectionsLoad(self):
+        path = self._write(INDENTLESS)
+        full = Manifest([path])
+        for sections in (['notes'], ['product', 'sources'], ['notes', 'sources']):
+            manifest = Manifest([], sections=sections)
+            self.assertEqual(
+                manifest._parseManifestFile(path),
+                dict([ (k, v) for k, v in full.iteritems() if k in sections ]) )
+
+    def test_documentMarker(self):
+        chunks = Manifest([])._splitSections('---\n' + INDENTLESS)
+        self.assertEqual(sorted(chunks.keys()), ['notes', 'product', 'sources'])
+
+    def test_topLevelSequenceIsNotSplit(self):
+        self.assertEqual(Manifest([])._splitSections('- a\n- b\n'), None)
+        self.assertEqual(Manifest([])._splitSections('---\n- a\nb: 1\n'), None)
+
+def _ruleCompare(version1, version2):
+    #The ordering rules of versionKey, compared a pair at a time
+    if version1 is None or version2 is None:
+        return cmp(version1 is not None, version2 is not None)
+    parts1 = str(version1).split('.')
+    parts2 = str(version2).split('.')
+    for part1, part2 in zip(parts1, parts2):
+        split1 = part1.split('-' if '-' in part1 else '+', 1)
+        split2 = part2.split('-' if '-' in part2 else '+', 1)
+        main1, main2 = split1[0], split2[0]
+        if main1.isdigit() != main2.isdigit():
+            return -1 if main1.isdigit() else 1
+        if main1.isdigit():
+            result = cmp(int(main1), int(main2))
+        else:
+            result = cmp(main1, main2)
+        if result == 0:
+            result = cmp(len(split1), len(split2)) or cmp(split1[1:], split2[1:])
+        if result != 0:
+            return result
+    return cmp(len(parts1), len(parts2))
+
+class VersionKeyTest(unittest.TestCase):
+
+    SAMPLE = [ None, '', '0', '1', '01', '1.0', '1.00', '1.0.0', '1.0-1',
+        '1.0-2', '1.0-10', '1.0+b', '1.0+a', '1.0-a+b', '1.0+a-b', '1.2',
+        '1.9', '1.10', '1.10a', '1.a', '1.rc1', '1.beta', '2', '10', 'rc',
+        'A', '1.0.0.0', '2.1.5-3ubuntu1' ]
+
+    def _order(self, version1, version2):
+        return cmp(versionKey(version1), versionKey(version2))
+
+    def test_numericParts(self):
+        self.assertEqual(self._order('1.10', '1.9'), 1)
+        self.assertEqual(self._order('10', '2'), 1)
+        self.assertEqual(self._order('01', '1'), 0)
+
+    def test_numericBeforeAlpha(self):
+        self.assertEqual(self._order('1.9', '1.a'), -1)
+        self.assertEqual(self._order('1.99', '1.10a'), -1)
+        self.assertEqual(self._order('1.beta', '1.rc1'), -1)
+        self.assertEqual(self._order('10', 'A'), -1)
+
+    def test_partCounts(self):
+        self.assertEqual(self._order('1.0', '1.0.0'), -1)
+        self.assertEqual(self._order('1.2', '1.1.5'), 1)
+        self.assertEqual(self._order('1.0-1', '1.0.0'), 1)
+
+    def test_subParts(self):
+        self.assertEqual(self._order('1.0', '1.0-1'), -1)
+        self.assertEqual(self._order('1.0-1', '1.0-2'), -1)
+        #Sub parts compare as strings
+        self.assertEqual(self._order('1.0-10', '1.0-9'), -1)
+        self.assertEqual(self._order('1.0+a', '1.0+b'), -1)
+        #'-' splits before '+' does
+        self.assertEqual(versionKey('1.0+a-b')[1], ((1, '0+a'), ('b',)))
+        self.assertEqual(versionKey('1.0-a+b')[1], ((0, 0), ('a+b',)))
+
+    def test_none(self):
+        self.assertEqual(self._order(None, None), 0)
+        self.assertEqual(self._order(None, ''), -1)
+        self.assertEqual(self._order('0', None), 1)
+
+    def test_numbersFromYaml(self):
+        self.assertEqual(versionKey(1.1), versionKey('1.1'))
+        self.assertEqual(versionKey(1), versionKey('1'))
+        self.assertEqual(versionKey(1.0), versionKey('1.0'))
+        self.assertEqual(self._order(1, 1.0), -1)
+
+    def test_compareVersions(self):
+        manifest = Manifest([])
+        for version1 in self.SAMPLE:
+            for version2 in self.SAMPLE:
+                self.assertEqual(
+                    cmp(manifest.compareVersions(version1, version2), 0),
+                    self._order(version1, version2) )
+
+    def test_matchesRules(self):
+        for version1 in self.SAMPLE:
+            for version2 in self.SAMPLE:
+                self.assertEqual(
+                    self._order(version1, version2),
+                    _ruleCompare(version1, version2),
+                    (version1, version2) )
+
+    def test_sortIsStable(self):
+        versions = ['1.01', '1.1', '0.9', '1.001', '01.1', '2']
+        self.assertEqual(
+            sorted(versions, key=versionKey),
+            ['0.9', '1.01', '1.1', '1.001', '01.1', '2'] )
+        self.assertEqual(
+            sorted(reversed(versions), key=versionKey),
+            ['0.9', '01.1', '1.001', '1.1', '1.01', '2'] )
+
+class TimeKeyTest(unittest.TestCase):
+
+    #2018-01-01T00:00:00Z
+    EPOCH = 1514764800
+
+    def test_naiveIsUtc(self):
+        self.assertEqual(timeKey('2018-01-01T00:00:00'), self.EPOCH)
+        self.assertEqual(timeKey('2018-01-01T00:00:00Z'), self.EPOCH)
+        self.assertEqual(timeKey('2018-01-01 00:00:00z'), self.EPOCH)
+        self.assertEqual(timeKey('2018-01-01'), self.EPOCH)
+
+    def test_offsets(self):
+        self.assertEqual(timeKey('2018-01-01T01:00:00+01:00'), self.EPOCH)
+        self.assertEqual(timeKey('2017-12-31T19:00:00-05:00'), self.EPOCH)
+        self.assertEqual(timeKey('2018-01-01T05:30:00+0530'), self.EPOCH)
+        self.assertEqual(timeKey('2018-01-01T02:00:00+02'), self.EPOCH)
+
+    def test_fractions(self):
+        self.assertEqual(timeKey('2018-01-01T00:00:00.25'), self.EPOCH + 0.25)
+        self.assertEqual(timeKey('2018-01-01T00:00:00.5+01:00'), self.EPOCH - 3600 + 0.5)
+        self.assertEqual(timeKey('2018-01-01T00:00:00.'), self.EPOCH)
+
+    def test_yamlTimes(self):
+        Csversion._importYaml()
+        loaded = Csversion.yaml.load(
+            'aware: 2018-01-01T01:00:00+01:00\n'
+            'naive: 2018-01-01 00:00:00.5\n'
+            'date: 2018-01-01\n', Loader=Csversion.YamlLoader )
+        self.assertEqual(timeKey(loaded['aware']), self.EPOCH)
+        self.assertEqual(timeKey(loaded['naive']), self.EPOCH + 0.5)
+        self.assertEqual(timeKey(loaded['date']), self.EPOCH)
+        self.assertEqual(timeKey(datetime.datetime(2018, 1, 1)), self.EPOCH)
+
+    def test_unparseable(self):
+        for time in [None, 20180101, '', 'yesterday', '2018-13-01',
+          '2018-02-30', '2018-01-01T25:00:00', '2018-01-01T00:00:00 UTC']:
+            self.assertEqual(timeKey(time), None, time)
+        manifest = Manifest([])
+        self.assertRaises(ValueError, manifest.convertIsoToDateTime, 'yesterday')
+        #Unparseable times are older than any time
+        self.assertTrue(manifest.compareTimes('yesterday', '1970-01-01') < 0)
+        self.assertEqual(manifest.compareTimes('yesterday', None), 0)
+
+    def test_compareTimes(self):
+        manifest = Manifest([])
+        self.assertEqual(manifest.compareTimes('2018-01-01T01:00:00+01:00', '2018-01-01'), 0)
+        self.assertTrue(manifest.compareTimes('2018-01-01T00:00:00.1', '2018-01-01') > 0)
+        self.assertEqual(
+            manifest.convertIsoToDateTime('2018-01-01T01:00:00+01:00'),
+            datetime.datetime(2018, 1, 1) )
+
+def _release(version, time, packages):
+    #A manifest of the prod tag at version, packages maps name to version
+    text = """product:
+  metadata:
+    prod: {name: prod, version-full: '%s'}
+  build:
+    prod: {time: '%s'}
+sources:
+""" % (version, time)
+    for name, packageVersion in sorted(packages.items()):
+        text += """  %s:
+    prod:
+      dpkg:
+        amd64: {PACKAGE: %s, VERSION: '%s', ARCH: amd64}
+""" % (name, name, packageVersion)
+    return text
+
+def _tagged(tags, packages):
+    #A manifest of each of tags, mapping it to its (version, time), with
+    #  every package of packages under each of the tags
+    manifest = Manifest([])
+    manifest['product'] = {'metadata' : {}, 'build' : {}}
+    manifest['sources'] = {}
+    for tag, (version, time) in tags.items():
+        if version is not None:
+            manifest['product']['metadata'][tag] = {'version-full' : version}
+        if time is not None:
+            manifest['product']['build'][tag] = {'time' : time}
+        for name, packageVersion in packages.items():
+            manifest['sources'].setdefault(name, {})[tag] = {'VERSION' : packageVersion}
+    return manifest
+
+class ManifestSubsumeTest(unittest.TestCase):
+
+    def _subsume(self, *manifests):
+        Manifest([]).subsumeManifests(list(manifests))
+        return manifests
+
+    def test_olderIsSubsumed(self):
+        old, new = self._subsume(
+            _tagged({'prod' : ('1.0', '2018-01-01')}, {'bash' : '4.3'}),
+            _tagged({'prod' : ('2.0', '2018-02-01')}, {'bash' : '5.0'}) )
+        self.assertEqual(old['sources']['bash']['prod'],
+            {'__older' : {'1.0__2018-01-01' : {'VERSION' : '4.3'}}})
+        self.assertEqual(old['product']['metadata']['prod'],
+            {'__older' : {'1.0__2018-01-01' : {'version-full' : '1.0'}}})
+        self.assertEqual(new['sources']['bash']['prod'], {'VERSION' : '5.0'})
+        self.assertEqual(new['product']['metadata']['prod'], {'version-full' : '2.0'})
+
+    def test_versionBeforeTime(self):
+        newer, older = self._subsume(
+            _tagged({'prod' : ('1.10', '2018-01-01')}, {'bash' : '5.0'}),
+            _tagged({'prod' : ('1.9', '2018-06-01')}, {'bash' : '4.3'}) )
+        self.assertEqual(newer['sources']['bash']['prod'], {'VERSION' : '5.0'})
+        self.assertEqual(older['sources']['bash']['prod'].keys(), ['__older'])
+
+    def test_sameVersionLaterTimeWins(self):
+        later, earlier = self._subsume(
+            _tagged({'prod' : ('1.0', '2018-01-01T12:00:00+00:00')}, {'bash' : '5.0'}),
+            _tagged({'prod' : ('1.0', '2018-01-01T13:00:00+02:00')}, {'bash' : '4.3'}) )
+        self.assertEqual(later['sources']['bash']['prod'], {'VERSION' : '5.0'})
+        self.assertEqual(earlier['sources']['bash']['prod'],
+            {'__older' : {'1.0__2018-01-01T13:00:00+02:00' : {'VERSION' : '4.3'}}})
+
+    def test_tieGoesToTheLaterManifest(self):
+        manifests = self._subsume(*[
+            _tagged({'prod' : ('1.0', '2018-01-01')}, {'bash' : str(index)})
+            for index in range(3) ])
+        self.assertEqual(manifests[2]['sources']['bash']['prod'], {'VERSION' : '2'})
+        for manifest in manifests[:2]:
+            self.assertEqual(manifest['sources']['bash']['prod'].keys(), ['__older'])
+
+    def test_versionOrTimeOnly(self):
+        noTime, noVersion, neither = self._subsume(
+            _tagged({'prod' : ('1.0', None)}, {'bash' : '4.3'}),
+            _tagged({'prod' : (None, '2018-01-01')}, {'bash' : '5.0'}),
+            _tagged({'prod' : (None, None)}, {'bash' : '6.0'}) )
+        #No version is older than any version, the partial manifest is
+        #  left as it is
+        self.assertEqual(noTime['sources']['bash']['prod'], {'VERSION' : '4.3'})
+        self.assertEqual(noVersion['sources']['bash']['prod'],
+            {'__older' : {'None__2018-01-01' : {'VERSION' : '5.0'}}})
+        self.assertEqual(neither['sources']['bash']['prod'], {'VERSION' : '6.0'})
+
+    def test_eachTagOnItsOwn(self):
+        first, second = self._subsume(
+            _tagged({'a' : ('2.0', None), 'b' : ('1.0', None), 'c' : ('1.0', None)}, {'bash' : '1'}),
+            _tagged({'a' : ('1.0', None), 'b' : ('2.0', None)}, {'bash' : '2'}) )
+        self.assertEqual(first['sources']['bash'], {
+            'a' : {'VERSION' : '1'},
+            'b' : {'__older' : {'1.0__None' : {'VERSION' : '1'}}},
+            'c' : {'VERSION' : '1'} })
+        self.assertEqual(second['sources']['bash'], {
+            'a' : {'__older' : {'1.0__None' : {'VERSION' : '2'}}},
+            'b' : {'VERSION' : '2'} })
+
+    def test_historyIsKept(self):
+        old = _tagged({'prod' : ('1.0', None)}, {'bash' : '4.3'})
+        old['sources']['bash']['prod']['__older'] = {'0.9__None' : {'VERSION' : '4.2'}}
+        old, new = self._subsume(old, _tagged({'prod' : ('2.0', None)}, {'bash' : '5.0'}))
+        self.assertEqual(old['sources']['bash']['prod'], {'__older' : {
+            '0.9__None' : {'VERSION' : '4.2'},
+            '1.0__None' : {'VERSION' : '4.3'} }})
+
+    def test_joinedManifest(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for index, (version, time) in enumerate([
+              ('1.0', '2018-01-01'), ('1.0', '2018-01-01'), ('0.9', '2018-06-01') ]):
+                path = os.path.join(tempdir, '%d.csversion' % index)
+                with open(path, 'w') as f:
+                    f.write(_release(version, time, {'bash' : str(index)}))
+                paths.append(path)
+            joined = Manifest(paths)
+        finally:
+            shutil.rmtree(tempdir)
+        bash = joined['sources']['bash']['prod']
+        self.assertEqual(bash['dpkg']['amd64']['VERSION'], '1')
+        self.assertEqual(sorted(bash['__older'].keys()), ['0.9__2018-06-01', '1.0__2018-01-01'])
+        #Of the tied manifests, the history keeps the first
+        self.assertEqual(bash['__older']['1.0__2018-01-01']['dpkg']['amd64']['VERSION'], '0')
+
+class TagTimelineTest(unittest.TestCase):
+    """The timeline lookups against a scan of every __older entry"""
+
+    VERSIONS = [None, '1.0', '1.0.0', '1.2', '1.10', '2.0-1', '2.0-2', 'rc']
+    TIMES = [None, '2018-01-01', '2018-01-01T00:00:00Z', '2018-01-01T03:00:00+02:00',
+        '2018-02-01T00:00:00', '2018-02-01T00:00:00.5', '2019-01-01T00:00:00-01:00']
+
+    def setUp(self):
+        generator = random.Random(8)
+        self.manifest = Manifest([])
+        metadata = {}
+        build = {}
+        for tag in ['a', 'b', 'c', 'empty']:
+            olders = {}
+            for _ in range(0 if tag == 'empty' else generator.randint(1, 30)):
+                version = generator.choice(self.VERSIONS)
+                time = generator.choice(self.TIMES)
+                olders[self.manifest.olderKey(version, time)] = {'version-full' : version}
+            current = generator.choice(self.VERSIONS[1:])
+            metadata[tag] = {'version-full' : current, '__older' : olders}
+            build[tag] = {'time' : generator.choice(self.TIMES[1:])}
+        self.manifest['product'] = {'metadata' : metadata, 'build' : build}
+
+    def _scanOldest(self, specificVersion, specificDate):
+        #How captureAllOldestTagAges found them before the timelines
+        manifest = self.manifest
+        ages = manifest.captureAllTagAges()
+        for k in ages.keys():
+            oldestVersion, oldestDate, oldestKeypath, tags = ages[k]
+            for old in tags['__older-keys']:
+                version, date = manifest._splitOlderKey(old)
+                if specificVersion is not None and \
+                  manifest.compareVersions(version, specificVersion) != 0:
+                    continue
+                if specificDate is not None and \
+                  manifest.compareTimes(date, specificDate) < 0:
+                    continue
+                ans = manifest.compareVersions(oldestVersion, version)
+                if ans == 0:
+                    ans = manifest.compareTimes(oldestDate, date)
+                if ans > 0:
+                    oldestVersion, oldestDate = version, date
+                    oldestKeypath = (k, '__older', old)
+            ages[k] = (oldestVersion, oldestDate, oldestKeypath)
+        return ages
+
+    def _scanLatest(self):
+        manifest = self.manifest
+        ages = manifest.captureAllTagAges()
+        for k in ages.keys():
+            olders = ages[k][3]['__older-keys']
+            if len(olders) == 0:
+                continue
+            latest = olders[0]
+            for old in olders:
+                ans = manifest.compareVersions(*[ manifest._splitOlderKey(key)[0] for key in (latest, old) ])
+                if ans == 0:
+                    ans = manifest.compareTimes(*[ manifest._splitOlderKey(key)[1] for key in (latest, old) ])
+                if ans < 0:
+                    latest = old
+            ages[k] = manifest._splitOlderKey(latest) + ((k, '__older', latest),)
+        return ages
+
+    def test_oldest(self):
+        for version in self.VERSIONS + ['9.9']:
+            for time in self.TIMES + ['2030-01-01', 'not a time']:
+                self.assertEqual(
+                    self.manifest.captureAllOldestTagAges(version, time),
+                    self._scanOldest(version, time),
+                    (version, time) )
+
+    def test_latest(self):
+        self.assertEqual(self.manifest.captureAllLatestOldTagAges(), self._scanLatest())
+
+    def test_equalEntriesKeepTheirOrder(self):
+        timeline = TagTimeline([
+            ('1.0', '2018-01-01', 'first'),
+            ('1.0', '2018-01-01T00:00:00Z', 'second'),
+            ('01.0', '2018-01-01T01:00:00+01:00', 'third') ])
+        self.assertEqual(timeline.oldest()[3], 'first')
+        self.assertEqual(timeline.oldest('1.0', '2018-01-01')[3], 'first')
+        self.assertEqual(timeline.latest()[3], 'first')
+        self.assertEqual(timeline.oldest('2.0'), None)
+        self.assertEqual(timeline.oldest(None, '2018-01-02'), None)
+        self.assertEqual(TagTimeline([]).latest(), None)
+
+class DiffAgainstTest(unittest.TestCase):
+
+    OLD = {
+        'bash' : '4.3', 'curl' : '7.1', 'gone' : '1' }
+    NEW = {
+        'bash' : '4.3', 'curl' : '7.2', 'new' : '1' }
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.paths = []
+        for version, packages in (('1.0', self.OLD), ('2.0', self.NEW)):
+            path = os.path.join(self.tempdir, '%s.csversion' % version)
+            with open(path, 'w') as f:
+                f.write(_release(version, '2018-01-01T00:00:00', packages))
+                f.write("notes:\n- %s\n" % version)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _checkDiff(self, diff):
+        sources = diff['sources']
+        self.assertEqual(sorted(sources.keys()), ['curl', 'gone', 'new'])
+        self.assertEqual(sources['gone']['prod']['new'], {})
+        self.assertEqual(sources['gone']['prod']['old']['dpkg']['amd64']['VERSION'], '1')
+        self.assertEqual(sources['new']['prod']['old'], {})
+        self.assertEqual(sources['new']['prod']['new']['dpkg']['amd64']['VERSION'], '1')
+        self.assertEqual(sources['curl']['prod']['old']['dpkg']['amd64']['VERSION'], '7.1')
+        self.assertEqual(sources['curl']['prod']['new']['dpkg']['amd64']['VERSION'], '7.2')
+        self.assertEqual(
+            sorted(diff['product']['metadata']['prod']['new'].keys()),
+            ['name', 'version-full'] )
+
+    def test_addedRemovedChanged(self):
+        old, new = [ Manifest([path]) for path in self.paths ]
+        #History is not part of the diff
+        old['sources']['bash']['prod']['__older'] = {'4.2__2017-01-01' : {}}
+        self._checkDiff(new.diffAgainst(old, DiffProcessor())['diff'])
+
+    def _cli(self):
+        cli = Csversion.CsversionCli.__new__(Csversion.CsversionCli)
+        cli.log = Manifest([]).log
+        cli.cache = None
+        cli.diffprocessor = DiffProcessor()
+        return cli
+
+    def _gather(self, records):
+        diff = {}
+        for (key, part, tag), tagdiff in records:
+            diff.setdefault(key, {}).setdefault(part, {})[tag] = tagdiff
+        return diff
+
+    def test_nestedOlderIgnored(self):
+        old, new = [ Manifest([path]) for path in self.paths ]
+        new['sources']['bash']['prod']['dpkg']['__older'] = {'4.2__2017-01-01' : {}}
+        old['sources']['bash']['prod']['dpkg']['amd64']['__older'] = {'x' : 1}
+        self._checkDiff(new.diffAgainst(old, DiffProcessor())['diff'])
+
+    def test_diffFilesReadsEachFileOnce(self):
+        opened = []
+        def countingOpen(path, *args):
+            opened.append(path)
+            return open(path, *args)
+        Csversion.open = countingOpen
+        try:
+            records = list(self._cli().diffFiles(*self.paths))
+        finally:
+            del Csversion.open
+        self.assertEqual(sorted(opened), sorted(self.paths))
+        self.assertEqual([ path for path, _ in records ], sorted([ path for path, _ in records ]))
+        diff = self._gather(records)
+        self._checkDiff(diff)
+        old, new = [ Manifest([path]) for path in self.paths ]
+        self.assertEqual(diff, new.diffAgainst(old, DiffProcessor())['diff'])
+
+    def test_diffFilesLoadsAPackageAtATime(self):
+        loaded = []
+        load = Manifest.loadEntry
+        def recordingLoad(manifest, filepath, chunks, section, text):
+            loaded.append((section, text.split(':', 1)[0]))
+            return load(manifest, filepath, chunks, section, text)
+        Manifest.loadEntry = recordingLoad
+        try:
+            records = self._cli().diffFiles(*self.paths)
+            for path, _ in records:
+                if path[0] == 'sources':
+                    break
+            #Only what was needed for the first changed package, curl
+            self.assertEqual(loaded[-4:], [
+                ('sources', 'bash'), ('sources', 'bash'),
+                ('sources', 'curl'), ('sources', 'curl') ])
+            self.assertEqual(path, ('sources', 'curl', 'prod'))
+        finally:
+            Manifest.loadEntry = load
+
+    def test_diffFilesWithoutEntries(self):
+        #Sections that can't be split into entries are diffed whole
+        with open(self.paths[0], 'a') as f:
+            f.write("odd: {a: {b: 1}}\n")
+        with open(self.paths[1], 'w') as f:
+            f.write(_release('2.0', '2018-01-01T00:00:00', self.NEW).replace(
+                "\n  bash:", "\n  'bash':"))
+            f.write("notes:\n- 2.0\n")
+        diff = self._gather(self._cli().diffFiles(*self.paths))
+        self._checkDiff(diff)
+        self.assertEqual(diff['odd'], {'a' : {'b' : {'old' : 1, 'new' : {}}}})
+
+    def test_streamedOutputs(self):
+        records = list(self._cli().diffFiles(*self.paths))
+        expected = {'diff' : self._gather(records)}
+        for output, load in (
+          (Csversion.YamlOutput, lambda text: Csversion.yaml.load(text, Loader=Csversion.YamlLoader)),
+          (Csversion.JsonOutput, lambda text: json.loads(text)) ):
+            for emitted in (records, []):
+                out = output()
+                out.stream = StringIO.StringIO()
+                out.begin('diff')
+                for path, value in emitted:
+                    out.record(path, value)
+                out.end()
+                self.assertEqual(
+                    load(out.stream.getvalue()),
+                    expected if len(emitted) > 0 else {'diff' : {}},
+                    output.__name__ )
+        streamed = Csversion.XmlOutput()
+        streamed.stream = StringIO.StringIO()
+        streamed.begin('diff')
+        for path, value in records:
+            streamed.record(path, value)
+        streamed.end()
+        whole = Csversion.XmlOutput()
+        whole.stream = StringIO.StringIO()
+        whole.output(expected)
+        self.assertEqual(
+            sorted(streamed.stream.getvalue().splitlines()),
+            sorted(whole.stream.getvalue().splitlines()) )
+
+class ManifestParallelLoadTest(unittest.TestCase):
+
+    RELEASES = [
+        ('1.0', '2018-01-01T00:00:00', {'bash' : '4.3', 'curl' : '7.1'}),
+        ('1.1', '2018-02-01T00:00:00', {'bash' : '4.4', 'curl' : '7.1'}),
+        ('1.1', '2018-03-01T00:00:00', {'bash' : '4.4', 'zlib' : '1.2'}),
+        ('2.0', '2018-01-15T00:00:00', {'bash' : '5.0'}) ]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.paths = []
+        for index, (version, time, packages) in enumerate(self.RELEASES):
+            path = os.path.join(self.tempdir, '%d.csversion' % index)
+            with open(path, 'w') as f:
+                f.write(_release(version, time, packages))
+            self.paths.append(path)
+        #Another product, and a partial manifest without a version
+        path = os.path.join(self.tempdir, 'other.csversion')
+        with open(path, 'w') as f:
+            f.write(_release('9', '2018-01-01', {'vim' : '8'}).replace('prod', 'other'))
+        self.paths.append(path)
+        path = os.path.join(self.tempdir, 'partial.csversion')
+        with open(path, 'w') as f:
+            f.write("sources:\n  extra:\n    prod: {note: partial}\n")
+        self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sameAsSerial(self):
+        cache = ManifestCache(os.path.join(self.tempdir, 'cache'))
+        for paths in (self.paths, list(reversed(self.paths))):
+            serial = Manifest(paths, workers=1)
+            self.assertIn('__older', serial['sources']['bash']['prod'])
+            for workers, withCache in ((2, None), (4, None), (3, cache), (3, cache)):
+                parallel = Manifest(paths, workers=workers, cache=withCache)
+                self.assertEqual(dict(parallel), dict(serial))
+                self.assertEqual(
+                    parallel.diffManifest(DiffProcessor()),
+                    serial.diffManifest(DiffProcessor()) )
+
+    def test_sameSectionsAsSerial(self):
+        self.assertEqual(
+            dict(Manifest(self.paths, workers=3, sections=['product'])),
+            dict(Manifest(self.paths, workers=1, sections=['product'])) )
+
+class ManifestFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = ManifestCache(os.path.join(self.tempdir, 'cache'))
+        self.paths = []
+        for version, time, packages in [
+          ('1.0', '2018-01-01T00:00:00', {'bash' : '4.3', 'curl' : '7.1', 'gone' : '1'}),
+          ('2.0', '2018-02-01T00:00:00', {'bash' : '4.3', 'curl' : '7.2', 'new' : '1'}) ]:
+            path = os.path.join(self.tempdir, '%s.csversion' % version)
+            with open(path, 'w') as f:
+                f.write(_release(version, time, packages))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _diff(self, manifest):
+        compared = []
+        compareTagDict = manifest.compareTagDict
+        def recordingCompare(dict1, dict2):
+            compared.append(dict1)
+            return compareTagDict(dict1, dict2)
+        manifest.compareTagDict = recordingCompare
+        diff = manifest.diffManifest(DiffProcessor())['diff']
+        names = [ data['dpkg']['amd64']['PACKAGE'] for data in compared if 'dpkg' in data ]
+        return diff, sorted(names)
+
+    def test_unchangedTagsAreSkipped(self):
+        for _ in range(2):
+            #The second time the fingerprints come from the cache
+            manifest = Manifest(self.paths, cache=self.cache)
+            diff, compared = self._diff(manifest)
+            self.assertEqual(compared, ['curl', 'new'])
+            self.assertEqual(sorted(diff['sources'].keys()), ['curl', 'new'])
+            self.assertEqual(
+                diff['sources']['curl']['prod']['new']['dpkg']['amd64']['VERSION'], '7.2')
+            self.assertEqual(
+                diff['sources']['curl']['prod']['old']['dpkg']['amd64']['VERSION'], '7.1')
+
+    def test_sameDiffWithoutFingerprints(self):
+        cached, _ = self._diff(Manifest(self.paths, cache=self.cache))
+        uncached, compared = self._diff(Manifest(self.paths))
+        self.assertEqual(compared, ['bash', 'curl', 'new'])
+        self.assertEqual(cached, uncached)
+
+    def test_knownFingerprintsMatchComputed(self):
+        manifest = Manifest(self.paths, cache=self.cache)
+        known = dict(manifest.fingerprints)
+        self.assertNotEqual(known, {})
+        manifest.fingerprints = {}
+        computed = manifest.getFingerprints()
+        for path, fingerprint in known.iteritems():
+            self.assertEqual(computed[path], fingerprint, path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.ManifestCache import ManifestCache, prepareCacheDir
+
+class ManifestCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.cache = ManifestCache(self.cachedir, logging)
+        self.path = os.path.join(self.tempdir, 'test.csversion')
+        self._write('a: 1\n', 1000000000)
+        self.parsed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, text, mtime):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        os.utime(self.path, (mtime, mtime))
+
+    def _parse(self, filepath):
+        with open(filepath) as f:
+            text = f.read()
+        self.parsed.append(text)
+        return {'text' : text}
+
+    def _load(self):
+        return self.cache.load(self.path, self._parse)
+
+    def test_hit(self):
+        self.assertEqual(self._load(), {'text' : 'a: 1\n'})
+        self.assertEqual(self._load(), {'text' : 'a: 1\n'})
+        self.assertEqual(self.parsed, ['a: 1\n'])
+
+    def test_missOnMtime(self):
+        self._load()
+        os.utime(self.path, (1000000001, 1000000001))
+        self._load()
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_missOnSize(self):
+        self._load()
+        self._write('a: 12\n', 1000000000)
+        self.assertEqual(self._load(), {'text' : 'a: 12\n'})
+
+    def test_missOnContent(self):
+        #Same size and mtime, only the hash tells them apart
+        self._load()
+        self._write('a: 2\n', 1000000000)
+        self.assertEqual(self._load(), {'text' : 'a: 2\n'})
+
+    def test_variants(self):
+        self.cache.load(self.path, self._parse, 'product')
+        self._load()
+        self.cache.load(self.path, self._parse, 'product')
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_digests(self):
+        digested = []
+        def digester(manifest):
+            digested.append(manifest)
+            return {'digest' : manifest['text']}
+        for _ in range(2):
+            self.assertEqual(
+                self.cache.loadDigested(self.path, self._parse, digester),
+                ({'text' : 'a: 1\n'}, {'digest' : 'a: 1\n'}) )
+        self.assertEqual(len(digested), 1)
+        #An entry written without digests doesn't have them to give
+        self._write('a: 3\n', 1000000000)
+        self._load()
+        self.assertEqual(
+            self.cache.loadDigested(self.path, self._parse, digester)[1],
+            {'digest' : 'a: 3\n'} )
+
+    def test_newDirIsPrivate(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.cachedir).st_mode) & 0077, 0)
+        capturedir = self.cache.captureDir()
+        prepareCacheDir(capturedir)
+        self.assertEqual(stat.S_IMODE(os.stat(capturedir).st_mode) & 0077, 0)
+
+    def test_sharedDirIsNotUsed(self):
+        #Anyone who can write to it could have the entries run code
+        self._load()
+        os.chmod(self.cachedir, 0770)
+        self.assertRaises(OSError, ManifestCache, self.cachedir, logging)
+        os.chmod(self.cachedir, 0702)
+        self.assertRaises(OSError, prepareCacheDir, self.cachedir)
+        os.chmod(self.cachedir, 0755)
+        prepareCacheDir(self.cachedir)
+
+    def test_otherUsersDirIsNotUsed(self):
+        if os.geteuid() != 0:
+            return
+        os.chown(self.cachedir, 65534, -1)
+        self.assertRaises(OSError, ManifestCache, self.cachedir, logging)
+
+    def _entry(self, path, size, age):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('x' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def _remaining(self):
+        remaining = []
+        for dirpath, _, names in os.walk(self.cachedir):
+            remaining.extend([ os.path.relpath(os.path.join(dirpath, name), self.cachedir) for name in names ])
+        return sorted(remaining)
+
+    def test_evictionOrder(self):
+        cache = ManifestCache(self.cachedir, logging, maxSize=2500, maxAge=1000)
+        capture = cache.captureDir()
+        self._entry(os.path.join(self.cachedir, 'expired.manifest'), 10, 2000)
+        self._entry(os.path.join(capture, 'expired.section'), 10, 2000)
+        self._entry(os.path.join(self.cachedir, 'oldest.manifest'), 1000, 500)
+        self._entry(os.path.join(capture, 'older.section'), 1000, 400)
+        self._entry(os.path.join(capture, 'venvs', 'newer.venvs'), 1000, 300)
+        self._entry(os.path.join(self.cachedir, 'newest.manifest'), 1000, 200)
+        self._entry(os.path.join(self.cachedir, 'other.file'), 10, 5000)
+        self._entry(os.path.join(capture, 'stale.tmp'), 10, 4000)
+        self._entry(os.path.join(capture, 'fresh.tmp'), 10, 0)
+        cache.prune()
+        #Expired first, then the least recently used until it fits
+        self.assertEqual(self._remaining(), [
+            'capture/fresh.tmp',
+            'capture/venvs/newer.venvs',
+            'newest.manifest',
+            'other.file' ])
+
+    def test_usedEntryIsKept(self):
+        self._load()
+        entry = os.listdir(self.cachedir)[0]
+        #Room for that entry only
+        cache = ManifestCache(self.cachedir, logging,
+            maxSize=os.path.getsize(os.path.join(self.cachedir, entry)), maxAge=1000)
+        old = time.time() - 500
+        os.utime(os.path.join(self.cachedir, entry), (old, old))
+        self._entry(os.path.join(cache.captureDir(), 'newer.section'), 10, 100)
+        #A hit marks the entry used
+        cache.load(self.path, self._parse)
+        cache.prune()
+        self.assertEqual(self._remaining(), [entry])
+
+if __name__ == '__main__':
+    unittest.main()
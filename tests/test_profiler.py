@@ -0,0 +1,176 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.Csversion import Manifest
+from Csversion.Profiler import PROFILER, Profiler
+
+MANIFEST = """product:
+  metadata:
+    prod: {name: prod, version-full: '1.0'}
+sources:
+  bash:
+    prod:
+      dpkg:
+        amd64: {PACKAGE: bash, VERSION: '4.3', ARCH: amd64}
+      __older:
+        0.9__2017-01-01:
+          dpkg:
+            amd64: {PACKAGE: bash, VERSION: '4.2', ARCH: amd64}
+  curl:
+    prod:
+      dpkg:
+        amd64: {PACKAGE: curl, VERSION: '7.1', ARCH: amd64}
+        i386: {PACKAGE: curl, VERSION: '7.1', ARCH: i386}
+  requests:
+    prod:
+      pip:
+        __global: {VENV: __global, PACKAGE: requests, VERSION: '2.0'}
+"""
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = Profiler()
+
+    def test_offRecordsNothing(self):
+        with self.profiler.phase('load', file='a'):
+            pass
+        self.profiler.count('records', 5)
+        self.assertEqual(self.profiler.phases, [])
+        self.assertEqual(self.profiler.counters, {})
+        report = self.profiler.report()
+        self.assertEqual(report['summary'], {})
+        self.assertEqual(report['counters'], {})
+
+    def test_offPhasePassesExceptions(self):
+        def fail():
+            with self.profiler.phase('load'):
+                raise KeyError('a')
+        self.assertRaises(KeyError, fail)
+
+    def test_report(self):
+        self.profiler.enable()
+        with self.profiler.phase('load', file='a'):
+            pass
+        try:
+            with self.profiler.phase('load', file='b'):
+                raise KeyError('b')
+        except KeyError:
+            pass
+        with self.profiler.phase('diff'):
+            pass
+        self.profiler.count('records', 2)
+        self.profiler.count('records')
+        report = self.profiler.report()
+        self.assertEqual(sorted(report['summary'].keys()), ['diff', 'load'])
+        self.assertEqual(report['summary']['load']['calls'], 2)
+        self.assertEqual(report['summary']['diff']['calls'], 1)
+        self.assertEqual(
+            [ (phase['name'], phase['args']) for phase in report['phases'] ],
+            [ ('load', {'file' : 'a'}), ('load', {'file' : 'b'}), ('diff', {}) ] )
+        for phase in report['phases']:
+            self.assertEqual(phase['pid'], os.getpid())
+            self.assertTrue(phase['wall'] >= 0)
+        self.assertEqual(report['counters'], {'records' : 3})
+        self.assertTrue(report['wall'] >= report['phases'][-1]['start'])
+
+    def test_mergeRecords(self):
+        self.profiler.enable()
+        worker = Profiler()
+        worker.enable()
+        worker.origin = self.profiler.origin + 10
+        worker.record('load', 1.0, 0.5, 0.25, {'file' : 'a'}, pid=1, tid=2)
+        worker.count('records', 4)
+        self.profiler.count('records')
+        self.profiler.mergeRecords(worker.takeRecords())
+        self.assertEqual(worker.phases, [])
+        self.assertEqual(worker.counters, {})
+        report = self.profiler.report()
+        self.assertEqual(report['phases'], [ {
+            'name' : 'load', 'start' : 11.0, 'wall' : 0.5, 'cpu' : 0.25,
+            'pid' : 1, 'tid' : 2, 'args' : {'file' : 'a'} } ])
+        self.assertEqual(report['counters'], {'records' : 5})
+
+    def test_writeReportAndTrace(self):
+        self.profiler.enable()
+        self.profiler.record('load', 1.0, 0.5, 0.25, {'file' : 'a'}, pid=1, tid=2)
+        self.profiler.count('records', 4)
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.profiler.writeReport(os.path.join(tempdir, 'report.json'))
+            self.profiler.writeTrace(os.path.join(tempdir, 'trace.json'))
+            with open(os.path.join(tempdir, 'report.json')) as f:
+                report = json.load(f)
+            with open(os.path.join(tempdir, 'trace.json')) as f:
+                trace = json.load(f)
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(report['summary'], {'load' : {'calls' : 1, 'wall' : 0.5, 'cpu' : 0.25}})
+        self.assertEqual(report['counters'], {'records' : 4})
+        events = dict([ (event['ph'], event) for event in trace['traceEvents'] ])
+        self.assertEqual(sorted(events.keys()), ['C', 'X'])
+        self.assertEqual(events['X']['ts'], 1000000)
+        self.assertEqual(events['X']['dur'], 500000)
+        self.assertEqual(events['X']['args'], {'file' : 'a', 'cpu' : 0.25})
+        self.assertEqual(events['C']['args'], {'records' : 4})
+
+class ProfilerManifestRecordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'test.csversion')
+        with open(self.path, 'w') as f:
+            f.write(MANIFEST)
+        PROFILER.takeRecords()
+
+    def tearDown(self):
+        PROFILER.enabled = False
+        PROFILER.takeRecords()
+        shutil.rmtree(self.tempdir)
+
+    def test_offCountsNothing(self):
+        Manifest([self.path])
+        self.assertEqual(PROFILER.takeRecords()[1:], ([], {}))
+
+    def test_recordsParsed(self):
+        PROFILER.enable()
+        Manifest([self.path])
+        _, phases, counters = PROFILER.takeRecords()
+        self.assertEqual(counters, {'dpkg records parsed' : 4, 'pip records parsed' : 1})
+        self.assertEqual([ phase['name'] for phase in phases ], ['loadManifest'])
+
+    def test_sectionRecordsParsed(self):
+        PROFILER.enable()
+        loader = Manifest([])
+        chunks = loader.readSections(self.path)
+        loader.loadSection(self.path, chunks, 'product')
+        self.assertEqual(PROFILER.takeRecords()[2], {})
+        loader.loadSection(self.path, chunks, 'sources')
+        self.assertEqual(
+            PROFILER.takeRecords()[2],
+            {'dpkg records parsed' : 4, 'pip records parsed' : 1} )
+
+if __name__ == '__main__':
+    unittest.main()
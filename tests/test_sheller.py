@@ -0,0 +1,181 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import cPickle
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion import CommandLines
+from Csversion.CommandLines import ProcessTracker
+from Csversion.ConfigDriver import ConfigDriver
+from CsversionModules.Sheller import Sheller
+
+def _exited(pid):
+    #An unreaped zombie counts as exited
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('State:'):
+                    return line.split()[1] in ('Z', 'X')
+    except IOError:
+        return True
+    return False
+
+def _gone(pid):
+    #True once pid exits, a killed process takes a moment to
+    deadline = time.time() + 5
+    while not _exited(pid):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+class ShellerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.log = logging.getLogger('test_sheller')
+        self.log.addHandler(logging.NullHandler())
+        self.log.propagate = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _capture(self, sections, cachedir=None):
+        path = os.path.join(self.tempdir, 'csversionfile')
+        with open(path, 'w') as f:
+            f.write(sections)
+        manifest = {}
+        ConfigDriver([path], self.log, manifest, cachedir=cachedir).execute()
+        return manifest['product']['metadata']
+
+    def test_cacheIsScopedToOneCapture(self):
+        counter = os.path.join(self.tempdir, 'counter')
+        command = "echo x >> %s; wc -l < %s" % (counter, counter)
+        sections = ("[Sheller@a product.metadata]\n**cache = True\ncount = %s\n\n"
+            "[Sheller@b product.metadata]\n**cache = True\ncount = %s\n" % (command, command))
+        first = self._capture(sections)
+        self.assertEqual(first['a']['count'], '1')
+        self.assertEqual(first['b']['count'], '1')
+        second = self._capture(sections)
+        self.assertEqual(second['a']['count'], '2')
+        self.assertEqual(second['b']['count'], '2')
+
+    def test_expiredEntryIsRemovedOnRead(self):
+        sheller = Sheller(self.log)
+        sheller._writeCache(self.tempdir, 'echo old', 'old\n', 60)
+        path = sheller._cachePath(self.tempdir, 'echo old')
+        self.assertEqual(sheller._readCache(self.tempdir, 'echo old', 60), 'old\n')
+        self.assertEqual(sheller._readCache(self.tempdir, 'echo old', -1), None)
+        self.assertFalse(os.path.exists(path))
+
+    def test_expiredEntriesArePruned(self):
+        sheller = Sheller(self.log)
+        sheller._writeCache(self.tempdir, 'echo kept', 'kept\n', 3600)
+        sheller._writeCache(self.tempdir, 'echo gone', 'gone\n', 3600)
+        #Written an hour and a minute ago
+        gone = sheller._cachePath(self.tempdir, 'echo gone')
+        with open(gone, 'rb') as f:
+            entry = cPickle.load(f)
+        entry['time'] -= 3660
+        with open(gone, 'wb') as f:
+            cPickle.dump(entry, f)
+        self._capture("[Sheller@a product.metadata]\n**cache-ttl = 3600\nvalue = echo new\n",
+            cachedir=self.tempdir)
+        self.assertFalse(os.path.exists(gone))
+        self.assertTrue(os.path.exists(sheller._cachePath(self.tempdir, 'echo kept')))
+        self.assertTrue(os.path.exists(sheller._cachePath(self.tempdir, 'echo new')))
+
+    def test_sessionMatchesPlainCommands(self):
+        commands = [
+            'echo )',
+            'echo "it\'s',
+            "echo 'unterminated",
+            'exit 3',
+            'false',
+            'printf "no newline"',
+            'printf "two\\n\\n"',
+            'echo one; echo two >&2; echo three',
+            'cat <<EOF\nhere\nEOF',
+            "echo '<<<Sheller-' $0" ]
+        sheller = Sheller(self.log)
+        session = Sheller.Session(self.log)
+        try:
+            for command in commands:
+                self.assertEqual(session.execute(command, None), sheller._execute(command, None), command)
+            #Still the first session after every command above
+            self.assertEqual(session.execute('echo alive', None), (0, 'alive\n'))
+        finally:
+            session.close()
+
+    def test_sessionIsScopedToOneCapture(self):
+        #$$ of a subshell is the session's shell
+        sections = ("[Sheller@a product.metadata]\n**session = True\nshell = echo $$\n\n"
+            "[Sheller@b product.metadata]\n**session = True\nshell = echo $$\n")
+        first = self._capture(sections)
+        self.assertEqual(first['a']['shell'], first['b']['shell'])
+        self.assertTrue(_gone(int(first['a']['shell'])))
+        second = self._capture(sections)
+        self.assertNotEqual(second['a']['shell'], first['a']['shell'])
+        self.assertTrue(_gone(int(second['a']['shell'])))
+
+    def test_sessionOutsideACapture(self):
+        manifest = Sheller(self.log).csversionPopulateManifest(
+            {}, {'**session' : 'True', 'shell' : 'echo $$'}, 'Sheller', 'a', 'product.metadata')
+        self.assertTrue(_gone(int(manifest['a']['shell'])))
+
+    def test_finishedCommandKeepsTheSession(self):
+        session = Sheller.Session(self.log)
+        tracker = ProcessTracker(self.log)
+        try:
+            tracker.track()
+            self.assertEqual(session.execute('echo one', None), (0, 'one\n'))
+            pid = session.process.pid
+            #The section that ran it is killed, e.g., for its timeout
+            tracker.kill()
+            ProcessTracker(self.log).track()
+            self.assertEqual(session.execute('echo two', None), (0, 'two\n'))
+            self.assertEqual(session.process.pid, pid)
+        finally:
+            CommandLines._tracking.tracker = None
+            session.close()
+
+    def _checkTimeout(self, session):
+        pidfile = os.path.join(self.tempdir, 'pid')
+        start = time.time()
+        metadata = self._capture(
+            "[Sheller@a product.metadata]\n**command-timeout = 1\n**session = %s\n"
+            "slow = sleep 30 & echo $! > %s; wait\n" % (session, pidfile))
+        self.assertLess(time.time() - start, 10)
+        self.assertTrue(metadata['a']['slow'].startswith('<<<Sheller FAILED>>> Timed out after 1.0 seconds'))
+        with open(pidfile) as f:
+            pid = int(f.read())
+        self.assertTrue(_gone(pid))
+
+    def test_timeoutKillsTheCommand(self):
+        self._checkTimeout('False')
+
+    def test_timeoutKillsTheSessionCommand(self):
+        self._checkTimeout('True')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# <copyright>
+# (c) Copyright 2018 Cardinal Peak Technologies
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# </copyright>
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Csversion.VenvFinder import VenvFinder
+
+class VenvFinderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'root')
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.mounts = os.path.join(self.tempdir, 'mounts')
+        self._mounts([])
+        for venv in ['opt/app/venv', 'home/user/.cache/tool', 'home/user/work/deep/er/env',
+          'proc/1/root/venv', 'srv/venv']:
+            self._venv(venv)
+        os.makedirs(os.path.join(self.root, 'usr/bin'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _venv(self, path):
+        bindir = os.path.join(self.root, path, 'bin')
+        os.makedirs(bindir)
+        with open(os.path.join(bindir, 'activate_this.py'), 'w') as f:
+            f.write('')
+
+    def _mounts(self, mounts):
+        with open(self.mounts, 'w') as f:
+            f.write('/dev/root / ext4 rw 0 0\n')
+            for mountpoint, fstype in mounts:
+                f.write('%s %s %s rw 0 0\n' % (
+                    fstype, os.path.join(self.root, mountpoint).replace(' ', '\\040'), fstype ))
+
+    def _find(self, excludes=[], cachedir=None):
+        finder = VenvFinder(self.root, logging, excludes, workers=2, cachedir=cachedir)
+        finder.MOUNTS = self.mounts
+        return finder.find()
+
+    def test_find(self):
+        self.assertEqual(self._find(), [
+            '/home/user/.cache/tool', '/home/user/work/deep/er/env',
+            '/opt/app/venv', '/proc/1/root/venv', '/srv/venv' ])
+
+    def test_prunedMounts(self):
+        os.makedirs(os.path.join(self.root, 'mnt/with space'))
+        self._venv('mnt/with space/venv')
+        self._mounts([('proc', 'proc'), ('mnt/with space', 'nfs4'), ('srv', 'ext4')])
+        self.assertEqual(self._find(), [
+            '/home/user/.cache/tool', '/home/user/work/deep/er/env',
+            '/opt/app/venv', '/srv/venv' ])
+
+    def test_excludes(self):
+        self.assertEqual(self._find(['/home/*/.cache', '/proc']), [
+            '/home/user/work/deep/er/env', '/opt/app/venv', '/srv/venv' ])
+
+    def test_linkCountIsNotTrusted(self):
+        #Some FUSE filesystems and NFS servers report a link count of 2
+        #  for every directory, whatever its subdirectories
+        lstat = os.lstat
+        def twoLinks(path):
+            st = lstat(path)
+            return os.stat_result(st[:3] + (2,) + st[4:])
+        os.lstat = twoLinks
+        try:
+            self.assertEqual(len(self._find()), 5)
+        finally:
+            os.lstat = lstat
+
+    def test_cache(self):
+        self.assertEqual(len(self._find(cachedir=self.cachedir)), 5)
+        listdir = os.listdir
+        listed = []
+        def recordingListdir(path):
+            listed.append(path)
+            return listdir(path)
+        os.listdir = recordingListdir
+        try:
+            #Nothing changed, no directory is listed again
+            self.assertEqual(len(self._find(cachedir=self.cachedir)), 5)
+            self.assertEqual(listed, [])
+            #Only the directory that changed is
+            self._venv('opt/app/other')
+            self.assertEqual(self._find(cachedir=self.cachedir), [
+                '/home/user/.cache/tool', '/home/user/work/deep/er/env',
+                '/opt/app/other', '/opt/app/venv', '/proc/1/root/venv', '/srv/venv' ])
+            self.assertTrue(os.path.join(self.root, 'opt/app') in listed)
+            self.assertFalse(os.path.join(self.root, 'home/user/work') in listed)
+        finally:
+            os.listdir = listdir
+
+if __name__ == '__main__':
+    unittest.main()